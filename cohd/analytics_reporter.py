@@ -0,0 +1,127 @@
+u"""
+Background reporting to Google Analytics
+
+Pageview hits are put on a bounded in-process queue and sent by a worker thread through the Measurement Protocol batch
+endpoint, so that requests only pay for an enqueue. When the queue is full, hits are dropped rather than slowing down
+requests.
+
+https://developers.google.com/analytics/devguides/collection/protocol/v1/devguide#batch
+"""
+
+import os
+import threading
+import urllib
+from Queue import Queue, Full, Empty
+import requests
+
+# Measurement Protocol limits: at most 20 hits per batch request, 8 KB per hit, and 16 KB per batch request
+_URL_GA_BATCH = u'https://www.google-analytics.com/batch'
+_MAX_BATCH_HITS = 20
+_MAX_HIT_BYTES = 8192
+_MAX_BATCH_BYTES = 16384
+
+
+class AnalyticsReporter(object):
+    """ Sends hits to Google Analytics from a background thread """
+
+    def __init__(self, max_queue=10000, timeout=5, url=_URL_GA_BATCH):
+        """ Create a new reporter. The worker thread is started on the first report.
+
+        :param max_queue: int - Maximum number of hits waiting to be sent
+        :param timeout: float - Seconds to wait for Google Analytics
+        :param url: Batch endpoint URL
+        """
+        self.url = url
+        self.max_queue = max_queue
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._queue = Queue(max_queue)
+        self._pid = None
+        self._stats = {
+            u'queued': 0,
+            u'sent': 0,
+            u'dropped': 0,
+            u'failed': 0
+        }
+
+    def _ensure_worker(self):
+        # Threads do not survive a fork, so each worker process starts its own thread (and queue) on first use
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = Queue(self.max_queue)
+                worker = threading.Thread(target=self._run, args=(self._queue,), name=u'analytics-reporter')
+                worker.daemon = True
+                worker.start()
+                self._pid = os.getpid()
+
+    def report(self, hit):
+        """ Queue a hit to be sent. Never blocks: the hit is dropped if the queue is full.
+
+        :param hit: dict - Measurement Protocol parameters
+        :return: True if the hit was queued
+        """
+        self._ensure_worker()
+        payload = urllib.urlencode({k: unicode(v).encode(u'utf8') for k, v in hit.items()})
+        try:
+            self._queue.put_nowait(payload)
+        except Full:
+            self._count(u'dropped')
+            return False
+        self._count(u'queued')
+        return True
+
+    def _count(self, stat, n=1):
+        with self._lock:
+            self._stats[stat] += n
+
+    def _next_batch(self, queue, first=None):
+        """ Waits for a hit (unless first is given), then takes as many more as fit in a batch request """
+        batch = [first if first is not None else queue.get()]
+        size = len(batch[0])
+        while len(batch) < _MAX_BATCH_HITS:
+            try:
+                payload = queue.get_nowait()
+            except Empty:
+                break
+            if size + len(payload) + 1 > _MAX_BATCH_BYTES:
+                # Leave the hit for the next batch
+                return batch, payload
+            batch.append(payload)
+            size += len(payload) + 1
+        return batch, None
+
+    def _run(self, queue):
+        carry = None
+        while True:
+            batch, carry = self._next_batch(queue, carry)
+
+            # Google Analytics discards oversized hits
+            oversized = [payload for payload in batch if len(payload) > _MAX_HIT_BYTES]
+            if oversized:
+                self._count(u'dropped', len(oversized))
+                batch = [payload for payload in batch if len(payload) <= _MAX_HIT_BYTES]
+                if not batch:
+                    continue
+
+            try:
+                r = requests.post(self.url, data='\n'.join(batch), timeout=self.timeout)
+                r.raise_for_status()
+                self._count(u'sent', len(batch))
+            except Exception as e:
+                # Reporting must never take down the worker
+                print u"Google Analytics error: ", e
+                self._count(u'failed', len(batch))
+
+    def stats(self):
+        """ Reporting statistics for monitoring
+
+        :return: dict
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats[u'pending'] = self._queue.qsize()
+        stats[u'max_queue'] = self.max_queue
+        return stats
@@ -0,0 +1,114 @@
+u"""
+Association statistics between pairs of concepts
+
+Vectorized versions of the statistics returned by the association endpoints. The same functions are used when serving
+requests and when precomputing the cohd.concept_pair_stats table, so that both produce identical values.
+"""
+
+import numpy as np
+from scipy.stats import chi2
+
+
+def chi_square(concept_pair_count, concept_count_1, concept_count_2, patient_count):
+    """ Chi-square test of independence for many pairs of concepts at once
+
+    Builds the observed and expected 2x2 tables for all pairs as arrays, equivalent to calling
+    scipy.stats.chisquare(observed, expected, ddof=2) on each pair.
+
+    :param concept_pair_count: array of pair counts
+    :param concept_count_1: array of concept 1 counts
+    :param concept_count_2: array of concept 2 counts
+    :param patient_count: array (or scalar) of dataset patient counts
+    :return: (array of chi-square statistics, array of p-values)
+    """
+    cpc = np.asarray(concept_pair_count, dtype=np.float64)
+    c1 = np.asarray(concept_count_1, dtype=np.float64)
+    c2 = np.asarray(concept_count_2, dtype=np.float64)
+    pts = np.asarray(patient_count, dtype=np.float64)
+    neg = pts - c1 - c2 + cpc
+
+    observed = [neg, c1 - cpc, c2 - cpc, cpc]
+    expected = [(pts - c1) * (pts - c2) / pts, c1 * (pts - c2) / pts, c2 * (pts - c1) / pts, c1 * c2 / pts]
+    statistic = sum((o - e) ** 2 / e for o, e in zip(observed, expected))
+
+    # p-value from the chi-square distribution with 1 degree of freedom
+    return statistic, chi2.sf(statistic, 1)
+
+
+def expected_count(concept_count_1, concept_count_2, patient_count):
+    """ Expected pair count assuming independence, i.e., c1 * c2 / N
+
+    Integer products are taken before the division, as in the obsExpRatio SQL query.
+    """
+    c1 = np.asarray(concept_count_1, dtype=np.int64)
+    c2 = np.asarray(concept_count_2, dtype=np.int64)
+    return (c1 * c2) / (np.int64(patient_count) + 0.0)
+
+
+def ln_ratio(concept_pair_count, concept_count_1, concept_count_2, patient_count):
+    """ Natural log of the ratio between the observed and expected pair counts, i.e., ln(cpc * N / (c1 * c2)) """
+    cpc = np.asarray(concept_pair_count, dtype=np.int64)
+    c1 = np.asarray(concept_count_1, dtype=np.int64)
+    c2 = np.asarray(concept_count_2, dtype=np.int64)
+    return np.log((cpc * np.int64(patient_count)) / (c1 * c2 + 0.0))
+
+
+def relative_frequency(concept_pair_count, concept_count_2):
+    """ Pair count relative to the count of concept 2, i.e., cpc / c2 """
+    cpc = np.asarray(concept_pair_count, dtype=np.int64)
+    c2 = np.asarray(concept_count_2, dtype=np.int64)
+    return cpc / (c2 + 0.0)
+
+
+def rank_descending(values, limit=None, ids=None):
+    """ Indices that sort values in descending order, keeping only the top limit if specified
+
+    Ties are broken by ids in ascending order (or by position if ids is not specified), so that the ranking is
+    deterministic and consistent with keyset pagination on (value, id).
+
+    :param values: numpy array
+    :param limit: int (optional)
+    :param ids: numpy array of tie-breakers (optional)
+    :return: numpy array of indices
+    """
+    values = np.asarray(values)
+    ids = np.arange(len(values)) if ids is None else np.asarray(ids)
+    candidates = np.arange(len(values))
+    if limit is not None and limit < len(values):
+        # Partial selection of the top-k is O(n), so only the k largest values (plus ties) need to be sorted
+        kth = -np.partition(-values, limit - 1)[limit - 1]
+        if kth == kth:
+            with np.errstate(invalid=u'ignore'):
+                candidates = np.flatnonzero(values >= kth)
+    order = candidates[np.lexsort((ids[candidates], -values[candidates]))]
+    return order[:limit] if limit is not None else order
+
+
+def page_mask(values, ids, pair_counts, page, statistic=None):
+    """ Filters values by the min_count, min_statistic and cursor parameters of a page
+
+    :param values: numpy array of the values the results are ranked by
+    :param ids: numpy array of associated concept_ids
+    :param pair_counts: numpy array of pair counts
+    :param page: dict of page parameters (see query_cohd_mysql._get_page_args)
+    :param statistic: numpy array compared to min_statistic, if different from values
+    :return: (boolean mask of values on the page or later pages, number of values passing the filters)
+    """
+    if statistic is None:
+        statistic = values
+    mask = np.ones(len(values), dtype=bool)
+    with np.errstate(invalid=u'ignore'):
+        if page[u'min_count'] is not None:
+            mask &= pair_counts >= page[u'min_count']
+        if page[u'min_statistic'] is not None:
+            mask &= statistic >= page[u'min_statistic']
+        total_count = int(mask.sum())
+        if page[u'cursor'] is not None:
+            # Keyset pagination: continue after the last (value, id) of the previous page. NaN values are ranked last
+            # (see rank_descending), and a cursor at a NaN value has the value None.
+            value, concept_id = page[u'cursor']
+            if value is None:
+                mask &= np.isnan(values) & (ids > concept_id)
+            else:
+                mask &= (values < value) | ((values == value) & (ids > concept_id)) | np.isnan(values)
+    return mask, total_count
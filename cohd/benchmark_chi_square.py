@@ -0,0 +1,93 @@
+u"""
+Compares the chiSquare computation before and after vectorization
+
+The original implementation called scipy.stats.chisquare on the 2x2 table of each pair and ranked the pairs with
+reversed(argsort(chi_squares)). The vectorized implementation (association_stats.chi_square) computes all pairs with
+array operations. Both are timed on synthetic counts of one concept's pairs, with many tied counts, and the statistics,
+p-values, and ranking are checked to be identical.
+
+Run from the cohd directory:
+    python benchmark_chi_square.py --rows 20000 --repeat 5
+"""
+
+import argparse
+import time
+import numpy as np
+from numpy import argsort
+from scipy.stats import chisquare
+
+from association_stats import chi_square
+
+
+def _counts(rows, seed):
+    """ Synthetic counts of the pairs of one concept, with power-law distributed (and often tied) counts """
+    rng = np.random.RandomState(seed)
+    patient_count = 5000000
+    concept_count_1 = 200000
+    concept_count_2 = np.minimum((rng.pareto(1.2, rows) + 1) * 100, patient_count - concept_count_1).astype(np.int64)
+    concept_pair_count = np.maximum(1, (concept_count_2 * rng.uniform(0, 0.1, rows)).astype(np.int64))
+    return concept_pair_count, np.full(rows, concept_count_1, dtype=np.int64), concept_count_2, patient_count
+
+
+def _original(concept_pair_count, concept_count_1, concept_count_2, patient_count):
+    """ The per-row computation and ranking of the original chiSquare implementation """
+    statistics = []
+    p_values = []
+    for cpc, c1, c2 in zip(concept_pair_count, concept_count_1, concept_count_2):
+        cpc = float(cpc)
+        c1 = float(c1)
+        c2 = float(c2)
+        pts = float(patient_count)
+        neg = pts - c1 - c2 + cpc
+        o = [neg, c1 - cpc, c2 - cpc, cpc]
+        e = [(pts - c1) * (pts - c2) / pts, c1 * (pts - c2) / pts, c2 * (pts - c1) / pts, c1 * c2 / pts]
+        cs = chisquare(o, e, 2)
+        statistics.append(cs.statistic)
+        p_values.append(cs.pvalue)
+    order = list(reversed(argsort(statistics)))
+    return np.array(statistics), np.array(p_values), np.array(order)
+
+
+def _vectorized(concept_pair_count, concept_count_1, concept_count_2, patient_count):
+    """ The computation and ranking of the vectorized chiSquare implementation (without pagination) """
+    statistics, p_values = chi_square(concept_pair_count, concept_count_1, concept_count_2, patient_count)
+    order = np.argsort(statistics)[::-1]
+    return statistics, p_values, order
+
+
+def _time(function, counts, repeat):
+    """ Median duration in ms of repeated calls, and the result of the last call """
+    durations = []
+    result = None
+    for _ in range(repeat):
+        start = time.time()
+        result = function(*counts)
+        durations.append((time.time() - start) * 1000)
+    return np.median(durations), result
+
+
+def run(rows, repeat, seed):
+    counts = _counts(rows, seed)
+    n_tied = rows - len(np.unique(counts[2] * (counts[0].max() + 1) + counts[0]))
+    print u"%d pairs (%d with the same counts as another pair), median of %d runs" % (rows, n_tied, repeat)
+
+    original_ms, original = _time(_original, counts, repeat)
+    vectorized_ms, vectorized = _time(_vectorized, counts, repeat)
+    print u"  original    %10.2f ms" % original_ms
+    print u"  vectorized  %10.2f ms (%.0fx)" % (vectorized_ms, original_ms / vectorized_ms)
+
+    for name, a, b in zip((u'chi_square', u'p-value', u'ranking'), original, vectorized):
+        if np.array_equal(a, b):
+            print u"  %-10s identical" % name
+        else:
+            print u"  WARNING: %s differs in %d rows" % (name, np.count_nonzero(a != b))
+
+
+if __name__ == u"__main__":
+    parser = argparse.ArgumentParser(description=u'Compare the chiSquare computation before and after vectorization')
+    parser.add_argument(u'--rows', type=int, default=20000, help=u'Number of pairs')
+    parser.add_argument(u'--repeat', type=int, default=5, help=u'Number of timed runs of each implementation')
+    parser.add_argument(u'--seed', type=int, default=0, help=u'Random seed')
+    arguments = parser.parse_args()
+
+    run(arguments.rows, arguments.repeat, arguments.seed)
@@ -0,0 +1,377 @@
+u"""
+Benchmarks every route of the COHD API
+
+Each route in cohd.py is requested through the Flask test client, in process, with parameters sampled from the
+database: concepts are sampled half uniformly and half weighted by their counts (so that hub concepts with many
+associations are included), and pairs are sampled from concept_pair_counts. The latency percentiles (p50, p95, p99),
+the throughput, and the peak resident memory after each endpoint are written as JSON, which can be compared with the
+results of another commit or configuration with --compare. Use a dataset from generate_synthetic_dataset.py to
+benchmark at a chosen scale without the COHD data.
+
+The API is configured by cohd_flask.conf. --sqlite serves from a SQLite database built by load_dataset.py instead, and
+--set overrides other settings, e.g., to compare the optional query backends. The response cache is disabled unless
+--response_cache is given, so that every request runs its query. The xref endpoints are only benchmarked with
+--oxo_url (e.g., an oxo_stub_server.py), since they call OxO.
+
+Run from the cohd directory (the location of cohd_flask.conf):
+    python benchmark_endpoints.py --sqlite cohd_bench.sqlite --requests 200 --output before.json
+    python benchmark_endpoints.py --sqlite cohd_bench.sqlite --set CONCEPT_DICTIONARY=True --compare before.json
+"""
+
+import argparse
+import ast
+import json
+import platform
+import resource
+import subprocess
+import sys
+import time
+import timeit
+import numpy as np
+import pymysql
+
+# Number of sampled concepts and pairs the request parameters are drawn from
+_SAMPLES = 500
+# Number of concept_ids in the multi-concept queries
+_MULTI_CONCEPTS = 10
+# Number of queries in a batch request
+_BATCH_SIZE = 20
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output([u'git', u'rev-parse', u'HEAD'], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _peak_rss_mb():
+    """ Peak resident memory of this process (ru_maxrss is in kilobytes on Linux, bytes on macOS) """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1048576.0 if sys.platform == u'darwin' else 1024.0)
+
+
+def _sample(conn, dataset_id, seed):
+    """ Samples the concepts, pairs, source codes, and name words that the requests are made with
+
+    :return: dict of lists
+    """
+    random = np.random.RandomState(seed)
+    cur = conn.cursor(pymysql.cursors.Cursor)
+
+    cur.execute('''SELECT concept_id, concept_count FROM cohd.concept_counts WHERE dataset_id = %s;''', [dataset_id])
+    rows = cur.fetchall()
+    if not rows:
+        raise ValueError(u'No concepts in dataset %d' % dataset_id)
+    concept_ids = np.array([row[0] for row in rows], dtype=np.int64)
+    weights = np.array([row[1] for row in rows], dtype=np.float64)
+    concepts = np.concatenate([random.choice(concept_ids, _SAMPLES // 2),
+                               random.choice(concept_ids, _SAMPLES - _SAMPLES // 2, p=weights / weights.sum())])
+    random.shuffle(concepts)
+    concepts = concepts.tolist()
+
+    # Each pair is the first pair at or after a sampled concept_id_1, in a random orientation
+    pairs = []
+    for concept_id in concepts:
+        cur.execute('''SELECT concept_id_1, concept_id_2
+            FROM cohd.concept_pair_counts
+            WHERE dataset_id = %s AND concept_id_1 >= %s
+            ORDER BY concept_id_1, concept_id_2
+            LIMIT 1;''', [dataset_id, concept_id])
+        row = cur.fetchone()
+        if row is not None:
+            pairs.append(row if random.rand() < 0.5 else row[::-1])
+    if not pairs:
+        raise ValueError(u'No concept pairs in dataset %d' % dataset_id)
+
+    # Source codes for mapToStandardConceptID, and words of the concept names for findConceptIDs
+    codes = []
+    words = []
+    for concept_id in concepts[:50]:
+        cur.execute('''SELECT concept_code, vocabulary_id
+            FROM cohd.concept
+            WHERE concept_id >= %s AND standard_concept IS NULL
+            ORDER BY concept_id
+            LIMIT 1;''', [concept_id])
+        row = cur.fetchone()
+        if row is not None:
+            codes.append(row)
+        cur.execute('''SELECT concept_name FROM cohd.concept WHERE concept_id = %s;''', [concept_id])
+        row = cur.fetchone()
+        if row is not None and row[0].split():
+            words.append(row[0].split()[0])
+    cur.close()
+
+    return {u'concepts': concepts, u'pairs': pairs, u'codes': codes or [(u'715.3', u'ICD9CM')],
+            u'words': words or [u'cancer']}
+
+
+def _endpoints(samples, dataset_id, include_xref):
+    """ The benchmarked requests
+
+    :return: list of (name, HTTP method, path, function of the request number that returns the query parameters or
+        the JSON body)
+    """
+    concepts = samples[u'concepts']
+    pairs = samples[u'pairs']
+    codes = samples[u'codes']
+    words = samples[u'words']
+
+    def concept(i):
+        return concepts[i % len(concepts)]
+
+    def pair(i):
+        return pairs[i % len(pairs)]
+
+    def concept_list(i):
+        return u','.join(u'%d' % concept(i * _MULTI_CONCEPTS + k) for k in range(_MULTI_CONCEPTS))
+
+    def association(i, with_pair):
+        if with_pair:
+            return {u'dataset_id': dataset_id, u'concept_id_1': pair(i)[0], u'concept_id_2': pair(i)[1]}
+        return {u'dataset_id': dataset_id, u'concept_id_1': concept(i)}
+
+    def batch(i):
+        items = []
+        for k in range(_BATCH_SIZE):
+            if k % 2 == 0:
+                items.append({u'service': u'frequencies', u'meta': u'singleConceptFreq',
+                              u'args': {u'dataset_id': dataset_id, u'q': u'%d' % concept(i * _BATCH_SIZE + k)}})
+            else:
+                items.append({u'service': u'frequencies', u'meta': u'pairedConceptFreq',
+                              u'args': {u'dataset_id': dataset_id, u'q': u'%d,%d' % pair(i * _BATCH_SIZE + k)}})
+        return items
+
+    endpoints = [
+        (u'/', u'GET', u'/', lambda i: {}),
+        (u'omop/findConceptIDs', u'GET', u'/api/omop/findConceptIDs',
+         lambda i: {u'q': words[i % len(words)], u'dataset_id': dataset_id}),
+        (u'omop/concepts', u'GET', u'/api/omop/concepts', lambda i: {u'q': concept_list(i)}),
+        (u'omop/mapToStandardConceptID', u'GET', u'/api/omop/mapToStandardConceptID',
+         lambda i: {u'concept_code': codes[i % len(codes)][0], u'vocabulary_id': codes[i % len(codes)][1]}),
+        (u'omop/mapFromStandardConceptID', u'GET', u'/api/omop/mapFromStandardConceptID',
+         lambda i: {u'concept_id': concept(i)}),
+        (u'omop/vocabularies', u'GET', u'/api/omop/vocabularies', lambda i: {}),
+        (u'metadata/datasets', u'GET', u'/api/metadata/datasets', lambda i: {}),
+        (u'metadata/domainCounts', u'GET', u'/api/metadata/domainCounts', lambda i: {u'dataset_id': dataset_id}),
+        (u'metadata/domainPairCounts', u'GET', u'/api/metadata/domainPairCounts',
+         lambda i: {u'dataset_id': dataset_id}),
+        (u'metadata/patientCount', u'GET', u'/api/metadata/patientCount', lambda i: {u'dataset_id': dataset_id}),
+        (u'frequencies/singleConceptFreq', u'GET', u'/api/frequencies/singleConceptFreq',
+         lambda i: {u'dataset_id': dataset_id, u'q': concept_list(i)}),
+        (u'frequencies/pairedConceptFreq', u'GET', u'/api/frequencies/pairedConceptFreq',
+         lambda i: {u'dataset_id': dataset_id, u'q': u'%d,%d' % pair(i)}),
+        (u'frequencies/associatedConceptFreq', u'GET', u'/api/frequencies/associatedConceptFreq',
+         lambda i: {u'dataset_id': dataset_id, u'q': concept(i)}),
+        (u'frequencies/associatedConceptDomainFreq', u'GET', u'/api/frequencies/associatedConceptDomainFreq',
+         lambda i: {u'dataset_id': dataset_id, u'concept_id': concept(i), u'domain': u'Condition'}),
+        (u'frequencies/pairwiseConceptFreq', u'GET', u'/api/frequencies/pairwiseConceptFreq',
+         lambda i: {u'dataset_id': dataset_id, u'q': concept_list(i)}),
+        (u'frequencies/mostFrequentConcepts', u'GET', u'/api/frequencies/mostFrequentConcepts',
+         lambda i: {u'dataset_id': dataset_id, u'q': 100}),
+    ]
+    for method in (u'chiSquare', u'obsExpRatio', u'relativeFrequency'):
+        endpoints.append((u'association/%s (pair)' % method, u'GET', u'/api/association/' + method,
+                          lambda i: association(i, True)))
+        endpoints.append((u'association/%s (concept)' % method, u'GET', u'/api/association/' + method,
+                          lambda i: association(i, False)))
+    endpoints += [
+        (u'query', u'GET', u'/api/query',
+         lambda i: {u'service': u'frequencies', u'meta': u'singleConceptFreq', u'dataset_id': dataset_id,
+                    u'q': concept(i)}),
+        (u'batch', u'POST', u'/api/v1/batch', batch),
+        (u'admin/poolStats', u'GET', u'/api/admin/poolStats', lambda i: {}),
+        (u'admin/conceptDictionaryStats', u'GET', u'/api/admin/conceptDictionaryStats', lambda i: {}),
+        (u'admin/cacheStats', u'GET', u'/api/admin/cacheStats', lambda i: {}),
+        (u'admin/analyticsStats', u'GET', u'/api/admin/analyticsStats', lambda i: {}),
+        (u'admin/oxoStatus', u'GET', u'/api/admin/oxoStatus', lambda i: {}),
+    ]
+    if include_xref:
+        endpoints += [
+            (u'omop/xrefToOMOP', u'GET', u'/api/omop/xrefToOMOP',
+             lambda i: {u'curie': u'DOID:%d' % (8398 + i % 100), u'distance': 2, u'dataset_id': dataset_id}),
+            (u'omop/xrefFromOMOP', u'GET', u'/api/omop/xrefFromOMOP',
+             lambda i: {u'concept_id': concept(i), u'distance': 2, u'dataset_id': dataset_id}),
+        ]
+    # Last, since it drops the in-memory data that the other endpoints use
+    endpoints.append((u'admin/invalidateDataset', u'POST', u'/api/admin/invalidateDataset',
+                      lambda i: {u'dataset_id': dataset_id}))
+    return endpoints
+
+
+def _request(client, http_method, path, params):
+    """ Makes one request and reads the whole response (including streamed responses)
+
+    :return: status code
+    """
+    if http_method == u'POST' and isinstance(params, list):
+        response = client.post(path, data=json.dumps(params), content_type=u'application/json')
+    elif http_method == u'POST':
+        response = client.post(path, query_string=params)
+    else:
+        response = client.get(path, query_string=params)
+    try:
+        response.get_data()
+        return response.status_code
+    finally:
+        response.close()
+
+
+def _run_endpoint(client, endpoint, n_requests, warmup):
+    """ Times the requests of one endpoint
+
+    :return: dict of results
+    """
+    name, http_method, path, params = endpoint
+    for i in range(warmup):
+        _request(client, http_method, path, params(n_requests + i))
+
+    latencies = []
+    errors = 0
+    start = timeit.default_timer()
+    for i in range(n_requests):
+        request_start = timeit.default_timer()
+        status = _request(client, http_method, path, params(i))
+        latencies.append((timeit.default_timer() - request_start) * 1000)
+        if status >= 400:
+            errors += 1
+    elapsed = timeit.default_timer() - start
+
+    return {
+        u'endpoint': name,
+        u'path': path,
+        u'requests': n_requests,
+        u'errors': errors,
+        u'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+        u'p95_ms': round(float(np.percentile(latencies, 95)), 3),
+        u'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+        u'mean_ms': round(float(np.mean(latencies)), 3),
+        u'throughput_rps': round(n_requests / max(elapsed, 1e-9), 1),
+        u'peak_rss_mb': round(_peak_rss_mb(), 1)
+    }
+
+
+def run(dataset_id, n_requests, warmup, seed, sqlite=None, settings=None, oxo_url=None, response_cache=False,
+        names=None):
+    """ Benchmarks the endpoints
+
+    :param dataset_id: Dataset the requests are made to
+    :param n_requests: Number of timed requests per endpoint
+    :param warmup: Number of untimed requests per endpoint before the timed requests
+    :param seed: Random seed of the sampled parameters
+    :param sqlite: SQLite database to serve from instead of the database in cohd_flask.conf
+    :param settings: dict of Flask configuration settings to override
+    :param oxo_url: OxO URL for the xref endpoints, which are skipped if None
+    :param response_cache: Keep the configured response cache
+    :param names: Names of the endpoints to benchmark, or None for all
+    :return: dict of results
+    """
+    import cohd
+    import query_cohd_mysql
+    from storage_backends import create_backend
+
+    config = cohd.app.config
+    if sqlite is not None:
+        config[u'STORAGE_BACKEND'] = u'sqlite'
+        config[u'SQLITE_DATABASE'] = sqlite
+    if oxo_url is not None:
+        config[u'OXO_URL'] = oxo_url
+    config.update(settings or {})
+
+    # Reconfigure with the overridden settings, dropping anything loaded with the settings of cohd_flask.conf
+    start = time.time()
+    query_cohd_mysql.reload_dataset()
+    cohd.configure(config)
+    startup = time.time() - start
+    if not response_cache:
+        cohd.response_cache = None
+
+    conn = create_backend(config, query_cohd_mysql.CONFIG_FILE).connect()
+    try:
+        samples = _sample(conn, dataset_id, seed)
+    finally:
+        conn.close()
+
+    client = cohd.app.test_client()
+    if cohd.app.config.get(u'ADMIN_TOKEN'):
+        client.environ_base[u'HTTP_X_COHD_ADMIN_TOKEN'] = cohd.app.config[u'ADMIN_TOKEN']
+    results = []
+    for endpoint in _endpoints(samples, dataset_id, oxo_url is not None):
+        if names and endpoint[0] not in names:
+            continue
+        results.append(_run_endpoint(client, endpoint, n_requests, warmup))
+        print >> sys.stderr, u"%-45s p50 %8.2f ms  p95 %8.2f ms  p99 %8.2f ms  %8.1f req/s  %d errors" % \
+            (results[-1][u'endpoint'], results[-1][u'p50_ms'], results[-1][u'p95_ms'], results[-1][u'p99_ms'],
+             results[-1][u'throughput_rps'], results[-1][u'errors'])
+
+    return {
+        u'git_commit': _git_commit(),
+        u'python': platform.python_version(),
+        u'platform': platform.platform(),
+        u'storage_backend': config.get(u'STORAGE_BACKEND', u'mysql'),
+        u'settings': {key: value for key, value in (settings or {}).items()},
+        u'dataset_id': dataset_id,
+        u'requests_per_endpoint': n_requests,
+        u'seed': seed,
+        u'startup_s': round(startup, 3),
+        u'endpoints': results
+    }
+
+
+def compare(results, baseline):
+    """ Prints the change of the latencies and throughput of each endpoint from the baseline results """
+    base = {r[u'endpoint']: r for r in baseline[u'endpoints']}
+    print >> sys.stderr, u"\nCompared with %s:" % (baseline.get(u'git_commit') or u'baseline')
+    for r in results[u'endpoints']:
+        b = base.get(r[u'endpoint'])
+        if b is None:
+            continue
+        ratios = [r[key] / b[key] if b[key] else float(u'nan') for key in (u'p50_ms', u'p95_ms', u'p99_ms',
+                                                                             u'throughput_rps')]
+        print >> sys.stderr, u"%-45s p50 x%.2f  p95 x%.2f  p99 x%.2f  throughput x%.2f" % tuple([r[u'endpoint']] +
+                                                                                              ratios)
+
+
+def _setting(value):
+    """ Parses KEY=VALUE, where VALUE is a Python literal or a string """
+    key, sep, text = value.partition(u'=')
+    if not sep:
+        raise argparse.ArgumentTypeError(u'expected KEY=VALUE')
+    try:
+        return key, ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return key, text
+
+
+if __name__ == u"__main__":
+    parser = argparse.ArgumentParser(description=u'Benchmark the COHD API endpoints')
+    parser.add_argument(u'--sqlite', help=u'Serve from this SQLite database (see load_dataset.py)')
+    parser.add_argument(u'--dataset_id', type=int, default=1, help=u'Dataset to query')
+    parser.add_argument(u'--requests', type=int, default=200, help=u'Number of timed requests per endpoint')
+    parser.add_argument(u'--warmup', type=int, default=10, help=u'Number of untimed requests per endpoint')
+    parser.add_argument(u'--seed', type=int, default=0, help=u'Random seed')
+    parser.add_argument(u'--set', type=_setting, action=u'append', default=[], metavar=u'KEY=VALUE',
+                        help=u'Override a setting of cohd_flask.conf (may be repeated)')
+    parser.add_argument(u'--oxo_url', help=u'OxO URL (e.g., of oxo_stub_server.py) to benchmark the xref endpoints')
+    parser.add_argument(u'--response_cache', action=u'store_true', help=u'Keep the configured response cache')
+    parser.add_argument(u'--endpoint', action=u'append', help=u'Endpoint to benchmark (may be repeated). Default: all')
+    parser.add_argument(u'--output', help=u'JSON results file. Default: standard output')
+    parser.add_argument(u'--compare', help=u'JSON results file of a previous run to compare with')
+    arguments = parser.parse_args()
+
+    # The API logs to standard output, which is kept for the results
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    benchmark = run(arguments.dataset_id, arguments.requests, arguments.warmup, arguments.seed, arguments.sqlite,
+                    dict(arguments.set), arguments.oxo_url, arguments.response_cache, arguments.endpoint)
+    sys.stdout = stdout
+
+    if arguments.compare:
+        with open(arguments.compare) as f:
+            compare(benchmark, json.load(f))
+    if arguments.output:
+        with open(arguments.output, u'w') as f:
+            json.dump(benchmark, f, indent=2, sort_keys=True)
+    else:
+        json.dump(benchmark, sys.stdout, indent=2, sort_keys=True)
+        print
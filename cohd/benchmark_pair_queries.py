@@ -0,0 +1,154 @@
+u"""
+Compares the query plans and latencies of the concept pair queries before and after canonical pair ordering
+
+For each query shape, the original query (an (a, b) OR (b, a) predicate, IN (a, b) AND IN (a, b), or a UNION of scans
+on concept_id_1 and concept_id_2) and the canonical query (one primary key lookup on cohd.concept_pair_counts, or one
+range scan of cohd.concept_pair_adjacency) are explained and then timed on a sample of pairs and concepts. Both forms
+return the same pairs, so the original queries run against the migrated tables (see build_canonical_pairs.py).
+
+Run from the cohd directory (the location of cohd_mysql.cnf):
+    python benchmark_pair_queries.py --dataset_id 1 --samples 200
+"""
+
+import argparse
+import time
+import numpy as np
+import pymysql
+
+# (name, original query, canonical query). Parameters: dataset_id, concept_id_1, concept_id_2 in the requested
+# orientation, and pair_id_1 < pair_id_2 in canonical order.
+_QUERIES = [
+    (u'pairedConceptFreq',
+     '''SELECT cpc.concept_id_1, cpc.concept_id_2, cpc.concept_count
+        FROM cohd.concept_pair_counts cpc
+        WHERE cpc.dataset_id = %(dataset_id)s AND
+            ((concept_id_1 = %(concept_id_1)s AND concept_id_2 = %(concept_id_2)s) OR
+            (concept_id_1 = %(concept_id_2)s AND concept_id_2 = %(concept_id_1)s));''',
+     '''SELECT cpc.concept_id_1, cpc.concept_id_2, cpc.concept_count
+        FROM cohd.concept_pair_counts cpc
+        WHERE cpc.dataset_id = %(dataset_id)s
+            AND cpc.concept_id_1 = %(pair_id_1)s AND cpc.concept_id_2 = %(pair_id_2)s;'''),
+    (u'chiSquare (pair)',
+     '''SELECT cp.concept_id_1, cp.concept_id_2, cp.concept_count
+        FROM cohd.concept_pair_counts cp
+        WHERE cp.dataset_id = %(dataset_id)s
+            AND cp.concept_id_1 IN (%(concept_id_1)s, %(concept_id_2)s)
+            AND cp.concept_id_2 IN (%(concept_id_1)s, %(concept_id_2)s);''',
+     '''SELECT cp.concept_id_1, cp.concept_id_2, cp.concept_count
+        FROM cohd.concept_pair_counts cp
+        WHERE cp.dataset_id = %(dataset_id)s
+            AND cp.concept_id_1 = %(pair_id_1)s AND cp.concept_id_2 = %(pair_id_2)s;'''),
+    (u'associatedConceptFreq',
+     '''(SELECT cpc.concept_id_2 AS associated_concept_id, cpc.concept_count
+        FROM cohd.concept_pair_counts cpc
+        WHERE cpc.dataset_id = %(dataset_id)s AND cpc.concept_id_1 = %(concept_id_1)s)
+        UNION
+        (SELECT cpc.concept_id_1 AS associated_concept_id, cpc.concept_count
+        FROM cohd.concept_pair_counts cpc
+        WHERE cpc.dataset_id = %(dataset_id)s AND cpc.concept_id_2 = %(concept_id_1)s)
+        ORDER BY concept_count DESC, associated_concept_id ASC;''',
+     '''SELECT a.associated_concept_id, a.concept_count
+        FROM cohd.concept_pair_adjacency a
+        WHERE a.dataset_id = %(dataset_id)s AND a.concept_id = %(concept_id_1)s
+        ORDER BY a.concept_count DESC, a.associated_concept_id ASC;'''),
+]
+
+
+def _sample_pairs(cur, dataset_id, samples, seed):
+    """ Samples pairs from the dataset, each in a random orientation
+
+    Each pair is the first pair at or after a random concept_id_1, so concepts are sampled with roughly uniform weight.
+
+    :return: list of (concept_id_1, concept_id_2)
+    """
+    cur.execute('''SELECT MIN(concept_id_1) AS first, MAX(concept_id_1) AS last
+        FROM cohd.concept_pair_counts
+        WHERE dataset_id = %s;''', [dataset_id])
+    row = cur.fetchone()
+    if row[u'first'] is None:
+        return []
+
+    random = np.random.RandomState(seed)
+    pairs = []
+    for threshold in random.randint(row[u'first'], row[u'last'] + 1, samples).tolist():
+        cur.execute('''SELECT concept_id_1, concept_id_2
+            FROM cohd.concept_pair_counts
+            WHERE dataset_id = %s AND concept_id_1 >= %s
+            ORDER BY concept_id_1, concept_id_2
+            LIMIT 1;''', [dataset_id, threshold])
+        r = cur.fetchone()
+        pair = (r[u'concept_id_1'], r[u'concept_id_2'])
+        pairs.append(pair if random.rand() < 0.5 else pair[::-1])
+    return pairs
+
+
+def _params(dataset_id, pair):
+    return {
+        'dataset_id': dataset_id,
+        'concept_id_1': pair[0],
+        'concept_id_2': pair[1],
+        'pair_id_1': min(pair),
+        'pair_id_2': max(pair)
+    }
+
+
+def _explain(cur, sql, params):
+    """ Prints the plan of the query """
+    cur.execute('EXPLAIN ' + sql, params)
+    for row in cur.fetchall():
+        print u"    %-8s %-22s %-8s %-24s rows=%-8s %s" % (row[u'id'], row[u'table'], row[u'type'], row[u'key'],
+                                                          row[u'rows'], row[u'Extra'] or u'')
+
+
+def _time(cur, sql, param_list):
+    """ Runs the query for each set of parameters
+
+    :return: (median ms, 95th percentile ms, total rows)
+    """
+    times = []
+    n_rows = 0
+    for params in param_list:
+        start = time.time()
+        cur.execute(sql, params)
+        n_rows += len(cur.fetchall())
+        times.append((time.time() - start) * 1000)
+    return np.median(times), np.percentile(times, 95), n_rows
+
+
+def run(config_file, dataset_id, samples, seed):
+    conn = pymysql.connect(read_default_file=config_file, charset=u'utf8mb4',
+                           cursorclass=pymysql.cursors.DictCursor)
+    cur = conn.cursor()
+    pairs = _sample_pairs(cur, dataset_id, samples, seed)
+    if not pairs:
+        print u"No pairs in dataset %d" % dataset_id
+        return
+    param_list = [_params(dataset_id, pair) for pair in pairs]
+
+    for name, original, canonical in _QUERIES:
+        print u"%s" % name
+        for label, sql in ((u'original', original), (u'canonical', canonical)):
+            print u"  %s plan:" % label
+            _explain(cur, sql, param_list[0])
+        results = []
+        for label, sql in ((u'original', original), (u'canonical', canonical)):
+            median, p95, n_rows = _time(cur, sql, param_list)
+            results.append(n_rows)
+            print u"  %-9s median %.3f ms, p95 %.3f ms, %d rows" % (label, median, p95, n_rows)
+        if results[0] != results[1]:
+            print u"  WARNING: the original and canonical queries returned different numbers of rows"
+
+    cur.close()
+    conn.close()
+
+
+if __name__ == u"__main__":
+    parser = argparse.ArgumentParser(description=u'Compare the concept pair queries before and after canonical pair '
+                                                 u'ordering')
+    parser.add_argument(u'--config', default=u'cohd_mysql.cnf', help=u'MySQL option file')
+    parser.add_argument(u'--dataset_id', type=int, default=1, help=u'Dataset to sample pairs from')
+    parser.add_argument(u'--samples', type=int, default=200, help=u'Number of sampled pairs')
+    parser.add_argument(u'--seed', type=int, default=0, help=u'Random seed')
+    arguments = parser.parse_args()
+
+    run(arguments.config, arguments.dataset_id, arguments.samples, arguments.seed)
@@ -0,0 +1,213 @@
+u"""
+Builds the cohd.concept_pair_stats table of precomputed association statistics
+
+Computes the chi-square, p-value, expected count, ln ratio and relative frequency of every pair in
+cohd.concept_pair_counts, splitting the pairs into chunks of concept_id_1 ranges that are processed by a pool of worker
+processes. The statistics are loaded into a copy of the table without secondary indexes, the indexes are added after
+loading, and the copy is then swapped in with an atomic RENAME TABLE.
+
+Run from the cohd directory (the location of cohd_mysql.cnf):
+    python build_association_stats.py --dataset_id 1 --processes 8
+"""
+
+import argparse
+import multiprocessing
+import time
+import numpy as np
+import pymysql
+from association_stats import chi_square, expected_count, ln_ratio, relative_frequency
+
+_TABLE = u'concept_pair_stats'
+_BUILD_TABLE = u'concept_pair_stats_build'
+_OLD_TABLE = u'concept_pair_stats_old'
+_INSERT_BATCH_SIZE = 5000
+
+# Per-process database connection for the worker processes
+_worker_conn = None
+
+
+def _connect(config_file):
+    return pymysql.connect(read_default_file=config_file, charset=u'utf8mb4', autocommit=False)
+
+
+def _init_worker(config_file):
+    global _worker_conn
+    _worker_conn = _connect(config_file)
+
+
+def _chunks(cur, dataset_id, chunk_size):
+    """ Splits the pairs of a dataset into ranges of concept_id_1 with roughly chunk_size pairs each
+
+    :return: list of (first concept_id_1, last concept_id_1)
+    """
+    cur.execute('''SELECT concept_id_1, COUNT(*)
+        FROM cohd.concept_pair_counts
+        WHERE dataset_id = %s
+        GROUP BY concept_id_1
+        ORDER BY concept_id_1;''', [dataset_id])
+
+    chunks = []
+    first = None
+    n = 0
+    for concept_id_1, count in cur.fetchall():
+        if first is None:
+            first = concept_id_1
+        n += count
+        last = concept_id_1
+        if n >= chunk_size:
+            chunks.append((first, last))
+            first = None
+            n = 0
+    if first is not None:
+        chunks.append((first, last))
+    return chunks
+
+
+def _build_chunk(task):
+    """ Computes and inserts the statistics for one chunk of pairs (runs in a worker process)
+
+    :param task: (dataset_id, patient_count, first concept_id_1, last concept_id_1)
+    :return: Number of rows inserted
+    """
+    dataset_id, patient_count, first, last = task
+    cur = _worker_conn.cursor()
+    # A concept missing from concept_counts (-1) leaves the statistics that need its count undefined (NULL)
+    cur.execute('''SELECT cp.concept_id_1, cp.concept_id_2, cp.concept_count,
+            IFNULL(c1.concept_count, -1), IFNULL(c2.concept_count, -1)
+        FROM cohd.concept_pair_counts cp
+        LEFT JOIN cohd.concept_counts c1 ON cp.dataset_id = c1.dataset_id AND cp.concept_id_1 = c1.concept_id
+        LEFT JOIN cohd.concept_counts c2 ON cp.dataset_id = c2.dataset_id AND cp.concept_id_2 = c2.concept_id
+        WHERE cp.dataset_id = %s AND cp.concept_id_1 BETWEEN %s AND %s
+            AND (c1.concept_id IS NOT NULL OR c2.concept_id IS NOT NULL);''', [dataset_id, first, last])
+    rows = cur.fetchall()
+    if len(rows) == 0:
+        cur.close()
+        return 0
+
+    id_1, id_2, cpc, c1, c2 = [np.array(column, dtype=np.int64) for column in zip(*rows)]
+    both_counted = (c1 >= 0) & (c2 >= 0)
+    # Computed for each orientation so the values match the request-time computation exactly
+    chi_squares, p_values = chi_square(cpc, c1, c2, patient_count)
+    chi_squares_reverse, p_values_reverse = chi_square(cpc, c2, c1, patient_count)
+    expected_counts = expected_count(c1, c2, patient_count)
+    with np.errstate(invalid=u'ignore'):
+        ln_ratios = ln_ratio(cpc, c1, c2, patient_count)
+
+    # Store both orientations of each pair
+    both_counted = np.concatenate([both_counted, both_counted])
+    count_1 = np.concatenate([c1, c2])
+    count_2 = np.concatenate([c2, c1])
+    columns = [
+        (np.concatenate([id_1, id_2]), None),
+        (np.concatenate([id_2, id_1]), None),
+        (np.concatenate([cpc, cpc]), None),
+        (count_1, count_1 >= 0),
+        (count_2, count_2 >= 0),
+        (np.concatenate([chi_squares, chi_squares_reverse]), both_counted),
+        (np.concatenate([p_values, p_values_reverse]), both_counted),
+        (np.concatenate([expected_counts, expected_counts]), both_counted),
+        (np.concatenate([ln_ratios, ln_ratios]), both_counted),
+        (np.concatenate([relative_frequency(cpc, c2), relative_frequency(cpc, c1)]), count_2 >= 0)
+    ]
+    # Store undefined values as NULL. chi-square is also undefined (NaN) when a concept is present in all patients.
+    columns = [column.tolist() if defined is None else
+               [x if d and x == x else None for x, d in zip(column.tolist(), defined.tolist())]
+               for column, defined in columns]
+    values = [[dataset_id] + list(row) for row in zip(*columns)]
+
+    sql = '''INSERT INTO cohd.{table} (dataset_id, concept_id_1, concept_id_2, concept_pair_count, concept_count_1,
+            concept_count_2, chi_square, p_value, expected_count, ln_ratio, relative_frequency)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);'''.format(table=_BUILD_TABLE)
+    for start in range(0, len(values), _INSERT_BATCH_SIZE):
+        cur.executemany(sql, values[start:start + _INSERT_BATCH_SIZE])
+    _worker_conn.commit()
+    cur.close()
+    return len(values)
+
+
+def build(config_file, dataset_ids=None, processes=None, chunk_size=200000):
+    """ Builds the concept_pair_stats table
+
+    :param config_file: MySQL option file
+    :param dataset_ids: List of dataset_ids to (re)build, or None for all datasets. Rows of other datasets are kept.
+    :param processes: Number of worker processes (default: number of CPUs)
+    :param chunk_size: Approximate number of pairs per chunk
+    """
+    conn = _connect(config_file)
+    cur = conn.cursor()
+
+    cur.execute('''SELECT dataset_id, count FROM cohd.patient_count ORDER BY dataset_id;''')
+    patient_counts = dict(cur.fetchall())
+    if dataset_ids is None:
+        dataset_ids = sorted(patient_counts)
+
+    # Create an empty copy of the table without secondary indexes, and keep the rows of datasets not being rebuilt
+    cur.execute('''CREATE TABLE IF NOT EXISTS cohd.{table} (
+          dataset_id TINYINT NOT NULL,
+          concept_id_1 INT(11) NOT NULL,
+          concept_id_2 INT(11) NOT NULL,
+          concept_pair_count INT UNSIGNED NOT NULL,
+          concept_count_1 INT UNSIGNED NULL,
+          concept_count_2 INT UNSIGNED NULL,
+          chi_square DOUBLE NULL,
+          p_value DOUBLE NULL,
+          expected_count DOUBLE NULL,
+          ln_ratio DOUBLE NULL,
+          relative_frequency DOUBLE NULL,
+          PRIMARY KEY (dataset_id, concept_id_1, concept_id_2));'''.format(table=_TABLE))
+    cur.execute('''DROP TABLE IF EXISTS cohd.{build};'''.format(build=_BUILD_TABLE))
+    cur.execute('''CREATE TABLE cohd.{build} LIKE cohd.{table};'''.format(build=_BUILD_TABLE, table=_TABLE))
+    cur.execute('''SHOW INDEX FROM cohd.{build} WHERE Key_name != 'PRIMARY';'''.format(build=_BUILD_TABLE))
+    for index_name in set(row[2] for row in cur.fetchall()):
+        cur.execute('''ALTER TABLE cohd.{build} DROP INDEX {index};'''.format(build=_BUILD_TABLE, index=index_name))
+    cur.execute('''INSERT INTO cohd.{build} SELECT * FROM cohd.{table} WHERE dataset_id NOT IN ({datasets});'''.format(
+        build=_BUILD_TABLE, table=_TABLE, datasets=','.join(['%s' for _ in dataset_ids])), dataset_ids)
+    conn.commit()
+
+    tasks = []
+    for dataset_id in dataset_ids:
+        for first, last in _chunks(cur, dataset_id, chunk_size):
+            tasks.append((dataset_id, patient_counts[dataset_id], first, last))
+    print u"Computing statistics for datasets %s in %d chunks" % (dataset_ids, len(tasks))
+
+    start = time.time()
+    n_rows = 0
+    pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(config_file,))
+    try:
+        for i, n in enumerate(pool.imap_unordered(_build_chunk, tasks)):
+            n_rows += n
+            elapsed = time.time() - start
+            print u"%d/%d chunks, %d rows, %.0f rows/s" % (i + 1, len(tasks), n_rows, n_rows / max(elapsed, 1e-9))
+    finally:
+        pool.close()
+        pool.join()
+
+    print u"Adding indexes"
+    cur.execute('''ALTER TABLE cohd.{build}
+        ADD INDEX chi_square_idx (dataset_id, concept_id_1, chi_square DESC),
+        ADD INDEX ln_ratio_idx (dataset_id, concept_id_1, ln_ratio DESC),
+        ADD INDEX relative_frequency_idx (dataset_id, concept_id_1, relative_frequency DESC);'''.format(
+        build=_BUILD_TABLE))
+
+    # Swap the new table in atomically
+    cur.execute('''DROP TABLE IF EXISTS cohd.{old};'''.format(old=_OLD_TABLE))
+    cur.execute('''RENAME TABLE cohd.{table} TO cohd.{old}, cohd.{build} TO cohd.{table};'''.format(
+        table=_TABLE, old=_OLD_TABLE, build=_BUILD_TABLE))
+    cur.execute('''DROP TABLE cohd.{old};'''.format(old=_OLD_TABLE))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+    print u"Built %s with %d rows in %.1f s" % (_TABLE, n_rows, time.time() - start)
+
+
+if __name__ == u"__main__":
+    parser = argparse.ArgumentParser(description=u'Build the cohd.concept_pair_stats table')
+    parser.add_argument(u'--config', default=u'cohd_mysql.cnf', help=u'MySQL option file')
+    parser.add_argument(u'--dataset_id', type=int, action=u'append',
+                        help=u'Dataset to build (may be repeated). Default: all datasets')
+    parser.add_argument(u'--processes', type=int, default=None, help=u'Number of worker processes')
+    parser.add_argument(u'--chunk_size', type=int, default=200000, help=u'Approximate number of pairs per chunk')
+    arguments = parser.parse_args()
+
+    build(arguments.config, arguments.dataset_id, arguments.processes, arguments.chunk_size)
@@ -0,0 +1,216 @@
+u"""
+Stores cohd.concept_pair_counts in canonical order and builds the cohd.concept_pair_adjacency table
+
+Pairs are rewritten with concept_id_1 < concept_id_2, so that a pair is found with one primary key lookup. The adjacency
+table stores every pair in both directions, so that all partners of a concept are found with one range scan. Both
+tables are loaded into copies without secondary indexes, the indexes are added after loading, and the copies are then
+swapped in with one atomic RENAME TABLE. Rows of datasets that are not rebuilt are kept. See
+db/sql/canonicalize_concept_pairs.sql for the schema.
+
+A pair stored in both orientations with the same count is kept once. If the two orientations have different counts, the
+build fails and reports the conflicting pairs without changing the tables, unless --keep_larger is given, which keeps
+the orientation with the larger count (and its frequency).
+
+Run from the cohd directory (the location of cohd_mysql.cnf):
+    python build_canonical_pairs.py --dataset_id 1
+"""
+
+import argparse
+import sys
+import time
+import pymysql
+
+_PAIR_TABLE = u'concept_pair_counts'
+_ADJACENCY_TABLE = u'concept_pair_adjacency'
+_BUILD_SUFFIX = u'_build'
+_OLD_SUFFIX = u'_old'
+
+# Number of conflicting pairs reported per dataset
+_MAX_REPORTED_CONFLICTS = 20
+
+
+class BuildError(Exception):
+    """ The pairs of a dataset cannot be stored in canonical order """
+    pass
+
+
+def _connect(config_file):
+    return pymysql.connect(read_default_file=config_file, charset=u'utf8mb4', autocommit=False)
+
+
+def _create_build_tables(cur):
+    """ Creates empty copies of both tables without secondary indexes """
+    cur.execute('''CREATE TABLE IF NOT EXISTS cohd.{table} (
+          dataset_id TINYINT NOT NULL,
+          concept_id INT(11) NOT NULL,
+          associated_concept_id INT(11) NOT NULL,
+          concept_count INT UNSIGNED NOT NULL,
+          PRIMARY KEY (dataset_id, concept_id, associated_concept_id));'''.format(table=_ADJACENCY_TABLE))
+
+    cur.execute('''DROP TABLE IF EXISTS cohd.{build};'''.format(build=_PAIR_TABLE + _BUILD_SUFFIX))
+    cur.execute('''CREATE TABLE cohd.{build} (
+          dataset_id TINYINT NOT NULL,
+          concept_id_1 INT(11) NOT NULL,
+          concept_id_2 INT(11) NOT NULL,
+          concept_count INT UNSIGNED NOT NULL,
+          concept_frequency DOUBLE NOT NULL,
+          PRIMARY KEY (dataset_id, concept_id_1, concept_id_2));'''.format(build=_PAIR_TABLE + _BUILD_SUFFIX))
+
+    cur.execute('''DROP TABLE IF EXISTS cohd.{build};'''.format(build=_ADJACENCY_TABLE + _BUILD_SUFFIX))
+    cur.execute('''CREATE TABLE cohd.{build} LIKE cohd.{table};'''.format(build=_ADJACENCY_TABLE + _BUILD_SUFFIX,
+                                                                          table=_ADJACENCY_TABLE))
+    cur.execute('''SHOW INDEX FROM cohd.{build} WHERE Key_name != 'PRIMARY';'''.format(
+        build=_ADJACENCY_TABLE + _BUILD_SUFFIX))
+    for index_name in set(row[2] for row in cur.fetchall()):
+        cur.execute('''ALTER TABLE cohd.{build} DROP INDEX {index};'''.format(build=_ADJACENCY_TABLE + _BUILD_SUFFIX,
+                                                                              index=index_name))
+
+
+def _conflicts(cur, dataset_id):
+    """ Pairs of a dataset that are stored in both orientations with different counts
+
+    :return: (number of conflicting pairs, list of the first (concept_id_1, concept_id_2, count, reversed count))
+    """
+    cur.execute('''SELECT a.concept_id_1, a.concept_id_2, a.concept_count, b.concept_count
+        FROM cohd.{table} a
+        JOIN cohd.{table} b ON b.dataset_id = a.dataset_id AND b.concept_id_1 = a.concept_id_2
+            AND b.concept_id_2 = a.concept_id_1
+        WHERE a.dataset_id = %s AND a.concept_id_1 < a.concept_id_2 AND a.concept_count <> b.concept_count
+        ORDER BY a.concept_id_1, a.concept_id_2;'''.format(table=_PAIR_TABLE), [dataset_id])
+    rows = cur.fetchall()
+    return len(rows), list(rows[:_MAX_REPORTED_CONFLICTS])
+
+
+def _build_dataset(cur, dataset_id):
+    """ Loads the canonical pairs and the adjacency of one dataset into the build tables
+
+    :return: (number of pairs, number of pairs that were stored in both orientations)
+    """
+    cur.execute('''SELECT COUNT(*) FROM cohd.{table} WHERE dataset_id = %s;'''.format(table=_PAIR_TABLE),
+                [dataset_id])
+    n_source = cur.fetchone()[0]
+
+    # A pair stored in both orientations is kept once, with the larger count and its frequency (the frequency is
+    # assigned first, since MySQL evaluates the assignments in order)
+    cur.execute('''INSERT INTO cohd.{build}
+            (dataset_id, concept_id_1, concept_id_2, concept_count, concept_frequency)
+        SELECT dataset_id, LEAST(concept_id_1, concept_id_2), GREATEST(concept_id_1, concept_id_2), concept_count,
+            concept_frequency
+        FROM cohd.{table}
+        WHERE dataset_id = %s
+        ON DUPLICATE KEY UPDATE
+            concept_frequency = IF(VALUES(concept_count) > concept_count, VALUES(concept_frequency), concept_frequency),
+            concept_count = GREATEST(concept_count, VALUES(concept_count));'''.format(
+        build=_PAIR_TABLE + _BUILD_SUFFIX, table=_PAIR_TABLE), [dataset_id])
+    cur.execute('''SELECT COUNT(*) FROM cohd.{build} WHERE dataset_id = %s;'''.format(
+        build=_PAIR_TABLE + _BUILD_SUFFIX), [dataset_id])
+    n_pairs = cur.fetchone()[0]
+
+    cur.execute('''INSERT INTO cohd.{adjacency} (dataset_id, concept_id, associated_concept_id, concept_count)
+        SELECT dataset_id, concept_id_1, concept_id_2, concept_count
+        FROM cohd.{pairs}
+        WHERE dataset_id = %s
+        UNION ALL
+        SELECT dataset_id, concept_id_2, concept_id_1, concept_count
+        FROM cohd.{pairs}
+        WHERE dataset_id = %s AND concept_id_1 <> concept_id_2;'''.format(
+        adjacency=_ADJACENCY_TABLE + _BUILD_SUFFIX, pairs=_PAIR_TABLE + _BUILD_SUFFIX), [dataset_id, dataset_id])
+
+    return n_pairs, n_source - n_pairs
+
+
+def build(config_file, dataset_ids=None, keep_larger=False):
+    """ Rebuilds concept_pair_counts in canonical order and concept_pair_adjacency
+
+    :param config_file: MySQL option file
+    :param dataset_ids: List of dataset_ids to (re)build, or None for all datasets. Rows of other datasets are kept.
+    :param keep_larger: True to keep the larger count of pairs stored in both orientations with different counts
+    :raises BuildError: if pairs are stored in both orientations with different counts and keep_larger is False. The
+                        tables are not changed.
+    """
+    conn = _connect(config_file)
+    cur = conn.cursor()
+
+    if dataset_ids is None:
+        cur.execute('''SELECT DISTINCT dataset_id FROM cohd.{table} ORDER BY dataset_id;'''.format(table=_PAIR_TABLE))
+        dataset_ids = [row[0] for row in cur.fetchall()]
+
+    errors = []
+    for dataset_id in dataset_ids:
+        n_conflicts, conflicts = _conflicts(cur, dataset_id)
+        if n_conflicts == 0:
+            continue
+        report = [u"Dataset %d: %d pairs stored in both orientations with different counts%s" %
+                  (dataset_id, n_conflicts, u', keeping the larger count' if keep_larger else u'')]
+        report.extend(u"  (%d, %d): %d, reversed %d" % tuple(row) for row in conflicts)
+        if n_conflicts > len(conflicts):
+            report.append(u"  ...")
+        if keep_larger:
+            print u'\n'.join(report)
+        else:
+            errors.extend(report)
+    if errors:
+        cur.close()
+        conn.close()
+        raise BuildError(u'\n'.join(errors + [u"Fix the counts, or use --keep_larger to keep the larger counts"]))
+
+    start = time.time()
+    _create_build_tables(cur)
+
+    # Keep the rows of datasets not being rebuilt
+    datasets = u','.join([u'%s' for _ in dataset_ids])
+    cur.execute('''INSERT INTO cohd.{build} (dataset_id, concept_id_1, concept_id_2, concept_count, concept_frequency)
+        SELECT dataset_id, concept_id_1, concept_id_2, concept_count, concept_frequency
+        FROM cohd.{table}
+        WHERE dataset_id NOT IN ({datasets});'''.format(build=_PAIR_TABLE + _BUILD_SUFFIX, table=_PAIR_TABLE,
+                                                       datasets=datasets), dataset_ids)
+    cur.execute('''INSERT INTO cohd.{build} SELECT * FROM cohd.{table} WHERE dataset_id NOT IN ({datasets});'''.format(
+        build=_ADJACENCY_TABLE + _BUILD_SUFFIX, table=_ADJACENCY_TABLE, datasets=datasets), dataset_ids)
+    conn.commit()
+
+    for dataset_id in dataset_ids:
+        n_pairs, n_duplicates = _build_dataset(cur, dataset_id)
+        conn.commit()
+        print u"Dataset %d: %d pairs, %d stored in both orientations, %.1f s" % \
+            (dataset_id, n_pairs, n_duplicates, time.time() - start)
+
+    print u"Adding indexes"
+    cur.execute('''ALTER TABLE cohd.{build} ADD INDEX concept_id_2_idx (dataset_id, concept_id_2 ASC);'''.format(
+        build=_PAIR_TABLE + _BUILD_SUFFIX))
+    cur.execute('''ALTER TABLE cohd.{build}
+        ADD INDEX concept_count_idx (dataset_id, concept_id, concept_count DESC);'''.format(
+        build=_ADJACENCY_TABLE + _BUILD_SUFFIX))
+
+    # Swap both new tables in atomically
+    for table in (_PAIR_TABLE, _ADJACENCY_TABLE):
+        cur.execute('''DROP TABLE IF EXISTS cohd.{old};'''.format(old=table + _OLD_SUFFIX))
+    cur.execute('''RENAME TABLE cohd.{pairs} TO cohd.{pairs_old}, cohd.{pairs_build} TO cohd.{pairs},
+        cohd.{adjacency} TO cohd.{adjacency_old}, cohd.{adjacency_build} TO cohd.{adjacency};'''.format(
+        pairs=_PAIR_TABLE, pairs_old=_PAIR_TABLE + _OLD_SUFFIX, pairs_build=_PAIR_TABLE + _BUILD_SUFFIX,
+        adjacency=_ADJACENCY_TABLE, adjacency_old=_ADJACENCY_TABLE + _OLD_SUFFIX,
+        adjacency_build=_ADJACENCY_TABLE + _BUILD_SUFFIX))
+    for table in (_PAIR_TABLE, _ADJACENCY_TABLE):
+        cur.execute('''DROP TABLE cohd.{old};'''.format(old=table + _OLD_SUFFIX))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+    print u"Built canonical %s and %s in %.1f s" % (_PAIR_TABLE, _ADJACENCY_TABLE, time.time() - start)
+
+
+if __name__ == u"__main__":
+    parser = argparse.ArgumentParser(description=u'Store cohd.concept_pair_counts in canonical order and build '
+                                                 u'cohd.concept_pair_adjacency')
+    parser.add_argument(u'--config', default=u'cohd_mysql.cnf', help=u'MySQL option file')
+    parser.add_argument(u'--dataset_id', type=int, action=u'append',
+                        help=u'Dataset to build (may be repeated). Default: all datasets')
+    parser.add_argument(u'--keep_larger', action=u'store_true',
+                        help=u'Keep the larger count of pairs stored in both orientations with different counts '
+                             u'instead of failing')
+    arguments = parser.parse_args()
+
+    try:
+        build(arguments.config, arguments.dataset_id, arguments.keep_larger)
+    except BuildError as e:
+        print >> sys.stderr, u"Canonical pairs not built:\n%s" % e
+        sys.exit(1)
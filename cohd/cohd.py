@@ -11,10 +11,18 @@ implemented in Flask
 (c) 2017 Tatonetti Lab
 """
 
-from flask import Flask, request, redirect, jsonify
+import hmac
+import json
+from functools import wraps
+from flask import Flask, request, redirect, jsonify, Response
+from werkzeug.datastructures import MultiDict
 from flask_cors import CORS
 import query_cohd_mysql
-import requests
+import omop_xref
+import request_metrics
+import response_formats
+from response_cache import ResponseCache
+from analytics_reporter import AnalyticsReporter
 
 #########
 # INITS #
@@ -24,6 +32,66 @@ app = Flask(__name__)
 CORS(app)
 app.config.from_pyfile(u'cohd_flask.conf')
 
+response_cache = None
+analytics_reporter = None
+
+
+def configure(config):
+    """ Configures the process from the Flask configuration
+
+    Called on import with the settings of cohd_flask.conf, and again by benchmark_endpoints.py after overriding
+    settings.
+
+    :param config: Flask configuration
+    """
+    global response_cache, analytics_reporter
+
+    # Pooled MySQL connections shared by all requests handled in this process
+    query_cohd_mysql.configure_pool(config)
+
+    # Optional backends for the associated concept and association endpoints
+    query_cohd_mysql.configure_features(config)
+
+    # Per-request timing, exposed on /metrics (only if REQUEST_METRICS is set)
+    request_metrics.configure(config)
+
+    # Cache of serialized responses, shared by all requests handled in this process (disabled if RESPONSE_CACHE_SIZE is
+    # 0)
+    if config.get(u'RESPONSE_CACHE_SIZE', 0) > 0:
+        response_cache = ResponseCache(max_entries=config[u'RESPONSE_CACHE_SIZE'],
+                                       max_bytes=config.get(u'RESPONSE_CACHE_MAX_BYTES', 100 * 1024 * 1024),
+                                       ttl=config.get(u'RESPONSE_CACHE_TTL'))
+    else:
+        response_cache = None
+
+    # Google Analytics hits are sent from a background thread (only if the tracking ID GA_TID is configured)
+    analytics_reporter = AnalyticsReporter(max_queue=config.get(u'GA_QUEUE_SIZE', 10000))
+
+
+configure(app.config)
+
+# Admin and metrics endpoints require the X-COHD-Admin-Token header to match ADMIN_TOKEN. Without ADMIN_TOKEN, they only
+# accept requests from the local host.
+ADMIN_TOKEN_HEADER = u'X-COHD-Admin-Token'
+_LOCAL_ADDRESSES = (u'127.0.0.1', u'::1')
+
+
+def admin_only(view):
+    """ Restricts a route to requests with the admin token, or to requests from the local host if no token is set """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = app.config.get(u'ADMIN_TOKEN')
+        if token:
+            provided = request.headers.get(ADMIN_TOKEN_HEADER, u'')
+            allowed = hmac.compare_digest(provided.encode(u'utf-8'), token.encode(u'utf-8'))
+        else:
+            allowed = request.remote_addr in _LOCAL_ADDRESSES
+        if not allowed:
+            return u'Forbidden', 403
+        return view(*args, **kwargs)
+    return wrapper
+
+
 ##########
 # ROUTES #
 ##########
@@ -116,6 +184,12 @@ def api_frequencies_associatedConceptDomainFreq():
     return api_call(u'frequencies', u'associatedConceptDomainFreq')
 
 
+@app.route(u'/api/frequencies/pairwiseConceptFreq')
+@app.route(u'/api/v1/frequencies/pairwiseConceptFreq')
+def api_frequencies_pairwiseConceptFreq():
+    return api_call(u'frequencies', u'pairwiseConceptFreq')
+
+
 @app.route(u'/api/frequencies/mostFrequentConcepts')
 @app.route(u'/api/v1/frequencies/mostFrequentConcepts')
 def api_frequencies_mostFrequentConcept():
@@ -137,6 +211,59 @@ def api_association_relativeFrequency():
     return api_call(u'association', u'relativeFrequency')
 
 
+@app.route(u'/api/admin/poolStats')
+@admin_only
+def api_admin_poolStats():
+    return jsonify(query_cohd_mysql.pool_stats())
+
+
+@app.route(u'/api/admin/conceptDictionaryStats')
+@admin_only
+def api_admin_conceptDictionaryStats():
+    return jsonify(query_cohd_mysql.concept_dictionary_stats())
+
+
+@app.route(u'/api/admin/cacheStats')
+@admin_only
+def api_admin_cacheStats():
+    return jsonify(response_cache.stats() if response_cache is not None else {})
+
+
+@app.route(u'/api/admin/analyticsStats')
+@admin_only
+def api_admin_analyticsStats():
+    return jsonify(analytics_reporter.stats())
+
+
+@app.route(u'/api/admin/oxoStatus')
+@admin_only
+def api_admin_oxoStatus():
+    return jsonify(omop_xref.oxo_status())
+
+
+# Request counts, durations, and phase timings in the Prometheus text format, summed over all worker processes if
+# METRICS_DIR is set
+@app.route(u'/metrics')
+@admin_only
+def api_metrics():
+    return Response(request_metrics.render(), mimetype=u'text/plain; version=0.0.4')
+
+
+# Invalidates the cached responses and in-memory data of a dataset after it is reloaded. Without dataset_id, all
+# datasets are invalidated. Only affects the process that handles the request.
+@app.route(u'/api/admin/invalidateDataset', methods=[u'POST'])
+@admin_only
+def api_admin_invalidateDataset():
+    dataset_id = request.args.get(u'dataset_id')
+    if dataset_id is not None and not dataset_id.strip().isdigit():
+        return u'dataset_id should be an integer', 400
+    dataset_id = int(dataset_id) if dataset_id is not None else None
+
+    query_cohd_mysql.reload_dataset(dataset_id)
+    invalidated = response_cache.invalidate(dataset_id) if response_cache is not None else 0
+    return jsonify({u'dataset_id': dataset_id, u'invalidated': invalidated})
+
+
 # Retrieves the desired arg_names from args and stores them in the queries dictionary. Returns None if any of arg_names
 # are missing
 def args_to_query(args, arg_names):
@@ -149,11 +276,39 @@ def args_to_query(args, arg_names):
     return query
 
 
+def cached_query_db(service, meta):
+    """ Runs the query, serving repeated requests from the response cache
+
+    :param service: string
+    :param meta: string
+    :return: Response, or (error message, status code)
+    """
+    if response_cache is None:
+        return query_cohd_mysql.query_db(service, meta, request.args)
+
+    key = ResponseCache.key(service, meta, request.args)
+    cached = response_cache.get(key)
+    if cached is not None:
+        body, mimetype = cached
+        return app.response_class(body, mimetype=mimetype)
+
+    result = query_cohd_mysql.query_db(service, meta, request.args)
+
+    # Only cache complete responses. Errors are returned as tuples, streamed responses are never buffered, and partial
+    # results are marked no-store. Only the body is cached, so responses with the metadata in a header are not cached.
+    if isinstance(result, app.response_class) and result.status_code == 200 and not result.is_streamed and \
+            not result.cache_control.no_store and response_formats.METADATA_HEADER not in result.headers:
+        response_cache.put(key, query_cohd_mysql.request_dataset_id(request.args), result.get_data(),
+                           result.mimetype)
+    return result
+
+
 def google_analytics(endpoint=None, service=None, meta=None):
     """ Reports the endpoint to Google Analytics
 
     Reports the endpoint as a pageview to Google Analytics. If endpoint is specified, then endpoint is reported.
-    Otherwise, if service and meta are specified, then /api/{service}/{meta} is reported.
+    Otherwise, if service and meta are specified, then /api/{service}/{meta} is reported. The pageview is only queued
+    here, and sent in the background by analytics_reporter.
 
     Uses Google Analytics Measurement Protocol for reporting:
     https://developers.google.com/analytics/devguides/collection/protocol/v1/devguide
@@ -180,46 +335,35 @@ def google_analytics(endpoint=None, service=None, meta=None):
 
         endpoint = u'/api/{service}/{meta}'.format(service=service, meta=meta)
 
-    try:
-        # Use a small timeout so that the Google Analytics request does not cause delays if there is an issue
-        endpoint_ga = u'http://www.google-analytics.com/collect'
-        payload = {
-            u'v': 1,
-            u'tid': app.config[u'GA_TID'],
-            u'cid': 555,
-            u't': u'pageview',
-            u'dh': u'cohd.nsides.io',
-            u'dp': endpoint,
-            u'uip': request.remote_addr,
-            u'ua': request.user_agent
-        }
-        requests.post(endpoint_ga, data=payload, timeout=0.1)
-    except requests.exceptions.Timeout:
-        # Log the timeout
-        print 'Google Analytics timeout: ' + endpoint
-
-
-@app.route(u'/api/query')
-@app.route(u'/api/v1/query')
-def api_call(service=None, meta=None, query=None):
-    if service is None:
-        service = request.args.get(u'service')
-    if meta is None:
-        meta = request.args.get(u'meta')
-
-    print u"Service: ", service
-    print u"Meta/Method: ", meta
-
+    payload = {
+        u'v': 1,
+        u'tid': app.config[u'GA_TID'],
+        u'cid': 555,
+        u't': u'pageview',
+        u'dh': u'cohd.nsides.io',
+        u'dp': endpoint,
+        u'uip': request.remote_addr,
+        u'ua': request.user_agent
+    }
+    analytics_reporter.report(payload)
+
+
+def endpoint_error(service, meta):
+    """ Checks that the service and meta are recognized
+
+    :param service: string
+    :param meta: string
+    :return: None, or (error message, status code)
+    """
     if service == [u''] or service is None:
-        result = u'No service selected', 400
+        return u'No service selected', 400
     elif service == u'metadata':
         if meta == u'datasets' or \
                 meta == u'domainCounts' or \
                 meta == u'domainPairCounts' or \
                 meta == u'patientCount':
-            result = query_cohd_mysql.query_db(service, meta, request.args)
-        else:
-            result = u'meta not recognized', 400
+            return None
+        return u'meta not recognized', 400
     elif service == u'omop':
         if meta == u'findConceptIDs' or \
                 meta == u'concepts' or \
@@ -228,32 +372,92 @@ def api_call(service=None, meta=None, query=None):
                 meta == u'vocabularies' or \
                 meta == u'xrefToOMOP' or \
                 meta == u'xrefFromOMOP':
-            result = query_cohd_mysql.query_db(service, meta, request.args)
-        else:
-            result = u'meta not recognized', 400
+            return None
+        return u'meta not recognized', 400
     elif service == u'frequencies':
         if meta == u'singleConceptFreq' or \
                 meta == u'pairedConceptFreq' or \
                 meta == u'associatedConceptFreq' or \
                 meta == u'mostFrequentConcepts' or \
-                meta == u'associatedConceptDomainFreq':
-            result = query_cohd_mysql.query_db(service, meta, request.args)
-        else:
-            result = u'meta not recognized', 400
+                meta == u'associatedConceptDomainFreq' or \
+                meta == u'pairwiseConceptFreq':
+            return None
+        return u'meta not recognized', 400
     elif service == u'association':
         if meta == u'chiSquare' or \
                 meta == u'obsExpRatio' or \
                 meta == u'relativeFrequency':
-            result = query_cohd_mysql.query_db(service, meta, request.args)
-        else:
-            result = u'meta not recognized', 400
-    else:
-        result = u'service not recognized', 400
+            return None
+        return u'meta not recognized', 400
+    return u'service not recognized', 400
 
-    # Report the API call to Google Analytics
-    google_analytics(service=service, meta=meta)
 
-    return result
+@app.route(u'/api/query')
+@app.route(u'/api/v1/query')
+def api_call(service=None, meta=None, query=None):
+    if service is None:
+        service = request.args.get(u'service')
+    if meta is None:
+        meta = request.args.get(u'meta')
+
+    print u"Service: ", service
+    print u"Meta/Method: ", meta
+
+    result = endpoint_error(service, meta)
+    # Unrecognized services and metas are counted together, so that requests cannot add arbitrary metric labels
+    timer = request_metrics.start(service, meta) if result is None else request_metrics.start(u'invalid', u'invalid')
+    if result is None:
+        result = cached_query_db(service, meta)
+
+    # Report the API call to Google Analytics
+    with request_metrics.phase(u'analytics'):
+        google_analytics(service=service, meta=meta)
+
+    return request_metrics.finish(timer, result)
+
+
+# Runs many queries in one request. The body is a JSON array of {"service": ..., "meta": ..., "args": {...}} objects,
+# where args holds the query parameters, e.g.,
+# [{"service": "frequencies", "meta": "pairedConceptFreq", "args": {"dataset_id": 1, "q": "4196636,437643"}}]
+# The response is an array of {"status": ..., "result": ...} or {"status": ..., "error": ...} objects in the same order.
+@app.route(u'/api/batch', methods=[u'POST'])
+@app.route(u'/api/v1/batch', methods=[u'POST'])
+def api_batch():
+    timer = request_metrics.start(u'batch', u'batch')
+    items = request.get_json(force=True, silent=True)
+    if not isinstance(items, list):
+        return request_metrics.finish(timer, (u'Request body should be a JSON array of queries', 400))
+    max_items = app.config.get(u'BATCH_MAX_ITEMS', 1000)
+    if len(items) > max_items:
+        return request_metrics.finish(timer, (u'Too many queries: at most %d may be included in a batch' % max_items,
+                                              400))
+
+    results = [None] * len(items)
+    queries = []
+    for i, item in enumerate(items):
+        if not isinstance(item, dict) or not isinstance(item.get(u'args', {}), dict):
+            results[i] = u'Each query should be an object with service, meta, and args', 400
+            continue
+        service = item.get(u'service')
+        meta = item.get(u'meta')
+        results[i] = endpoint_error(service, meta)
+        if results[i] is None:
+            # Query parameters are strings, as in GET requests
+            args = MultiDict([(name, value if isinstance(value, basestring) else json.dumps(value))
+                              for name, value in item.get(u'args', {}).items()])
+            queries.append((i, (service, meta, args)))
+
+    for (i, _), result in zip(queries, query_cohd_mysql.query_batch([query for _, query in queries])):
+        results[i] = result
+
+    # Report the batch once to Google Analytics
+    with request_metrics.phase(u'analytics'):
+        google_analytics(endpoint=u'/api/v1/batch')
+
+    with request_metrics.phase(u'serialize'):
+        response = jsonify([{u'status': status, u'result': body} if status == 200 else
+                            {u'status': status, u'error': body} for body, status in results])
+    return request_metrics.finish(timer, response)
 
 
 if __name__ == u"__main__":
@@ -0,0 +1,283 @@
+u"""
+In-memory concept dictionary
+
+Holds cohd.concept in a few flat arrays instead of millions of Python objects: the concept_ids as a sorted int32 array,
+the domain, vocabulary, concept class, and standard_concept columns as small integer codes into tables of the distinct
+values, and the concept names and codes as UTF-8 buffers with offsets. Concepts are found by binary search of the
+concept_ids. The dictionary answers the concepts lookups, and attaches the names and domains of the associated concepts
+to query results, so that the association queries do not need to join cohd.concept. Since the arrays are not written
+after loading, the pages of a dictionary loaded before uWSGI forks the workers stay shared between the workers.
+"""
+
+import threading
+import numpy as np
+import pymysql
+
+# Number of rows fetched per round trip when loading the concepts
+_FETCH_SIZE = 100000
+
+_dictionary = None
+_lock = threading.Lock()
+
+
+class _Codes(object):
+    """ Interns the values of a column as integer codes """
+
+    def __init__(self):
+        self.values = []
+        self._lookup = {}
+
+    def code(self, value):
+        code = self._lookup.get(value)
+        if code is None:
+            code = self._lookup[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class _Strings(object):
+    """ Concatenates strings into one UTF-8 buffer with offsets """
+
+    def __init__(self):
+        self._chunks = []
+        self._lengths = []
+
+    def extend(self, strings):
+        encoded = [s.encode(u'utf-8') for s in strings]
+        self._chunks.append(b''.join(encoded))
+        self._lengths.append(np.array([len(s) for s in encoded], dtype=np.int64))
+
+    def build(self):
+        """ :return: (buffer, offsets), where string i is buffer[offsets[i]:offsets[i + 1]] """
+        lengths = np.concatenate(self._lengths) if self._lengths else np.zeros(0, dtype=np.int64)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return b''.join(self._chunks), offsets
+
+
+class ConceptDictionary(object):
+    """ The concepts of cohd.concept, addressed by their index in the sorted concept_ids array """
+
+    def __init__(self, concept_ids, names, name_offsets, codes, code_offsets, domain_codes, domains,
+                 vocabulary_codes, vocabularies, class_codes, concept_classes, standard_codes, standard_values):
+        """
+        :param concept_ids: sorted int32 array of concept_ids
+        :param names: UTF-8 buffer of the concept names
+        :param name_offsets: int64 array of the offsets of the names in the buffer (one more than the concepts)
+        :param codes: UTF-8 buffer of the concept codes
+        :param code_offsets: int64 array of the offsets of the concept codes in the buffer
+        :param domain_codes: int array of indices into domains
+        :param domains: list of domain_ids
+        :param vocabulary_codes: int array of indices into vocabularies
+        :param vocabularies: list of vocabulary_ids
+        :param class_codes: int array of indices into concept_classes
+        :param concept_classes: list of concept_class_ids
+        :param standard_codes: int array of indices into standard_values
+        :param standard_values: list of standard_concept values (including None)
+        """
+        self.concept_ids = concept_ids
+        self._names = names
+        self._name_offsets = name_offsets
+        self._codes = codes
+        self._code_offsets = code_offsets
+        self.domain_codes = domain_codes
+        self.domains = domains
+        self.vocabulary_codes = vocabulary_codes
+        self.vocabularies = vocabularies
+        self.class_codes = class_codes
+        self.concept_classes = concept_classes
+        self.standard_codes = standard_codes
+        self.standard_values = standard_values
+
+    def __len__(self):
+        return len(self.concept_ids)
+
+    def _indices(self, concept_ids):
+        """ Binary search of the concept_ids
+
+        :param concept_ids: list of concept_ids
+        :return: int array of indices, with -1 for concept_ids that are not in the dictionary
+        """
+        ids = np.asarray(concept_ids, dtype=np.int64)
+        if len(self.concept_ids) == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+        # Search with the dtype of concept_ids, since numpy would otherwise convert the whole array on every search.
+        # concept_ids out of its range are clipped, and then do not match.
+        limits = np.iinfo(self.concept_ids.dtype)
+        i = np.searchsorted(self.concept_ids, np.clip(ids, limits.min, limits.max).astype(self.concept_ids.dtype))
+        i[i >= len(self.concept_ids)] = 0
+        return np.where(self.concept_ids[i] == ids, i, -1)
+
+    def _name(self, i):
+        return self._names[self._name_offsets[i]:self._name_offsets[i + 1]].decode(u'utf-8')
+
+    def _code(self, i):
+        return self._codes[self._code_offsets[i]:self._code_offsets[i + 1]].decode(u'utf-8')
+
+    def _row(self, i):
+        return {
+            u'concept_id': int(self.concept_ids[i]),
+            u'concept_name': self._name(i),
+            u'domain_id': self.domains[self.domain_codes[i]],
+            u'vocabulary_id': self.vocabularies[self.vocabulary_codes[i]],
+            u'concept_class_id': self.concept_classes[self.class_codes[i]],
+            u'concept_code': self._code(i)
+        }
+
+    def lookup(self, concept_id):
+        """ Same row as SELECT * FROM cohd.concept WHERE concept_id = concept_id
+
+        :param concept_id: int
+        :return: dict, or None if the concept does not exist
+        """
+        i = int(self._indices([concept_id])[0])
+        if i < 0:
+            return None
+        row = self._row(i)
+        row[u'standard_concept'] = self.standard_values[self.standard_codes[i]]
+        return row
+
+    def concepts(self, concept_ids):
+        """ Same results as the concepts SQL query
+
+        :param concept_ids: list of concept_ids
+        :return: list of dicts, ordered by concept_id
+        """
+        indices = self._indices(sorted(set(concept_ids)))
+        return [self._row(i) for i in indices[indices >= 0].tolist()]
+
+    def attach(self, rows, id_key, name_key, domain_key):
+        """ Sets the name and domain of the concept of each row, as a join on cohd.concept would
+
+        :param rows: list of dicts
+        :param id_key: key of the concept_id in the rows
+        :param name_key: key to store the concept name under
+        :param domain_key: key to store the domain_id under
+        :return: list of the rows whose concept is in the dictionary, in the same order
+        """
+        if not rows:
+            return rows
+        results = []
+        for row, i in zip(rows, self._indices([row[id_key] for row in rows]).tolist()):
+            if i >= 0:
+                row[name_key] = self._name(i)
+                row[domain_key] = self.domains[self.domain_codes[i]]
+                results.append(row)
+        return results
+
+    def attach_tuples(self, rows, id_index, name_index, domain_index):
+        """ Same as attach, for rows read with a tuple cursor
+
+        :param rows: list of tuples
+        :param id_index: position of the concept_id in the rows
+        :param name_index: position to store the concept name at
+        :param domain_index: position to store the domain_id at
+        :return: list of the rows (as lists) whose concept is in the dictionary, in the same order
+        """
+        if not rows:
+            return rows
+        results = []
+        for row, i in zip(rows, self._indices([row[id_index] for row in rows]).tolist()):
+            if i >= 0:
+                row = list(row)
+                row[name_index] = self._name(i)
+                row[domain_index] = self.domains[self.domain_codes[i]]
+                results.append(row)
+        return results
+
+    def stats(self):
+        """ Number of concepts and the memory used by the dictionary
+
+        :return: dict
+        """
+        arrays = [self.concept_ids, self._name_offsets, self._code_offsets, self.domain_codes, self.vocabulary_codes,
+                  self.class_codes, self.standard_codes]
+        stats = {
+            u'concepts': len(self.concept_ids),
+            u'array_bytes': sum(a.nbytes for a in arrays),
+            u'string_bytes': len(self._names) + len(self._codes),
+            u'table_bytes': sum(len(v.encode(u'utf-8')) for v in self.domains + self.vocabularies +
+                                self.concept_classes)
+        }
+        stats[u'total_bytes'] = stats[u'array_bytes'] + stats[u'string_bytes'] + stats[u'table_bytes']
+        return stats
+
+
+def load_dictionary(conn):
+    """ Loads the concept dictionary from cohd.concept
+
+    :param conn: pymysql connection
+    :return: ConceptDictionary
+    """
+    print u"Loading concept dictionary"
+
+    concept_ids = []
+    names = _Strings()
+    codes = _Strings()
+    columns = [_Codes() for _ in range(4)]
+    column_codes = [[] for _ in range(4)]
+    cur = conn.cursor(pymysql.cursors.SSCursor)
+    try:
+        cur.execute('''SELECT concept_id, concept_name, domain_id, vocabulary_id, concept_class_id, standard_concept,
+                concept_code
+            FROM cohd.concept
+            ORDER BY concept_id;''')
+        while True:
+            rows = cur.fetchmany(_FETCH_SIZE)
+            if not rows:
+                break
+            concept_ids.append(np.array([row[0] for row in rows], dtype=np.int32))
+            names.extend([row[1] for row in rows])
+            codes.extend([row[6] for row in rows])
+            for k, (interned, codes_k) in enumerate(zip(columns, column_codes)):
+                codes_k.append(np.array([interned.code(row[k + 2]) for row in rows], dtype=np.int16))
+    finally:
+        cur.close()
+
+    def concatenate(arrays, dtype):
+        return np.concatenate(arrays).astype(dtype) if arrays else np.zeros(0, dtype=dtype)
+
+    # The codes are stored in the smallest integer type that holds them
+    code_arrays = [concatenate(codes_k, np.int8 if len(interned.values) <= 127 else np.int16)
+                   for interned, codes_k in zip(columns, column_codes)]
+    name_buffer, name_offsets = names.build()
+    code_buffer, code_offsets = codes.build()
+    dictionary = ConceptDictionary(concatenate(concept_ids, np.int32), name_buffer, name_offsets, code_buffer,
+                                   code_offsets, code_arrays[0], columns[0].values, code_arrays[1], columns[1].values,
+                                   code_arrays[2], columns[2].values, code_arrays[3], columns[3].values)
+
+    print u"Loaded %d concepts into the concept dictionary (%.1f MB)" % \
+        (len(dictionary), dictionary.stats()[u'total_bytes'] / 1048576.0)
+    return dictionary
+
+
+def get_dictionary(conn):
+    """ Gets the concept dictionary, loading it on first use
+
+    :param conn: pymysql connection used if the dictionary needs to be loaded
+    :return: ConceptDictionary
+    """
+    global _dictionary
+    if _dictionary is not None:
+        return _dictionary
+
+    with _lock:
+        # Another thread may have loaded the dictionary while we were waiting
+        if _dictionary is None:
+            _dictionary = load_dictionary(conn)
+        return _dictionary
+
+
+def loaded():
+    """ The concept dictionary if it has been loaded, without loading it
+
+    :return: ConceptDictionary, or None
+    """
+    return _dictionary
+
+
+def clear():
+    """ Drops the concept dictionary so that it is reloaded on next use """
+    global _dictionary
+    with _lock:
+        _dictionary = None
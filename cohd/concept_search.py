@@ -0,0 +1,291 @@
+u"""
+In-memory concept name search
+
+Indexes the names of the standard concepts counted in a dataset so that findConceptIDs does not need a full scan of
+cohd.concept for every LIKE '%query%'. Concepts are numbered by their rank in the dataset (concept_count descending,
+then concept_id), and every bigram and trigram of the lowercased names maps to a sorted posting list of ranks.
+Intersecting the posting lists of the query's trigrams (or its bigram, for two-character queries) therefore yields the
+candidates already in result order, and verifying the substring match can stop as soon as enough results are found.
+Results are formatted like the findConceptIDs SQL query.
+
+Fuzzy searches rank concepts by the edit distance between the query and the best matching substring of the name. The
+postings serve as pigeonhole and q-gram filters for the candidates, whose distances are then computed together with
+numpy.
+"""
+
+import threading
+import numpy as np
+import pymysql
+
+# Maximum number of results, as in the findConceptIDs SQL query
+DEFAULT_LIMIT = 1000
+# Characters with a special meaning in LIKE patterns. Queries containing them are left to SQL.
+_LIKE_SPECIAL_CHARACTERS = u'%_\\'
+# Default and largest max_distance of fuzzy searches. The q-gram filter loses its selectivity for larger distances.
+DEFAULT_FUZZY_DISTANCE = 2
+MAX_FUZZY_DISTANCE = 3
+# Number of candidates whose edit distances are computed together
+_FUZZY_BATCH_SIZE = 4096
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def _ngrams(text, n):
+    return set(text[k:k + n] for k in range(len(text) - n + 1))
+
+
+def indexable(query):
+    """ Whether the index has the same semantics as concept_name LIKE '%query%' for this query
+
+    :param query: string
+    :return: boolean
+    """
+    return not any(c in query for c in _LIKE_SPECIAL_CHARACTERS)
+
+
+class ConceptSearchIndex(object):
+    """ Bigram and trigram index of the standard concepts counted in one dataset """
+
+    def __init__(self, dataset_id, concept_ids, concept_names, domain_ids, vocabulary_ids, concept_class_ids,
+                 concept_codes, concept_counts):
+        """
+        :param dataset_id: int
+        :param concept_ids: int array of concept_ids, ordered by concept_count descending, then concept_id
+        :param concept_names: list of concept names
+        :param domain_ids: list of domain_ids
+        :param vocabulary_ids: list of vocabulary_ids
+        :param concept_class_ids: list of concept_class_ids
+        :param concept_codes: list of concept codes
+        :param concept_counts: int array of concept counts (descending)
+        """
+        self.dataset_id = dataset_id
+        self.concept_ids = concept_ids
+        self.concept_names = concept_names
+        self.domain_ids = domain_ids
+        self.vocabulary_ids = vocabulary_ids
+        self.concept_class_ids = concept_class_ids
+        self.concept_codes = concept_codes
+        self.concept_counts = concept_counts
+
+        # MySQL compares concept_name and domain_id case-insensitively
+        self._names = [name.lower() for name in concept_names]
+        self._domains = [domain_id.lower() for domain_id in domain_ids]
+
+        postings = {}
+        for rank, name in enumerate(self._names):
+            for ngram in _ngrams(name, 2) | _ngrams(name, 3):
+                postings.setdefault(ngram, []).append(rank)
+        self._postings = {ngram: np.array(ranks, dtype=np.int32) for ngram, ranks in postings.items()}
+
+        # Code points of all names, concatenated, for computing edit distances
+        self._lengths = np.array([len(name) for name in self._names], dtype=np.int64)
+        self._offsets = np.cumsum(self._lengths) - self._lengths
+        self._codes = np.array([ord(c) for name in self._names for c in name], dtype=np.int32)
+
+    def _prefix(self, min_count):
+        # Concepts are ordered by count, so the concepts passing min_count are a prefix
+        return int(np.searchsorted(-self.concept_counts, -min_count, side=u'right'))
+
+    def _candidates(self, query, n):
+        """ Ranks (in ascending order) of the concepts that may contain the query, among the top n concepts """
+        ngrams = _ngrams(query, 3) if len(query) >= 3 else _ngrams(query, 2)
+        if not ngrams:
+            # Single characters are too common for the index to help, so scan the concepts in rank order
+            return np.arange(n)
+
+        postings = [self._postings.get(ngram) for ngram in ngrams]
+        if any(p is None for p in postings):
+            return np.array([], dtype=np.int32)
+
+        # Intersect the shortest posting lists first
+        postings.sort(key=len)
+        candidates = postings[0][:np.searchsorted(postings[0], n)]
+        for p in postings[1:]:
+            if len(candidates) == 0:
+                break
+            candidates = np.intersect1d(candidates, p, assume_unique=True)
+        return candidates
+
+    def search(self, query, domain_id=None, min_count=1, limit=DEFAULT_LIMIT):
+        """ Same results as the findConceptIDs SQL query with a min_count of at least 1
+
+        :param query: string to search for in the concept names
+        :param domain_id: restrict the results to this domain (optional)
+        :param min_count: minimum concept_count (at least 1)
+        :param limit: maximum number of results
+        :return: list of results in descending order of concept_count
+        """
+        query = query.lower()
+        domain_id = domain_id.lower() if domain_id is not None else None
+
+        ranks = []
+        for rank in self._candidates(query, self._prefix(min_count)).tolist():
+            if query in self._names[rank] and (domain_id is None or self._domains[rank] == domain_id):
+                ranks.append(rank)
+                if len(ranks) >= limit:
+                    break
+
+        return self._results(ranks)
+
+    def _fuzzy_candidates(self, query, max_distance, n):
+        """ Ranks of the concepts that may contain the query within max_distance edits, among the top n concepts """
+        candidates = np.arange(n)
+
+        # Pigeonhole filter: split into max_distance + 1 pieces, one of which must appear unchanged in a match
+        bounds = np.linspace(0, len(query), max_distance + 2).astype(int)
+        if np.diff(bounds).min() >= 2:
+            candidates = np.unique(np.concatenate([self._candidates(query[bounds[k]:bounds[k + 1]], n)
+                                                   for k in range(max_distance + 1)]))
+
+        # q-gram filter: each edit removes at most two of the query's bigrams, so a match keeps all but
+        # 2 * max_distance of them
+        bigrams = _ngrams(query, 2)
+        threshold = len(bigrams) - 2 * max_distance
+        if threshold > 0 and len(candidates) > 0:
+            postings = [p[:np.searchsorted(p, n)] for p in (self._postings.get(bigram) for bigram in bigrams)
+                        if p is not None]
+            if len(postings) < threshold:
+                return np.array([], dtype=np.int64)
+            hits = np.bincount(np.concatenate(postings), minlength=n)
+            candidates = candidates[hits[candidates] >= threshold]
+
+        return candidates
+
+    def _substring_distances(self, query, ranks):
+        """ Edit distances between the query and the best matching substring of each name (Sellers' algorithm)
+
+        The dynamic programming columns of all names are computed together, one character position at a time.
+
+        :param query: lowercase string
+        :param ranks: int array of concept ranks
+        :return: int array of distances
+        """
+        q = [ord(c) for c in query]
+        m = len(q)
+        lengths = self._lengths[ranks]
+        width = int(lengths.max()) if len(ranks) > 0 else 0
+        positions = np.arange(width)
+        valid = positions[None, :] < lengths[:, None]
+        text = np.where(valid, self._codes[np.where(valid, self._offsets[ranks][:, None] + positions, 0)], -1)
+
+        # column[:, i] is the distance between the first i characters of the query and the best substring ending at
+        # the current position of the name
+        column = np.tile(np.arange(m + 1, dtype=np.int32), (len(ranks), 1))
+        distances = column[:, m].copy()
+        for j in range(width):
+            previous = column
+            column = np.empty_like(previous)
+            column[:, 0] = 0
+            for i in range(1, m + 1):
+                column[:, i] = np.minimum(np.minimum(previous[:, i - 1] + (text[:, j] != q[i - 1]),
+                                                     previous[:, i] + 1),
+                                          column[:, i - 1] + 1)
+            distances = np.where(valid[:, j], np.minimum(distances, column[:, m]), distances)
+        return distances
+
+    def fuzzy_search(self, query, max_distance=DEFAULT_FUZZY_DISTANCE, domain_id=None, min_count=1,
+                     limit=DEFAULT_LIMIT):
+        """ Typo-tolerant search for concepts whose names contain the query within max_distance edits
+
+        :param query: string to search for in the concept names
+        :param max_distance: maximum edit distance
+        :param domain_id: restrict the results to this domain (optional)
+        :param min_count: minimum concept_count (at least 1)
+        :param limit: maximum number of results
+        :return: list of results in ascending order of distance, then descending order of concept_count
+        """
+        query = query.lower()
+        domain_id = domain_id.lower() if domain_id is not None else None
+
+        ranks = self._fuzzy_candidates(query, max_distance, self._prefix(min_count))
+        if domain_id is not None:
+            ranks = ranks[np.array([self._domains[rank] == domain_id for rank in ranks.tolist()], dtype=bool)]
+
+        # Similar lengths are batched together to reduce padding
+        ranks = ranks[np.argsort(self._lengths[ranks], kind=u'mergesort')]
+        distances = np.concatenate([self._substring_distances(query, ranks[start:start + _FUZZY_BATCH_SIZE])
+                                    for start in range(0, len(ranks), _FUZZY_BATCH_SIZE)] or
+                                   [np.array([], dtype=np.int32)])
+
+        matched = distances <= max_distance
+        ranks = ranks[matched]
+        distances = distances[matched]
+        order = np.lexsort((ranks, distances))[:limit]
+        return self._results(ranks[order].tolist(), distances[order].tolist())
+
+    def _results(self, ranks, distances=None):
+        results = [{
+            u'concept_id': int(self.concept_ids[rank]),
+            u'concept_name': self.concept_names[rank],
+            u'domain_id': self.domain_ids[rank],
+            u'vocabulary_id': self.vocabulary_ids[rank],
+            u'concept_class_id': self.concept_class_ids[rank],
+            u'concept_code': self.concept_codes[rank],
+            u'concept_count': float(self.concept_counts[rank])
+        } for rank in ranks]
+        if distances is not None:
+            for result, distance in zip(results, distances):
+                result[u'distance'] = distance
+        return results
+
+
+def load_index(conn, dataset_id):
+    """ Builds the concept search index of a dataset from MySQL
+
+    :param conn: pymysql connection
+    :param dataset_id: int
+    :return: ConceptSearchIndex
+    """
+    print u"Building concept search index for dataset ", dataset_id
+
+    cur = conn.cursor(pymysql.cursors.SSCursor)
+    try:
+        cur.execute('''SELECT c.concept_id, c.concept_name, c.domain_id, c.vocabulary_id, c.concept_class_id,
+                c.concept_code, cc.concept_count
+            FROM cohd.concept_counts cc
+            JOIN cohd.concept c ON cc.concept_id = c.concept_id
+            WHERE cc.dataset_id = %s AND cc.concept_count >= 1 AND c.standard_concept = 'S'
+            ORDER BY cc.concept_count DESC, c.concept_id;''', [dataset_id])
+        rows = cur.fetchall()
+    finally:
+        cur.close()
+
+    columns = zip(*rows) if rows else [[]] * 7
+    index = ConceptSearchIndex(dataset_id,
+                               np.array(columns[0], dtype=np.int64),
+                               list(columns[1]), list(columns[2]), list(columns[3]), list(columns[4]),
+                               list(columns[5]),
+                               np.array(columns[6], dtype=np.int64))
+
+    print u"Indexed %d concepts with %d n-grams for dataset %d" % (len(rows), len(index._postings), dataset_id)
+    return index
+
+
+def get_index(conn, dataset_id):
+    """ Gets the concept search index of a dataset, building it on first use
+
+    :param conn: pymysql connection used if the index needs to be built
+    :param dataset_id: int
+    :return: ConceptSearchIndex
+    """
+    if dataset_id in _indexes:
+        return _indexes[dataset_id]
+
+    with _lock:
+        # Another thread may have built the index while we were waiting
+        if dataset_id not in _indexes:
+            _indexes[dataset_id] = load_index(conn, dataset_id)
+        return _indexes[dataset_id]
+
+
+def clear(dataset_id=None):
+    """ Drops the indexes of a dataset (or all datasets) so that they are rebuilt on next use
+
+    :param dataset_id: int, or None for all datasets
+    """
+    with _lock:
+        if dataset_id is None:
+            _indexes.clear()
+        else:
+            _indexes.pop(dataset_id, None)
@@ -0,0 +1,183 @@
+u"""
+Process-wide pool of reusable database connections
+
+Connections are checked out for the duration of a request and returned to the pool afterwards, so that the TCP, TLS
+and authentication handshake with the database server is only paid when a connection is first opened or recycled.
+"""
+
+import os
+import threading
+import time
+
+
+class PoolTimeout(Exception):
+    """ Raised when no connection becomes available within the pool timeout """
+    pass
+
+
+class _PooledConnection(object):
+    """ Book-keeping for a single pooled connection """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created = time.time()
+        self.last_used = self.created
+        self.uses = 0
+
+
+class ConnectionPool(object):
+    """ Bounded, thread-safe pool of database connections
+
+    The pool opens at most `size` connections. Connections are recycled after `max_uses` checkouts or `max_age` seconds,
+    and connections that have been idle for more than `ping_interval` seconds are health checked with a ping before
+    they are handed out. Connections inherited from a parent process (e.g., uWSGI forking workers after the app is
+    loaded) are never reused; each process builds its own pool.
+    """
+
+    def __init__(self, connect, size=5, max_uses=1000, max_age=3600, timeout=10, ping_interval=30):
+        """ Create a new pool
+
+        :param connect: Function that takes no arguments and returns a new DB-API connection
+        :param size: int - Maximum number of open connections
+        :param max_uses: int - Recycle a connection after this many checkouts (0 to disable)
+        :param max_age: float - Recycle a connection after this many seconds (0 to disable)
+        :param timeout: float - Seconds to wait for a free connection before raising PoolTimeout
+        :param ping_interval: float - Ping connections that have been idle for longer than this many seconds
+        """
+        self._connect = connect
+        self.size = size
+        self.max_uses = max_uses
+        self.max_age = max_age
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+
+        self._cond = threading.Condition(threading.Lock())
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = []
+        self._in_use = {}
+        self._open = 0
+        self._stats = {
+            u'checkouts': 0,
+            u'timeouts': 0,
+            u'connections_created': 0,
+            u'connections_recycled': 0,
+            u'connections_discarded': 0,
+            u'wait_time_total': 0.0,
+            u'wait_time_max': 0.0
+        }
+
+    def _expired(self, record, now):
+        return (self.max_uses and record.uses >= self.max_uses) or \
+               (self.max_age and now - record.created >= self.max_age)
+
+    @staticmethod
+    def _close(record):
+        try:
+            record.conn.close()
+        except Exception:
+            pass
+
+    def checkout(self):
+        """ Check out a connection, waiting up to the pool timeout for one to become available
+
+        :return: DB-API connection
+        """
+        start = time.time()
+        with self._cond:
+            if self._pid != os.getpid():
+                # Forked since the pool was created. The parent's sockets must not be shared, so forget them.
+                self._reset()
+
+            deadline = start + self.timeout
+            while not self._idle and self._open >= self.size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._stats[u'timeouts'] += 1
+                    raise PoolTimeout(u'No database connection available after %.1f seconds' % self.timeout)
+                self._cond.wait(remaining)
+
+            if self._idle:
+                record = self._idle.pop()
+            else:
+                # Reserve a slot for a new connection, which is opened outside of the lock
+                record = None
+                self._open += 1
+
+            wait = time.time() - start
+            self._stats[u'checkouts'] += 1
+            self._stats[u'wait_time_total'] += wait
+            self._stats[u'wait_time_max'] = max(self._stats[u'wait_time_max'], wait)
+
+        try:
+            now = time.time()
+            if record is not None and self._expired(record, now):
+                self._close(record)
+                record = None
+                self._count(u'connections_recycled')
+            elif record is not None and now - record.last_used >= self.ping_interval:
+                try:
+                    record.conn.ping(True)
+                except Exception:
+                    self._close(record)
+                    record = None
+                    self._count(u'connections_discarded')
+
+            if record is None:
+                record = _PooledConnection(self._connect())
+                self._count(u'connections_created')
+        except Exception:
+            # Give the slot back so that a failed connect does not shrink the pool
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+
+        record.uses += 1
+        with self._cond:
+            self._in_use[id(record.conn)] = record
+        return record.conn
+
+    def checkin(self, conn, discard=False):
+        """ Return a connection to the pool
+
+        :param conn: Connection previously returned by checkout
+        :param discard: True to close the connection instead of reusing it (e.g., after an OperationalError)
+        """
+        with self._cond:
+            record = self._in_use.pop(id(conn), None)
+            if record is None:
+                # Connection was checked out before a fork and no longer belongs to this pool
+                return
+
+            if discard:
+                self._open -= 1
+                self._stats[u'connections_discarded'] += 1
+            else:
+                record.last_used = time.time()
+                self._idle.append(record)
+            self._cond.notify()
+
+        if discard:
+            self._close(record)
+
+    def _count(self, stat):
+        with self._cond:
+            self._stats[stat] += 1
+
+    def stats(self):
+        """ Pool statistics for monitoring
+
+        :return: dict
+        """
+        with self._cond:
+            stats = dict(self._stats)
+            stats[u'size'] = self.size
+            stats[u'open'] = self._open
+            stats[u'idle'] = len(self._idle)
+            stats[u'in_use'] = len(self._in_use)
+        checkouts = stats[u'checkouts']
+        stats[u'wait_time_mean'] = stats[u'wait_time_total'] / checkouts if checkouts else 0.0
+        return stats
@@ -0,0 +1,535 @@
+u"""
+In-memory co-occurrence engine
+
+Loads a dataset's concept_pair_counts once into a symmetric sparse matrix (CSR) so that "all partners of a concept"
+queries become a row slice plus vectorized arithmetic instead of a two-branch UNION over concept_pair_counts. Results
+are formatted exactly like the corresponding SQL queries in query_cohd_mysql so the two backends are interchangeable.
+
+A matrix can also be exported to a binary snapshot file (see export_snapshot.py). Snapshots are opened with
+numpy.memmap, so all worker processes that open the same snapshot share its pages in the page cache instead of each
+holding a copy of the matrix. The snapshot format is:
+    8 bytes     magic (_SNAPSHOT_MAGIC)
+    4 bytes     length of the header (little-endian uint32)
+    header      JSON: version, dataset_id, patient_count, domains, and the dtype, offset, and length of each array
+    arrays      _SNAPSHOT_ARRAYS, each starting at a multiple of _SNAPSHOT_ALIGNMENT bytes after the header
+"""
+
+import json
+import os
+import struct
+import threading
+import numpy as np
+import pymysql
+from scipy.sparse import coo_matrix
+from association_stats import expected_count, ln_ratio, relative_frequency, rank_descending, page_mask
+
+# Number of rows fetched per round trip when streaming pair counts from MySQL
+_FETCH_SIZE = 100000
+# Number of concept_ids per IN (...) clause when looking up concept names
+_CONCEPT_CHUNK_SIZE = 10000
+
+# Snapshot file format
+_SNAPSHOT_MAGIC = b'COHDSNAP'
+_SNAPSHOT_VERSION = 1
+_SNAPSHOT_ALIGNMENT = 64
+# Arrays of a snapshot and their (little-endian) dtypes. names holds the UTF-8 encoded concept names, where the name of
+# concept k is names[name_offsets[k]:name_offsets[k + 1]].
+_SNAPSHOT_ARRAYS = [
+    (u'concept_ids', '<i4'),
+    (u'concept_counts', '<i4'),
+    (u'indptr', '<i8'),
+    (u'indices', '<i4'),
+    (u'pair_counts', '<u4'),
+    (u'domain_codes', '<i2'),
+    (u'name_offsets', '<i8'),
+    (u'names', 'u1'),
+]
+
+_matrices = {}
+_lock = threading.Lock()
+# Directory of the snapshot files (dataset_<dataset_id>.snapshot), or None to always load from MySQL
+_snapshot_dir = None
+
+
+class CooccurrenceMatrix(object):
+    """ Co-occurrence counts for one dataset
+
+    Concepts are addressed by their index in the sorted concept_ids array. The pairs are stored symmetrically, i.e.,
+    row i of the CSR arrays (indptr, indices, pair_counts) lists every concept that co-occurs with concept i.
+    """
+
+    def __init__(self, dataset_id, patient_count, concept_ids, concept_counts, indptr, indices, pair_counts,
+                 concept_names, domain_codes, domains):
+        """
+        :param dataset_id: int
+        :param patient_count: int - Number of patients in the dataset
+        :param concept_ids: sorted int array of all concept_ids in the dataset
+        :param concept_counts: int array of concept counts (-1 if the concept is not in concept_counts)
+        :param indptr: CSR row pointers
+        :param indices: CSR column indices
+        :param pair_counts: CSR values (concept pair counts)
+        :param concept_names: list of concept names (None if the concept is not in the concept table)
+        :param domain_codes: int array of indices into domains (-1 if the concept is not in the concept table)
+        :param domains: list of domain_ids
+        """
+        self.dataset_id = dataset_id
+        self.patient_count = patient_count
+        self.concept_ids = concept_ids
+        self.concept_counts = concept_counts
+        self.indptr = indptr
+        self.indices = indices
+        self.pair_counts = pair_counts
+        self.concept_names = concept_names
+        self.domain_codes = domain_codes
+        self.domains = domains
+        # MySQL compares domain_id case-insensitively
+        self._domain_lookup = {d.lower(): i for i, d in enumerate(domains)}
+
+    def _index(self, concept_id):
+        i = np.searchsorted(self.concept_ids, concept_id)
+        if i < len(self.concept_ids) and self.concept_ids[i] == concept_id:
+            return i
+        return None
+
+    def _partners(self, concept_id, domain_id=None, require_counts=False):
+        """ Row slice of the partners of concept_id
+
+        Partners are restricted to concepts in the concept table (the SQL queries inner join cohd.concept), to the
+        domain if specified, and to concepts with concept counts if require_counts is set.
+
+        :return: (index of concept_id, partner indices, pair counts), or None if concept_id has no partners
+        """
+        i = self._index(concept_id)
+        if i is None:
+            return None
+
+        start, end = self.indptr[i], self.indptr[i + 1]
+        j = self.indices[start:end]
+        cpc = self.pair_counts[start:end]
+
+        codes = self.domain_codes[j]
+        if domain_id is not None:
+            code = self._domain_lookup.get(domain_id.lower())
+            if code is None:
+                return None
+            mask = codes == code
+        else:
+            mask = codes >= 0
+        if require_counts:
+            mask &= self.concept_counts[j] >= 0
+
+        return i, j[mask], cpc[mask].astype(np.int64)
+
+    @staticmethod
+    def _rows(columns):
+        """ Converts columns of equal length into a list of row dicts
+
+        :param columns: list of (name, list or numpy array of values)
+        :return: list of dicts
+        """
+        names = [name for name, _ in columns]
+        values = [column if isinstance(column, list) else column.tolist() for _, column in columns]
+        return [dict(zip(names, row)) for row in zip(*values)]
+
+    @staticmethod
+    def _select(values, ids, pair_counts, page, statistic=None):
+        """ Ranks the partners by value descending (ties broken by concept_id), applying the page parameters
+
+        :return: (row order, total number of partners passing the filters)
+        """
+        if page is None:
+            return rank_descending(values, None, ids), len(values)
+        mask, total_count = page_mask(values, ids, pair_counts, page, statistic)
+        selected = np.flatnonzero(mask)
+        return selected[rank_descending(values[selected], page[u'limit'], ids[selected])], total_count
+
+    def _names(self, j):
+        return [self.concept_names[k] for k in j.tolist()], [self.domains[k] for k in self.domain_codes[j].tolist()]
+
+    def associated_concept_freq(self, concept_id, domain_id=None, page=None):
+        """ Same results as the associatedConceptFreq and associatedConceptDomainFreq SQL queries
+
+        :return: (list of results, total number of results passing the page filters)
+        """
+        partners = self._partners(concept_id, domain_id)
+        if partners is None:
+            return [], 0
+        i, j, cpc = partners
+
+        associated_ids = self.concept_ids[j]
+        concept_frequency = cpc / (self.patient_count + 0.0)
+        # Ranked by count, while min_statistic applies to the frequency
+        order, total_count = self._select(cpc, associated_ids, cpc, page, concept_frequency)
+        j = j[order]
+        cpc = cpc[order]
+
+        names, domains = self._names(j)
+        columns = [
+            (u'dataset_id', [self.dataset_id] * len(j)),
+            (u'concept_id', np.repeat(self.concept_ids[i], len(j))),
+            (u'associated_concept_id', associated_ids[order]),
+            (u'concept_count', cpc),
+            (u'concept_frequency', concept_frequency[order]),
+            (u'associated_concept_name', names),
+            (u'associated_domain_id', domains)
+        ]
+        return self._rows(columns), total_count
+
+    def chi_square_counts(self, concept_id_1, domain_id=None):
+        """ Same rows as the chiSquare SQL query (observed counts, before the chi-square is computed) """
+        partners = self._partners(concept_id_1, domain_id, require_counts=True)
+        if partners is None or self.concept_counts[partners[0]] < 0:
+            return []
+        i, j, cpc = partners
+
+        names, domains = self._names(j)
+        columns = [
+            (u'dataset_id', [self.dataset_id] * len(j)),
+            (u'concept_id_1', np.repeat(self.concept_ids[i], len(j))),
+            (u'concept_id_2', self.concept_ids[j]),
+            (u'concept_pair_count', cpc),
+            (u'concept_count_1', np.repeat(self.concept_counts[i], len(j))),
+            (u'concept_count_2', self.concept_counts[j]),
+            (u'patient_count', [self.patient_count] * len(j)),
+            (u'concept_2_name', names),
+            (u'concept_2_domain', domains)
+        ]
+        return self._rows(columns)
+
+    def obs_exp_ratio(self, concept_id_1, domain_id=None, page=None):
+        """ Same results as the obsExpRatio SQL query
+
+        :return: (list of results, total number of results passing the page filters)
+        """
+        partners = self._partners(concept_id_1, domain_id, require_counts=True)
+        if partners is None or self.concept_counts[partners[0]] < 0:
+            return [], 0
+        i, j, cpc = partners
+
+        c1 = self.concept_counts[i]
+        c2 = self.concept_counts[j]
+        associated_ids = self.concept_ids[j]
+        ln_ratios = ln_ratio(cpc, c1, c2, self.patient_count)
+        order, total_count = self._select(ln_ratios, associated_ids, cpc, page)
+        j = j[order]
+        c2 = c2[order]
+
+        names, domains = self._names(j)
+        columns = [
+            (u'dataset_id', [self.dataset_id] * len(j)),
+            (u'concept_id_1', np.repeat(self.concept_ids[i], len(j))),
+            (u'concept_id_2', associated_ids[order]),
+            (u'observed_count', cpc[order]),
+            (u'expected_count', expected_count(c1, c2, self.patient_count)),
+            (u'ln_ratio', ln_ratios[order]),
+            (u'concept_2_name', names),
+            (u'concept_2_domain', domains)
+        ]
+        return self._rows(columns), total_count
+
+    def relative_frequency(self, concept_id_1, domain_id=None, page=None):
+        """ Same results as the relativeFrequency SQL query
+
+        :return: (list of results, total number of results passing the page filters)
+        """
+        partners = self._partners(concept_id_1, domain_id, require_counts=True)
+        if partners is None:
+            return [], 0
+        i, j, cpc = partners
+
+        c2 = self.concept_counts[j]
+        associated_ids = self.concept_ids[j]
+        relative_frequencies = relative_frequency(cpc, c2)
+        order, total_count = self._select(relative_frequencies, associated_ids, cpc, page)
+        j = j[order]
+
+        names, domains = self._names(j)
+        columns = [
+            (u'dataset_id', [self.dataset_id] * len(j)),
+            (u'concept_id_1', np.repeat(self.concept_ids[i], len(j))),
+            (u'concept_id_2', associated_ids[order]),
+            (u'concept_pair_count', cpc[order]),
+            (u'concept_2_count', c2[order]),
+            (u'relative_frequency', relative_frequencies[order]),
+            (u'concept_2_name', names),
+            (u'concept_2_domain', domains)
+        ]
+        return self._rows(columns), total_count
+
+
+def _fetch_columns(conn, sql, params, dtypes):
+    """ Streams the results of a query into numpy arrays without materializing the rows as Python objects
+
+    :param conn: pymysql connection
+    :param sql: SQL query
+    :param params: SQL parameters
+    :param dtypes: list of numpy dtypes, one per selected column
+    :return: list of numpy arrays, one per column
+    """
+    chunks = [[] for _ in dtypes]
+    cur = conn.cursor(pymysql.cursors.SSCursor)
+    try:
+        cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(_FETCH_SIZE)
+            if not rows:
+                break
+            for k, column in enumerate(zip(*rows)):
+                chunks[k].append(np.array(column, dtype=dtypes[k]))
+    finally:
+        cur.close()
+
+    return [np.concatenate(c) if c else np.array([], dtype=dtypes[k]) for k, c in enumerate(chunks)]
+
+
+def load_matrix(conn, dataset_id):
+    """ Loads the co-occurrence matrix of a dataset from MySQL
+
+    :param conn: pymysql connection
+    :param dataset_id: int
+    :return: CooccurrenceMatrix, or None if the dataset does not exist
+    """
+    print u"Loading co-occurrence matrix for dataset ", dataset_id
+
+    cur = conn.cursor(pymysql.cursors.Cursor)
+    cur.execute('''SELECT count FROM cohd.patient_count WHERE dataset_id = %s;''', [dataset_id])
+    row = cur.fetchone()
+    cur.close()
+    if row is None:
+        return None
+    patient_count = int(row[0])
+
+    counted_ids, counts = _fetch_columns(
+        conn,
+        '''SELECT concept_id, concept_count FROM cohd.concept_counts WHERE dataset_id = %s;''',
+        [dataset_id], [np.int64, np.int64])
+    pair_ids_1, pair_ids_2, pair_counts = _fetch_columns(
+        conn,
+        '''SELECT concept_id_1, concept_id_2, concept_count FROM cohd.concept_pair_counts WHERE dataset_id = %s;''',
+        [dataset_id], [np.int64, np.int64, np.uint32])
+
+    # Index every concept that appears in either table
+    concept_ids = np.unique(np.concatenate([counted_ids, pair_ids_1, pair_ids_2])).astype(np.int32)
+    n = len(concept_ids)
+    concept_counts = np.full(n, -1, dtype=np.int64)
+    concept_counts[np.searchsorted(concept_ids, counted_ids)] = counts
+
+    # Symmetric sparse matrix: each pair is stored once in the table but is needed in both rows
+    i = np.searchsorted(concept_ids, pair_ids_1)
+    j = np.searchsorted(concept_ids, pair_ids_2)
+    matrix = coo_matrix((np.concatenate([pair_counts, pair_counts]), (np.concatenate([i, j]), np.concatenate([j, i]))),
+                        shape=(n, n)).tocsr()
+    matrix.sort_indices()
+
+    # Concept names and domains
+    concept_names = [None] * n
+    domain_codes = np.full(n, -1, dtype=np.int16)
+    domains = []
+    domain_lookup = {}
+    cur = conn.cursor(pymysql.cursors.Cursor)
+    id_list = concept_ids.tolist()
+    for start in range(0, n, _CONCEPT_CHUNK_SIZE):
+        chunk = id_list[start:start + _CONCEPT_CHUNK_SIZE]
+        sql = '''SELECT concept_id, concept_name, domain_id
+            FROM cohd.concept
+            WHERE concept_id IN (%s);''' % ','.join(['%s' for _ in chunk])
+        cur.execute(sql, chunk)
+        for concept_id, concept_name, domain_id in cur.fetchall():
+            k = np.searchsorted(concept_ids, concept_id)
+            concept_names[k] = concept_name
+            if domain_id not in domain_lookup:
+                domain_lookup[domain_id] = len(domains)
+                domains.append(domain_id)
+            domain_codes[k] = domain_lookup[domain_id]
+    cur.close()
+
+    print u"Loaded %d concepts and %d pairs for dataset %d" % (n, len(pair_counts), dataset_id)
+
+    return CooccurrenceMatrix(dataset_id, patient_count, concept_ids, concept_counts, matrix.indptr, matrix.indices,
+                              matrix.data, concept_names, domain_codes, domains)
+
+
+class _SnapshotNames(object):
+    """ Concept names decoded on access from the UTF-8 buffer of a snapshot """
+
+    def __init__(self, names, name_offsets, domain_codes):
+        self._names = names
+        self._name_offsets = name_offsets
+        self._domain_codes = domain_codes
+
+    def __len__(self):
+        return len(self._domain_codes)
+
+    def __getitem__(self, k):
+        # Concepts that are not in the concept table have neither a name nor a domain
+        if self._domain_codes[k] < 0:
+            return None
+        return self._names[self._name_offsets[k]:self._name_offsets[k + 1]].tostring().decode(u'utf-8')
+
+
+def snapshot_path(snapshot_dir, dataset_id):
+    return os.path.join(snapshot_dir, u'dataset_%d.snapshot' % dataset_id)
+
+
+def write_snapshot(matrix, path):
+    """ Writes the co-occurrence matrix to a snapshot file
+
+    The file is written next to path and then renamed, so that processes that still have the previous snapshot open keep
+    reading a consistent file.
+
+    :param matrix: CooccurrenceMatrix
+    :param path: snapshot file
+    :return: size of the file in bytes
+    """
+    encoded = [name.encode(u'utf-8') if name is not None else b'' for name in matrix.concept_names]
+    name_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(name) for name in encoded], out=name_offsets[1:])
+    arrays = {
+        u'concept_ids': matrix.concept_ids,
+        u'concept_counts': matrix.concept_counts,
+        u'indptr': matrix.indptr,
+        u'indices': matrix.indices,
+        u'pair_counts': matrix.pair_counts,
+        u'domain_codes': matrix.domain_codes,
+        u'name_offsets': name_offsets,
+        u'names': np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    }
+
+    header = {
+        u'version': _SNAPSHOT_VERSION,
+        u'dataset_id': matrix.dataset_id,
+        u'patient_count': matrix.patient_count,
+        u'domains': matrix.domains,
+        u'arrays': []
+    }
+    offset = 0
+    for name, dtype in _SNAPSHOT_ARRAYS:
+        header[u'arrays'].append({u'name': name, u'dtype': dtype, u'offset': offset, u'length': len(arrays[name])})
+        offset += _align(len(arrays[name]) * np.dtype(dtype).itemsize)
+    encoded_header = json.dumps(header).encode(u'utf-8')
+    data_start = _align(len(_SNAPSHOT_MAGIC) + 4 + len(encoded_header))
+
+    temp_path = path + u'.tmp'
+    with open(temp_path, u'wb') as f:
+        f.write(_SNAPSHOT_MAGIC + struct.pack('<I', len(encoded_header)) + encoded_header)
+        for entry in header[u'arrays']:
+            f.seek(data_start + entry[u'offset'])
+            f.write(np.ascontiguousarray(arrays[entry[u'name']], dtype=entry[u'dtype']).tostring())
+        f.truncate(data_start + offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp_path, path)
+    return data_start + offset
+
+
+def _align(n):
+    """ Rounds n up to a multiple of _SNAPSHOT_ALIGNMENT """
+    return -(-n // _SNAPSHOT_ALIGNMENT) * _SNAPSHOT_ALIGNMENT
+
+
+def load_snapshot(path):
+    """ Opens a snapshot file written by write_snapshot
+
+    The arrays are memory-mapped read-only, so opening a snapshot reads no pair data, and the pages read while serving
+    requests are shared by all processes that open the same file.
+
+    :param path: snapshot file
+    :return: CooccurrenceMatrix
+    """
+    with open(path, u'rb') as f:
+        prefix = f.read(len(_SNAPSHOT_MAGIC) + 4)
+        if len(prefix) < len(_SNAPSHOT_MAGIC) + 4 or prefix[:len(_SNAPSHOT_MAGIC)] != _SNAPSHOT_MAGIC:
+            raise ValueError(u'%s is not a COHD snapshot' % path)
+        header_length = struct.unpack('<I', prefix[len(_SNAPSHOT_MAGIC):])[0]
+        header = json.loads(f.read(header_length).decode(u'utf-8'))
+    if header[u'version'] != _SNAPSHOT_VERSION:
+        raise ValueError(u'%s has snapshot version %s, expected %d' % (path, header[u'version'], _SNAPSHOT_VERSION))
+
+    data_start = _align(len(_SNAPSHOT_MAGIC) + 4 + header_length)
+    arrays = {}
+    for entry in header[u'arrays']:
+        if entry[u'length'] == 0:
+            # Empty arrays cannot be memory-mapped
+            arrays[entry[u'name']] = np.zeros(0, dtype=entry[u'dtype'])
+        else:
+            arrays[entry[u'name']] = np.memmap(path, dtype=entry[u'dtype'], mode=u'r',
+                                               offset=data_start + entry[u'offset'], shape=(entry[u'length'],))
+
+    names = _SnapshotNames(arrays[u'names'], arrays[u'name_offsets'], arrays[u'domain_codes'])
+    print u"Opened snapshot %s: %d concepts and %d pairs for dataset %d" % \
+        (path, len(arrays[u'concept_ids']), len(arrays[u'indices']) // 2, header[u'dataset_id'])
+    return CooccurrenceMatrix(header[u'dataset_id'], header[u'patient_count'], arrays[u'concept_ids'],
+                              arrays[u'concept_counts'], arrays[u'indptr'], arrays[u'indices'], arrays[u'pair_counts'],
+                              names, arrays[u'domain_codes'], header[u'domains'])
+
+
+def configure_snapshots(snapshot_dir):
+    """ Serves datasets that have a snapshot file in snapshot_dir from the snapshot instead of loading them from MySQL
+
+    :param snapshot_dir: directory, or None to always load from MySQL
+    """
+    global _snapshot_dir
+    _snapshot_dir = snapshot_dir
+
+
+def _snapshot_matches(conn, matrix):
+    """ Whether a snapshot matches the dataset in the database: same number of patients and of concepts with counts
+
+    A snapshot that was not re-exported after the dataset was reloaded would serve the previous data.
+    """
+    cur = conn.cursor(pymysql.cursors.Cursor)
+    cur.execute('''SELECT (SELECT count FROM cohd.patient_count WHERE dataset_id = %s),
+            (SELECT COUNT(*) FROM cohd.concept_counts WHERE dataset_id = %s);''',
+                [matrix.dataset_id, matrix.dataset_id])
+    row = cur.fetchone()
+    cur.close()
+    # Concepts that only appear in pairs have a count of -1
+    return row[0] is not None and int(row[0]) == matrix.patient_count and \
+        int(row[1]) == np.count_nonzero(matrix.concept_counts >= 0)
+
+
+def _load(conn, dataset_id):
+    """ Opens the snapshot of the dataset if there is one and it is up to date, otherwise loads the dataset from MySQL
+    """
+    if _snapshot_dir is not None:
+        path = snapshot_path(_snapshot_dir, dataset_id)
+        if os.path.exists(path):
+            try:
+                matrix = load_snapshot(path)
+            except (IOError, ValueError) as e:
+                print u"Cannot open snapshot, loading from MySQL instead: ", e
+            else:
+                if _snapshot_matches(conn, matrix):
+                    return matrix
+                print u"Snapshot %s is out of date, loading from MySQL instead. Re-export it with " \
+                      u"export_snapshot.py." % path
+    return load_matrix(conn, dataset_id)
+
+
+def get_matrix(conn, dataset_id):
+    """ Gets the co-occurrence matrix of a dataset, loading it on first use
+
+    :param conn: pymysql connection used if the dataset needs to be loaded
+    :param dataset_id: int
+    :return: CooccurrenceMatrix, or None if the dataset does not exist
+    """
+    if dataset_id in _matrices:
+        return _matrices[dataset_id]
+
+    with _lock:
+        # Another thread may have loaded the dataset while we were waiting
+        if dataset_id not in _matrices:
+            _matrices[dataset_id] = _load(conn, dataset_id)
+        return _matrices[dataset_id]
+
+
+def clear(dataset_id=None):
+    """ Drops the loaded matrices of a dataset (or all datasets) so that they are reloaded on next use
+
+    :param dataset_id: int, or None for all datasets
+    """
+    with _lock:
+        if dataset_id is None:
+            _matrices.clear()
+        else:
+            _matrices.pop(dataset_id, None)
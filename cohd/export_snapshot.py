@@ -0,0 +1,63 @@
+u"""
+Exports the co-occurrence matrices of datasets to binary snapshot files
+
+Each dataset's concept_counts and concept_pair_counts are loaded into a co-occurrence matrix and written to
+dataset_<dataset_id>.snapshot in the output directory (see cooccurrence.py for the format). API processes configured
+with COOCCURRENCE_ENGINE = True and COOCCURRENCE_SNAPSHOT_DIR set to the output directory memory-map the snapshots
+instead of loading the pairs from MySQL. Re-export after loading a dataset, then POST to /api/admin/invalidateDataset
+(or restart the workers) so that the new snapshot is opened.
+
+Run from the cohd directory (the location of cohd_mysql.cnf):
+    python export_snapshot.py --output_dir /data/cohd/snapshots --dataset_id 1
+"""
+
+import argparse
+import os
+import time
+import pymysql
+import cooccurrence
+from storage_backends import MySQLBackend, SQLiteBackend
+
+
+def export(conn, output_dir, dataset_ids=None):
+    """ Writes the snapshots of the datasets
+
+    :param conn: pymysql connection (or a connection of storage_backends)
+    :param output_dir: directory of the snapshot files
+    :param dataset_ids: list of dataset_ids, or None for all datasets
+    """
+    if dataset_ids is None:
+        cur = conn.cursor(pymysql.cursors.Cursor)
+        cur.execute('''SELECT dataset_id FROM cohd.dataset ORDER BY dataset_id;''')
+        dataset_ids = [row[0] for row in cur.fetchall()]
+        cur.close()
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    for dataset_id in dataset_ids:
+        start = time.time()
+        matrix = cooccurrence.load_matrix(conn, dataset_id)
+        if matrix is None:
+            print u"Dataset %d not found" % dataset_id
+            continue
+        path = cooccurrence.snapshot_path(output_dir, dataset_id)
+        size = cooccurrence.write_snapshot(matrix, path)
+        print u"Wrote %s (%.1f MB) in %.1f s" % (path, size / 1048576.0, time.time() - start)
+
+
+if __name__ == u"__main__":
+    parser = argparse.ArgumentParser(description=u'Export the co-occurrence matrices of datasets to snapshot files')
+    parser.add_argument(u'--output_dir', required=True, help=u'Directory of the snapshot files')
+    parser.add_argument(u'--dataset_id', type=int, action=u'append',
+                        help=u'Dataset to export (may be repeated). Default: all datasets')
+    parser.add_argument(u'--config', default=u'cohd_mysql.cnf', help=u'MySQL option file')
+    parser.add_argument(u'--sqlite', help=u'Export from this SQLite database (see load_dataset.py) instead of MySQL')
+    arguments = parser.parse_args()
+
+    backend = SQLiteBackend(arguments.sqlite) if arguments.sqlite else MySQLBackend(arguments.config)
+    connection = backend.connect()
+    try:
+        export(connection, arguments.output_dir, arguments.dataset_id)
+    finally:
+        connection.close()
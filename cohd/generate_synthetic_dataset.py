@@ -0,0 +1,220 @@
+u"""
+Generates a synthetic COHD dataset for benchmarking
+
+Writes a dataset directory in the format of load_dataset.py: concept.txt, concept_relationship.txt, concept_counts.txt,
+concept_pair_counts.txt, and patient_count.txt. The skew of the real data is reproduced: concept weights follow a power
+law, so a few hub concepts (common conditions and drugs) co-occur with a large fraction of all concepts while most
+concepts have only a few pairs. Pairs are drawn with probability proportional to the product of the weights of their
+concepts (Chung-Lu model), which gives a power-law degree distribution with the requested exponent. Concept counts grow
+with the weights, pair counts never exceed the counts of their concepts, and all counts are above COHD's minimum count
+of 10. A tenth of the concepts are non-standard source codes that map to standard concepts in concept_relationship.txt,
+for the OMOP mapping endpoints. The same seed always generates the same dataset.
+
+Run from the cohd directory, then load the dataset (the dataset name and description go to cohd.dataset):
+    python generate_synthetic_dataset.py /data/cohd/synthetic --concepts 1000000 --pairs 20000000
+    python load_dataset.py /data/cohd/synthetic --dataset_id 1 --dataset_name "Synthetic" --sqlite cohd_bench.sqlite
+"""
+
+import argparse
+import os
+import time
+import numpy as np
+
+# Minimum count reported by COHD (lower counts are censored)
+_MIN_COUNT = 11
+# Rows written per chunk
+_CHUNK_SIZE = 1000000
+# Fraction of the concepts that are non-standard source codes
+_SOURCE_FRACTION = 0.1
+
+# Standard domains: (domain_id, vocabulary_id, concept_class_id, fraction of the standard concepts)
+_DOMAINS = [
+    (u'Condition', u'SNOMED', u'Clinical Finding', 0.35),
+    (u'Drug', u'RxNorm', u'Ingredient', 0.25),
+    (u'Procedure', u'SNOMED', u'Procedure', 0.2),
+    (u'Measurement', u'LOINC', u'Lab Test', 0.12),
+    (u'Observation', u'SNOMED', u'Observable Entity', 0.08),
+]
+# Source vocabularies of the non-standard concepts: (vocabulary_id, concept_class_id, domain index)
+_SOURCE_VOCABULARIES = [
+    (u'ICD9CM', u'4-dig billing code', 0),
+    (u'ICD10CM', u'4-char billing code', 0),
+    (u'CPT4', u'CPT4', 2),
+    (u'NDC', u'11-digit NDC', 1),
+]
+# Words that the concept names are made of, so that findConceptIDs finds matches
+_WORDS = [u'acute', u'chronic', u'primary', u'secondary', u'essential', u'benign', u'malignant', u'congenital',
+          u'bilateral', u'severe', u'mild', u'recurrent', u'hypertension', u'diabetes', u'neoplasm', u'infection',
+          u'fracture', u'disorder', u'syndrome', u'deficiency', u'inflammation', u'obstruction', u'stenosis',
+          u'heart', u'kidney', u'liver', u'lung', u'skin', u'bone', u'joint', u'blood', u'brain', u'colon',
+          u'aspirin', u'metformin', u'insulin', u'lisinopril', u'atorvastatin', u'amoxicillin', u'heparin',
+          u'injection', u'tablet', u'oral', u'excision', u'biopsy', u'repair', u'imaging', u'panel', u'serum',
+          u'glucose', u'sodium', u'potassium', u'hemoglobin', u'cholesterol', u'pressure', u'rate', u'finding']
+
+
+def _weights(n, exponent, random):
+    """ Power-law weights in random order, so that the hubs are spread over the concept_ids
+
+    The expected degree of a concept in the Chung-Lu model is proportional to its weight, and weights
+    (rank)^(-1 / (exponent - 1)) give a degree distribution P(k) ~ k^-exponent.
+    """
+    weights = np.arange(1, n + 1, dtype=np.float64) ** (-1.0 / (exponent - 1.0))
+    random.shuffle(weights)
+    return weights
+
+
+def _concept_ids(n, random):
+    """ Sorted, sparse concept_ids, like the OMOP vocabulary """
+    return np.cumsum(random.randint(1, 40, n)).astype(np.int64) + 1000
+
+
+def _names(n, random):
+    """ Concept names of 2 to 4 words, made unique by a number """
+    words = np.array(_WORDS, dtype=object)
+    lengths = random.randint(2, 5, n)
+    picks = random.randint(0, len(_WORDS), (n, 4))
+    return [u' '.join(words[picks[i, :lengths[i]]]) + u' %d' % i for i in xrange(n)]
+
+
+def _write_concepts(output_dir, concept_ids, standard, domains, random):
+    """ Writes concept.txt and concept_relationship.txt
+
+    :param concept_ids: array of all concept_ids
+    :param standard: boolean array, True for standard concepts
+    :param domains: array of domain indices of the standard concepts (source concepts: -1)
+    """
+    n = len(concept_ids)
+    names = _names(n, random)
+    sources = random.randint(0, len(_SOURCE_VOCABULARIES), n)
+    codes = random.randint(100000, 99999999, n)
+    standard_ids = concept_ids[standard]
+    standard_domains = domains[standard]
+
+    with open(os.path.join(output_dir, u'concept.txt'), u'wb') as f:
+        for i in xrange(n):
+            if standard[i]:
+                domain_id, vocabulary_id, concept_class_id, _ = _DOMAINS[domains[i]]
+                standard_concept = u'S'
+                concept_code = u'%d' % codes[i]
+            else:
+                vocabulary_id, concept_class_id, domain = _SOURCE_VOCABULARIES[sources[i]]
+                domain_id = _DOMAINS[domain][0]
+                standard_concept = u''
+                concept_code = u'%d.%d' % (codes[i] // 100, codes[i] % 100)
+            f.write((u'\t'.join([u'%d' % concept_ids[i], names[i], domain_id, vocabulary_id, concept_class_id,
+                                 standard_concept, concept_code]) + u'\n').encode(u'utf-8'))
+
+    # Each source concept maps to a standard concept of its domain
+    with open(os.path.join(output_dir, u'concept_relationship.txt'), u'wb') as f:
+        for d in range(len(_DOMAINS)):
+            targets = standard_ids[standard_domains == d]
+            source_ids = concept_ids[(~standard) & (np.array([v[2] for v in _SOURCE_VOCABULARIES])[sources] == d)]
+            if len(targets) == 0 or len(source_ids) == 0:
+                continue
+            mapped = targets[random.randint(0, len(targets), len(source_ids))]
+            for source_id, target_id in zip(source_ids.tolist(), mapped.tolist()):
+                f.write(u'%d\t%d\tMaps to\n%d\t%d\tMapped from\n' % (source_id, target_id, target_id, source_id))
+
+
+def _sample_pairs(weights, n_pairs, random):
+    """ Draws distinct pairs of concept indices, with probability proportional to the product of their weights
+
+    :return: (index_1, index_2) arrays in canonical order (index_1 < index_2), sorted
+    """
+    p = weights / weights.sum()
+    cumulative = np.cumsum(p)
+    keys = np.zeros(0, dtype=np.int64)
+    n = np.int64(len(weights))
+    for _ in range(50):
+        # Draw more than needed, since the hubs produce many duplicate pairs
+        draws = int((n_pairs - len(keys)) * 1.3) + 1000
+        a = np.minimum(np.searchsorted(cumulative, random.random_sample(draws)), n - 1)
+        b = np.minimum(np.searchsorted(cumulative, random.random_sample(draws)), n - 1)
+        keep = a != b
+        a, b = a[keep], b[keep]
+        keys = np.unique(np.concatenate([keys, np.minimum(a, b) * n + np.maximum(a, b)]))
+        if len(keys) >= n_pairs:
+            break
+    if len(keys) > n_pairs:
+        keys = np.sort(random.choice(keys, n_pairs, replace=False))
+    return keys // n, keys % n
+
+
+def _write_rows(path, columns, fmt):
+    """ Writes tab-separated rows in chunks """
+    n = len(columns[0])
+    with open(path, u'wb') as f:
+        for start in xrange(0, n, _CHUNK_SIZE):
+            chunk = np.column_stack([c[start:start + _CHUNK_SIZE] for c in columns])
+            np.savetxt(f, chunk, fmt=fmt, delimiter='\t')
+
+
+def generate(output_dir, n_concepts, n_pairs, n_patients, exponent, seed):
+    """ Writes a synthetic dataset
+
+    :param output_dir: Dataset directory (created if missing)
+    :param n_concepts: Number of concepts with counts (standard concepts)
+    :param n_pairs: Number of concept pairs (fewer if the concepts cannot form that many distinct pairs)
+    :param n_patients: Number of patients
+    :param exponent: Exponent of the power-law degree distribution (> 2)
+    :param seed: Random seed
+    """
+    random = np.random.RandomState(seed)
+    start = time.time()
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    # Standard concepts with counts, plus the non-standard source concepts
+    n_sources = int(n_concepts * _SOURCE_FRACTION / (1 - _SOURCE_FRACTION))
+    n_total = n_concepts + n_sources
+    concept_ids = _concept_ids(n_total, random)
+    standard = np.zeros(n_total, dtype=bool)
+    standard[random.choice(n_total, n_concepts, replace=False)] = True
+    domains = np.full(n_total, -1, dtype=np.int64)
+    fractions = np.array([d[3] for d in _DOMAINS])
+    domains[standard] = random.choice(len(_DOMAINS), n_concepts, p=fractions / fractions.sum())
+    _write_concepts(output_dir, concept_ids, standard, domains, random)
+    print u"Wrote %d concepts (%d standard)" % (n_total, n_concepts)
+
+    # Concept counts grow with the weights: the hubs are seen in a large fraction of the patients
+    ids = concept_ids[standard]
+    weights = _weights(n_concepts, exponent, random)
+    noise = random.lognormal(0, 0.5, n_concepts)
+    counts = np.clip(np.round(0.3 * n_patients * weights / weights.max() * noise), _MIN_COUNT, n_patients)
+    counts = counts.astype(np.int64)
+    _write_rows(os.path.join(output_dir, u'concept_counts.txt'),
+                [ids, counts, counts / float(n_patients)], [u'%d', u'%d', u'%.6g'])
+    print u"Wrote %d concept counts" % n_concepts
+
+    # Pair counts are a fraction of the smaller count of the two concepts
+    max_pairs = n_concepts * (n_concepts - 1) // 2
+    i1, i2 = _sample_pairs(weights, min(n_pairs, max_pairs), random)
+    smaller = np.minimum(counts[i1], counts[i2])
+    pair_counts = _MIN_COUNT + np.floor((smaller - _MIN_COUNT) * random.beta(0.5, 5, len(i1))).astype(np.int64)
+    _write_rows(os.path.join(output_dir, u'concept_pair_counts.txt'),
+                [ids[i1], ids[i2], pair_counts, pair_counts / float(n_patients)], [u'%d', u'%d', u'%d', u'%.6g'])
+    degrees = np.bincount(np.concatenate([i1, i2]), minlength=n_concepts)
+    print u"Wrote %d concept pairs (maximum degree %d, median degree %d)" % \
+        (len(i1), degrees.max(), np.median(degrees))
+
+    with open(os.path.join(output_dir, u'patient_count.txt'), u'wb') as f:
+        f.write(u'%d\n' % n_patients)
+
+    print u"Generated %s in %.1f s" % (output_dir, time.time() - start)
+
+
+if __name__ == u"__main__":
+    parser = argparse.ArgumentParser(description=u'Generate a synthetic COHD dataset for benchmarking')
+    parser.add_argument(u'output_dir', help=u'Directory of the dataset files')
+    parser.add_argument(u'--concepts', type=int, default=100000, help=u'Number of concepts with counts')
+    parser.add_argument(u'--pairs', type=int, default=1000000, help=u'Number of concept pairs')
+    parser.add_argument(u'--patients', type=int, default=1000000, help=u'Number of patients')
+    parser.add_argument(u'--exponent', type=float, default=2.2,
+                        help=u'Exponent of the power-law degree distribution (> 2). Lower values give bigger hubs')
+    parser.add_argument(u'--seed', type=int, default=0, help=u'Random seed')
+    arguments = parser.parse_args()
+
+    if arguments.exponent <= 2:
+        parser.error(u'--exponent should be greater than 2')
+    generate(arguments.output_dir, arguments.concepts, arguments.pairs, arguments.patients, arguments.exponent,
+             arguments.seed)
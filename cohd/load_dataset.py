@@ -0,0 +1,646 @@
+u"""
+Loads a COHD dataset from a directory of tab-separated files
+
+Replaces db/sql/setup_mysql_db.sql. The files are validated while they are streamed and loaded in chunks into staging
+tables without secondary indexes, by a pool of worker processes. The derived tables (patient_count,
+concept_pair_adjacency, domain_concept_counts, domain_pair_concept_counts) are built from the staging tables, the
+indexes are added after loading, and all staging tables are then swapped in at once. Rows of other datasets are kept,
+and nothing is changed if a file fails validation. Concept pairs are stored in canonical order (concept_id_1 <
+concept_id_2, see build_canonical_pairs.py).
+
+Files in the dataset directory (no header line unless --header is given):
+    concept_counts.txt       concept_id, concept_count, concept_frequency
+    concept_pair_counts.txt  concept_id_1, concept_id_2, concept_count, concept_frequency
+    patient_count.txt        number of patients in the dataset (or use --patient_count)
+    concept.txt              optional: concept_id, concept_name, domain_id, vocabulary_id, concept_class_id,
+                             standard_concept, concept_code
+    concept_relationship.txt optional: concept_id_1, concept_id_2, relationship_id
+cohd.concept and cohd.concept_relationship are shared by all datasets and are replaced when their files are given.
+
+The target is either the MySQL database in the MySQL option file, or an embedded SQLite database file that can be
+served with STORAGE_BACKEND = 'sqlite' (see storage_backends.py) or used for testing.
+
+Data derived from the dataset outside of these tables is brought up to date after the load: on MySQL, the association
+statistics in cohd.concept_pair_stats are rebuilt for the dataset if the table exists (see build_association_stats.py,
+unless --skip_stats), and with --snapshot_dir, the co-occurrence snapshot of the dataset is re-exported (see
+export_snapshot.py). API processes that serve snapshots from another directory ignore a snapshot that no longer matches
+the database.
+
+Run from the cohd directory (the location of cohd_mysql.cnf):
+    python load_dataset.py /data/cohd/5_year --dataset_id 1 --dataset_name "5-year dataset" --processes 8 \
+        --snapshot_dir /data/cohd/snapshots
+    python load_dataset.py /data/cohd/5_year --dataset_id 1 --sqlite cohd_test.sqlite
+"""
+
+import argparse
+import codecs
+import csv
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+from collections import deque
+import pymysql
+import build_association_stats
+import export_snapshot
+from storage_backends import MySQLBackend, SQLiteBackend
+
+_STAGING_SUFFIX = u'_staging'
+_OLD_SUFFIX = u'_old'
+_CHUNK_SIZE = 20000
+# Maximum number of validation errors reported before the load is aborted
+_MAX_ERRORS = 20
+
+# Tables: columns (name, SQL type, parser), primary key, secondary indexes, and whether the table holds rows of
+# several datasets (the dataset_id column is added by the loader). Parsers raise ValueError for invalid values.
+_TABLES = [
+    (u'concept', {
+        u'columns': [(u'concept_id', u'INT(11) NOT NULL', u'id'),
+                     (u'concept_name', u'VARCHAR(255) NOT NULL', 255),
+                     (u'domain_id', u'VARCHAR(20) NOT NULL', 20),
+                     (u'vocabulary_id', u'VARCHAR(20) NOT NULL', 20),
+                     (u'concept_class_id', u'VARCHAR(20) NOT NULL', 20),
+                     (u'standard_concept', u'VARCHAR(1) NULL', 1),
+                     (u'concept_code', u'VARCHAR(50) NOT NULL', 50)],
+        u'primary_key': [u'concept_id'],
+        u'indexes': [(u'concept_class', [u'concept_class_id']), (u'domain', [u'domain_id'])],
+        u'per_dataset': False
+    }),
+    (u'concept_relationship', {
+        u'columns': [(u'concept_id_1', u'INT(11) NOT NULL', u'id'),
+                     (u'concept_id_2', u'INT(11) NOT NULL', u'id'),
+                     (u'relationship_id', u'VARCHAR(20) NOT NULL', 20)],
+        u'primary_key': [u'concept_id_1', u'concept_id_2', u'relationship_id'],
+        u'indexes': [(u'concept_id_2_idx', [u'concept_id_2', u'relationship_id'])],
+        u'per_dataset': False
+    }),
+    (u'concept_counts', {
+        u'columns': [(u'concept_id', u'INT(11) NOT NULL', u'id'),
+                     (u'concept_count', u'INT UNSIGNED NOT NULL', u'count'),
+                     (u'concept_frequency', u'DOUBLE NOT NULL', u'frequency')],
+        u'primary_key': [u'dataset_id', u'concept_id'],
+        u'indexes': [],
+        u'per_dataset': True
+    }),
+    (u'concept_pair_counts', {
+        u'columns': [(u'concept_id_1', u'INT(11) NOT NULL', u'id'),
+                     (u'concept_id_2', u'INT(11) NOT NULL', u'id'),
+                     (u'concept_count', u'INT UNSIGNED NOT NULL', u'count'),
+                     (u'concept_frequency', u'DOUBLE NOT NULL', u'frequency')],
+        u'primary_key': [u'dataset_id', u'concept_id_1', u'concept_id_2'],
+        u'indexes': [(u'concept_id_2_idx', [u'dataset_id', u'concept_id_2'])],
+        u'per_dataset': True
+    }),
+    (u'concept_pair_adjacency', {
+        u'columns': [(u'concept_id', u'INT(11) NOT NULL', None),
+                     (u'associated_concept_id', u'INT(11) NOT NULL', None),
+                     (u'concept_count', u'INT UNSIGNED NOT NULL', None)],
+        u'primary_key': [u'dataset_id', u'concept_id', u'associated_concept_id'],
+        u'indexes': [(u'concept_count_idx', [u'dataset_id', u'concept_id', u'concept_count DESC'])],
+        u'per_dataset': True
+    }),
+    (u'patient_count', {
+        u'columns': [(u'count', u'INT UNSIGNED NOT NULL', None)],
+        u'primary_key': [u'dataset_id'],
+        u'indexes': [],
+        u'per_dataset': True
+    }),
+    (u'domain_concept_counts', {
+        u'columns': [(u'domain_id', u'VARCHAR(20) NOT NULL', None),
+                     (u'count', u'INT UNSIGNED NOT NULL', None)],
+        u'primary_key': [u'dataset_id', u'domain_id'],
+        u'indexes': [],
+        u'per_dataset': True
+    }),
+    (u'domain_pair_concept_counts', {
+        u'columns': [(u'domain_id_1', u'VARCHAR(20) NOT NULL', None),
+                     (u'domain_id_2', u'VARCHAR(20) NOT NULL', None),
+                     (u'count', u'INT UNSIGNED NOT NULL', None)],
+        u'primary_key': [u'dataset_id', u'domain_id_1', u'domain_id_2'],
+        u'indexes': [],
+        u'per_dataset': True
+    }),
+]
+_TABLE_SPECS = dict(_TABLES)
+
+# Per-process target and connection for the worker processes
+_worker_target = None
+_worker_conn = None
+
+
+class LoadError(Exception):
+    """ A dataset file failed validation """
+    pass
+
+
+def _parse_id(value):
+    return int(value)
+
+
+def _parse_count(value):
+    count = int(value)
+    if count < 0:
+        raise ValueError(u'negative count')
+    return count
+
+
+def _parse_frequency(value):
+    frequency = float(value)
+    if not 0 <= frequency <= 1:
+        raise ValueError(u'frequency outside [0, 1]')
+    return frequency
+
+
+_PARSERS = {
+    u'id': _parse_id,
+    u'count': _parse_count,
+    u'frequency': _parse_frequency
+}
+
+
+def _parser(kind, nullable):
+    if isinstance(kind, int):
+        # Text of at most kind characters. Empty text is stored as NULL in nullable columns.
+        def parse_text(value):
+            if nullable and value == '':
+                return None
+            text = value.decode(u'utf-8')
+            if len(text) > kind:
+                raise ValueError(u'longer than %d characters' % kind)
+            return text
+        return parse_text
+    return _PARSERS[kind]
+
+
+def _columns(spec):
+    """ Column names of a table, starting with dataset_id for per-dataset tables """
+    return ([u'dataset_id'] if spec[u'per_dataset'] else []) + [name for name, _, _ in spec[u'columns']]
+
+
+def _ddl(spec, indexes, text_collation=None):
+    columns = [(u'dataset_id', u'TINYINT NOT NULL', None)] if spec[u'per_dataset'] else []
+    columns += spec[u'columns']
+    definitions = [u'%s %s' % (name, sql_type) +
+                   (u' COLLATE ' + text_collation if text_collation and sql_type.startswith(u'VARCHAR') else u'')
+                   for name, sql_type, _ in columns]
+    definitions.append(u'PRIMARY KEY (%s)' % u', '.join(spec[u'primary_key']))
+    if indexes:
+        definitions += [u'INDEX %s (%s)' % (name, u', '.join(index_columns))
+                        for name, index_columns in spec[u'indexes']]
+    return u'(\n  %s)' % u',\n  '.join(definitions)
+
+
+class _MySQLTarget(object):
+    """ Loads into the cohd schema of a MySQL database """
+
+    name = u'MySQL'
+    parallel = True
+    least = u'LEAST'
+    greatest = u'GREATEST'
+
+    def __init__(self, config_file):
+        self.config_file = config_file
+
+    def connect(self):
+        return pymysql.connect(read_default_file=self.config_file, charset=u'utf8mb4', autocommit=False)
+
+    def backend(self):
+        return MySQLBackend(self.config_file)
+
+    def has_association_stats(self):
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute(u"SHOW TABLES FROM cohd LIKE 'concept_pair_stats';")
+            return cur.fetchone() is not None
+        finally:
+            conn.close()
+
+    def build_association_stats(self, dataset_id, processes):
+        build_association_stats.build(self.config_file, [dataset_id], processes)
+
+    def sql(self, sql):
+        return sql
+
+    def commit(self, conn):
+        conn.commit()
+
+    def rollback(self, conn):
+        conn.rollback()
+
+    def create_table(self, cur, table, spec, staging):
+        if staging:
+            cur.execute(u'DROP TABLE IF EXISTS cohd.%s;' % table)
+            cur.execute(u'CREATE TABLE cohd.%s %s;' % (table, _ddl(spec, indexes=False)))
+        else:
+            cur.execute(u'CREATE TABLE IF NOT EXISTS cohd.%s %s;' % (table, _ddl(spec, indexes=True)))
+
+    def drop_table(self, cur, table):
+        cur.execute(u'DROP TABLE IF EXISTS cohd.%s;' % table)
+
+    def swap(self, conn, tables):
+        """ Adds the indexes to the staging tables and swaps them in with one atomic RENAME TABLE
+
+        :param tables: list of (table, spec)
+        """
+        cur = conn.cursor()
+        for table, spec in tables:
+            if spec[u'indexes']:
+                print u"Adding indexes to %s" % table
+                cur.execute(u'ALTER TABLE cohd.%s %s;' % (table + _STAGING_SUFFIX, u', '.join(
+                    u'ADD INDEX %s (%s)' % (name, u', '.join(columns)) for name, columns in spec[u'indexes'])))
+        for table, _ in tables:
+            cur.execute(u'DROP TABLE IF EXISTS cohd.%s;' % (table + _OLD_SUFFIX))
+        cur.execute(u'RENAME TABLE %s;' % u', '.join(
+            u'cohd.{t} TO cohd.{t}{old}, cohd.{t}{staging} TO cohd.{t}'.format(t=table, old=_OLD_SUFFIX,
+                                                                               staging=_STAGING_SUFFIX)
+            for table, _ in tables))
+        for table, _ in tables:
+            cur.execute(u'DROP TABLE cohd.%s;' % (table + _OLD_SUFFIX))
+        conn.commit()
+        cur.close()
+
+
+class _SQLiteTarget(object):
+    """ Loads into an embedded SQLite database file, attached as the cohd schema
+
+    SQLite serializes writes, so chunks are inserted by the loading process. Text is compared case-insensitively, as
+    in MySQL.
+    """
+
+    name = u'SQLite'
+    parallel = False
+    least = u'MIN'
+    greatest = u'MAX'
+
+    def __init__(self, path):
+        self.path = path
+
+    def backend(self):
+        return SQLiteBackend(self.path)
+
+    def has_association_stats(self):
+        # concept_pair_stats is only built on MySQL
+        return False
+
+    def connect(self):
+        # Transactions are managed explicitly so that DDL statements are part of them
+        conn = sqlite3.connect(u':memory:', isolation_level=None)
+        conn.execute(u'ATTACH DATABASE ? AS cohd;', [self.path])
+        conn.execute(u'BEGIN;')
+        return conn
+
+    def sql(self, sql):
+        return sql.replace(u'%s', u'?')
+
+    def commit(self, conn):
+        conn.execute(u'COMMIT;')
+        conn.execute(u'BEGIN;')
+
+    def rollback(self, conn):
+        conn.execute(u'ROLLBACK;')
+        conn.execute(u'BEGIN;')
+
+    def create_table(self, cur, table, spec, staging):
+        if staging:
+            cur.execute(u'DROP TABLE IF EXISTS cohd.%s;' % table)
+            cur.execute(u'CREATE TABLE cohd.%s %s;' % (table, _ddl(spec, indexes=False, text_collation=u'NOCASE')))
+        else:
+            cur.execute(u'CREATE TABLE IF NOT EXISTS cohd.%s %s;' % (table, _ddl(spec, indexes=False,
+                                                                                 text_collation=u'NOCASE')))
+            self._create_indexes(cur, table, spec)
+
+    def drop_table(self, cur, table):
+        cur.execute(u'DROP TABLE IF EXISTS cohd.%s;' % table)
+
+    @staticmethod
+    def _create_indexes(cur, table, spec):
+        # Index names are unique per database in SQLite
+        for name, columns in spec[u'indexes']:
+            cur.execute(u'CREATE INDEX IF NOT EXISTS cohd.%s_%s ON %s (%s);' % (table, name, table, u', '.join(columns)))
+
+    def swap(self, conn, tables):
+        """ Replaces the tables with the staging tables and indexes them in one transaction
+
+        :param tables: list of (table, spec)
+        """
+        cur = conn.cursor()
+        for table, spec in tables:
+            cur.execute(u'DROP TABLE IF EXISTS cohd.%s;' % table)
+            cur.execute(u'ALTER TABLE cohd.%s RENAME TO %s;' % (table + _STAGING_SUFFIX, table))
+            if spec[u'indexes']:
+                print u"Adding indexes to %s" % table
+                self._create_indexes(cur, table, spec)
+        self.commit(conn)
+        cur.close()
+
+
+def _init_worker(target):
+    global _worker_target, _worker_conn
+    _worker_target = target
+    _worker_conn = target.connect()
+
+
+def _insert_chunk(task):
+    """ Inserts one chunk of validated rows into a staging table (runs in a worker process)
+
+    :param task: (staging table, column names, rows)
+    :return: Number of rows inserted
+    """
+    table, columns, rows = task
+    return _insert(_worker_target, _worker_conn, table, columns, rows)
+
+
+def _insert(target, conn, table, columns, rows):
+    cur = conn.cursor()
+    cur.executemany(target.sql(u'INSERT INTO cohd.%s (%s) VALUES (%s);' % (
+        table, u', '.join(columns), u', '.join([u'%s'] * len(columns)))), rows)
+    target.commit(conn)
+    cur.close()
+    return len(rows)
+
+
+def _read_rows(path, table, spec, dataset_id, header):
+    """ Streams and validates the rows of a dataset file
+
+    :return: generator of rows ready to insert (with the dataset_id for per-dataset tables)
+    :raises LoadError: after the first _MAX_ERRORS invalid lines, or at the end of the file if any line was invalid
+    """
+    parsers = [_parser(kind, u'NOT NULL' not in sql_type) for _, sql_type, kind in spec[u'columns']]
+    n_columns = len(parsers)
+    prefix = [dataset_id] if spec[u'per_dataset'] else []
+    canonical = table == u'concept_pair_counts'
+    errors = []
+
+    with open(path, u'rb') as f:
+        if f.read(len(codecs.BOM_UTF8)) != codecs.BOM_UTF8:
+            f.seek(0)
+        reader = csv.reader(f, delimiter='\t', quotechar='"', escapechar='\\')
+        for line_number, fields in enumerate(reader, 1):
+            if header and line_number == 1:
+                continue
+            try:
+                if len(fields) != n_columns:
+                    raise ValueError(u'expected %d columns, found %d' % (n_columns, len(fields)))
+                row = []
+                for parse, value, (name, _, _) in zip(parsers, fields, spec[u'columns']):
+                    try:
+                        row.append(parse(value))
+                    except (ValueError, UnicodeError) as e:
+                        raise ValueError(u'%s: %s' % (name, e))
+                if canonical:
+                    if row[0] == row[1]:
+                        raise ValueError(u'concept_id_1 equals concept_id_2')
+                    if row[0] > row[1]:
+                        row[0], row[1] = row[1], row[0]
+            except ValueError as e:
+                errors.append(u'%s:%d: %s' % (os.path.basename(path), reader.line_num, e))
+                if len(errors) >= _MAX_ERRORS:
+                    break
+                continue
+            yield prefix + row
+
+    if errors:
+        raise LoadError(u'\n'.join(errors))
+
+
+def _load_file(target, conn, pool, path, table, spec, dataset_id, header, chunk_size, processes):
+    """ Validates a dataset file and loads it into its staging table in parallel chunks
+
+    :return: Number of rows loaded
+    """
+    columns = _columns(spec)
+    staging = table + _STAGING_SUFFIX
+    start = time.time()
+    n_rows = 0
+    pending = deque()
+
+    def report():
+        elapsed = time.time() - start
+        print u"%s: %d rows, %.0f rows/s" % (table, n_rows, n_rows / max(elapsed, 1e-9))
+
+    chunk = []
+    for row in _read_rows(path, table, spec, dataset_id, header):
+        chunk.append(row)
+        if len(chunk) < chunk_size:
+            continue
+        if pool is None:
+            n_rows += _insert(target, conn, staging, columns, chunk)
+            report()
+        else:
+            # Keep a bounded number of chunks in flight so the file is not read into memory faster than it is loaded
+            pending.append(pool.apply_async(_insert_chunk, [(staging, columns, chunk)]))
+            while len(pending) > 2 * processes:
+                n_rows += pending.popleft().get()
+                report()
+        chunk = []
+    if chunk:
+        if pool is None:
+            n_rows += _insert(target, conn, staging, columns, chunk)
+        else:
+            pending.append(pool.apply_async(_insert_chunk, [(staging, columns, chunk)]))
+    while pending:
+        n_rows += pending.popleft().get()
+
+    elapsed = time.time() - start
+    print u"Loaded %d rows into %s in %.1f s (%.0f rows/s)" % (n_rows, table, elapsed, n_rows / max(elapsed, 1e-9))
+    return n_rows
+
+
+def _build_derived(target, conn, dataset_id, patient_count, concept_table):
+    """ Builds the derived tables of the dataset from the staging tables
+
+    :param concept_table: cohd.concept, or its staging table if concepts are being loaded
+    """
+    cur = conn.cursor()
+    cur.execute(target.sql(u'INSERT INTO cohd.patient_count{s} (dataset_id, count) VALUES (%s, %s);'.format(
+        s=_STAGING_SUFFIX)), [dataset_id, patient_count])
+
+    start = time.time()
+    cur.execute(target.sql(u'''INSERT INTO cohd.concept_pair_adjacency{s}
+            (dataset_id, concept_id, associated_concept_id, concept_count)
+        SELECT dataset_id, concept_id_1, concept_id_2, concept_count
+        FROM cohd.concept_pair_counts{s}
+        WHERE dataset_id = %s
+        UNION ALL
+        SELECT dataset_id, concept_id_2, concept_id_1, concept_count
+        FROM cohd.concept_pair_counts{s}
+        WHERE dataset_id = %s;'''.format(s=_STAGING_SUFFIX)), [dataset_id, dataset_id])
+    print u"Built concept_pair_adjacency in %.1f s" % (time.time() - start)
+
+    cur.execute(target.sql(u'''INSERT INTO cohd.domain_concept_counts{s} (dataset_id, domain_id, count)
+        SELECT cc.dataset_id, c.domain_id, COUNT(*)
+        FROM cohd.concept_counts{s} cc
+        JOIN cohd.{concept} c ON cc.concept_id = c.concept_id
+        WHERE cc.dataset_id = %s
+        GROUP BY cc.dataset_id, c.domain_id;'''.format(s=_STAGING_SUFFIX, concept=concept_table)), [dataset_id])
+
+    start = time.time()
+    cur.execute(target.sql(u'''INSERT INTO cohd.domain_pair_concept_counts{s}
+            (dataset_id, domain_id_1, domain_id_2, count)
+        SELECT dataset_id, domain_id_1, domain_id_2, COUNT(*)
+        FROM (SELECT cp.dataset_id,
+                {least}(c1.domain_id, c2.domain_id) AS domain_id_1,
+                {greatest}(c1.domain_id, c2.domain_id) AS domain_id_2
+            FROM cohd.concept_pair_counts{s} cp
+            JOIN cohd.{concept} c1 ON cp.concept_id_1 = c1.concept_id
+            JOIN cohd.{concept} c2 ON cp.concept_id_2 = c2.concept_id
+            WHERE cp.dataset_id = %s) x
+        GROUP BY dataset_id, domain_id_1, domain_id_2;'''.format(
+        s=_STAGING_SUFFIX, concept=concept_table, least=target.least, greatest=target.greatest)), [dataset_id])
+    print u"Built domain counts in %.1f s" % (time.time() - start)
+    target.commit(conn)
+    cur.close()
+
+
+def _read_patient_count(data_dir):
+    path = os.path.join(data_dir, u'patient_count.txt')
+    if not os.path.exists(path):
+        raise LoadError(u'patient_count.txt not found. Use --patient_count to specify the number of patients.')
+    with open(path) as f:
+        value = f.read().strip()
+    if not value.isdigit():
+        raise LoadError(u'patient_count.txt: expected the number of patients, found %r' % value)
+    return int(value)
+
+
+def load(target, data_dir, dataset_id, patient_count=None, dataset_name=None, dataset_description=None, header=False,
+         processes=None, chunk_size=_CHUNK_SIZE, rebuild_stats=True, snapshot_dir=None):
+    """ Loads one dataset
+
+    :param target: _MySQLTarget or _SQLiteTarget
+    :param data_dir: Directory of the dataset files
+    :param dataset_id: int
+    :param patient_count: Number of patients, or None to read patient_count.txt
+    :param dataset_name: Name of the dataset in cohd.dataset (optional)
+    :param dataset_description: Description of the dataset in cohd.dataset (optional)
+    :param header: True if the files start with a header line
+    :param processes: Number of worker processes (default: number of CPUs)
+    :param chunk_size: Number of rows per inserted chunk
+    :param rebuild_stats: True to rebuild the association statistics of the dataset if concept_pair_stats exists
+    :param snapshot_dir: Directory to re-export the co-occurrence snapshot of the dataset to (optional)
+    :raises LoadError: if a file is missing or invalid. The existing tables are not changed.
+    """
+    files = {table: os.path.join(data_dir, table + u'.txt') for table, spec in _TABLES}
+    loaded = [table for table in (u'concept', u'concept_relationship', u'concept_counts', u'concept_pair_counts')
+              if os.path.exists(files[table])]
+    for table in (u'concept_counts', u'concept_pair_counts'):
+        if table not in loaded:
+            raise LoadError(u'%s not found' % files[table])
+    if patient_count is None:
+        patient_count = _read_patient_count(data_dir)
+
+    staged = [(table, spec) for table, spec in _TABLES if spec[u'per_dataset'] or table in loaded]
+    start = time.time()
+    conn = target.connect()
+    cur = conn.cursor()
+    pool = None
+    try:
+        # Create missing tables, and staging tables with the rows of the other datasets
+        for table, spec in staged:
+            target.create_table(cur, table, spec, staging=False)
+            target.create_table(cur, table + _STAGING_SUFFIX, spec, staging=True)
+            if spec[u'per_dataset']:
+                cur.execute(target.sql(u'INSERT INTO cohd.{staging} ({columns}) SELECT {columns} FROM cohd.{table} '
+                                       u'WHERE dataset_id != %s;'.format(staging=table + _STAGING_SUFFIX, table=table,
+                                                                         columns=u', '.join(_columns(spec)))),
+                            [dataset_id])
+        target.commit(conn)
+
+        if target.parallel:
+            processes = processes or multiprocessing.cpu_count()
+            pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(target,))
+        for table in loaded:
+            try:
+                _load_file(target, conn, pool, files[table], table, _TABLE_SPECS[table], dataset_id, header,
+                           chunk_size, processes)
+            except (pymysql.err.IntegrityError, sqlite3.IntegrityError) as e:
+                raise LoadError(u'%s: duplicate rows (%s)' % (os.path.basename(files[table]), e))
+
+        concept_table = u'concept' + (_STAGING_SUFFIX if u'concept' in loaded else u'')
+        _build_derived(target, conn, dataset_id, patient_count, concept_table)
+
+        target.swap(conn, staged)
+
+        if dataset_name is not None:
+            cur.execute(u'''CREATE TABLE IF NOT EXISTS cohd.dataset (
+                  dataset_id TINYINT NOT NULL,
+                  dataset_name VARCHAR(255) NOT NULL,
+                  dataset_description VARCHAR(255) NOT NULL,
+                  PRIMARY KEY (dataset_id));''')
+            cur.execute(target.sql(u'REPLACE INTO cohd.dataset (dataset_id, dataset_name, dataset_description) '
+                                   u'VALUES (%s, %s, %s);'), [dataset_id, dataset_name, dataset_description or u''])
+            target.commit(conn)
+    except Exception:
+        if pool is not None:
+            pool.terminate()
+            pool = None
+        target.rollback(conn)
+        for table, _ in staged:
+            target.drop_table(cur, table + _STAGING_SUFFIX)
+        target.commit(conn)
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        cur.close()
+        conn.close()
+
+    print u"Loaded dataset %d into %s in %.1f s" % (dataset_id, target.name, time.time() - start)
+
+    _update_derived_data(target, dataset_id, processes, rebuild_stats, snapshot_dir)
+
+
+def _update_derived_data(target, dataset_id, processes, rebuild_stats, snapshot_dir):
+    """ Rebuilds the association statistics and re-exports the co-occurrence snapshot of a loaded dataset """
+    if target.has_association_stats():
+        if rebuild_stats:
+            print u"Rebuilding the association statistics of dataset %d" % dataset_id
+            target.build_association_stats(dataset_id, processes)
+        else:
+            print >> sys.stderr, u"Warning: cohd.concept_pair_stats is out of date for dataset %d. Run " \
+                                 u"build_association_stats.py --dataset_id %d before serving it with " \
+                                 u"ASSOCIATION_STATS_TABLE." % (dataset_id, dataset_id)
+
+    if snapshot_dir is not None:
+        conn = target.backend().connect()
+        try:
+            export_snapshot.export(conn, snapshot_dir, [dataset_id])
+        finally:
+            conn.close()
+    else:
+        print u"If the API serves co-occurrence snapshots, re-export the snapshot of dataset %d with " \
+              u"export_snapshot.py (or use --snapshot_dir)" % dataset_id
+
+    print u"POST to /api/admin/invalidateDataset?dataset_id=%d (or restart the API) to drop the cached data" % \
+        dataset_id
+
+
+if __name__ == u"__main__":
+    parser = argparse.ArgumentParser(description=u'Load a COHD dataset from a directory of tab-separated files')
+    parser.add_argument(u'data_dir', help=u'Directory of the dataset files')
+    parser.add_argument(u'--dataset_id', type=int, required=True, help=u'Dataset to (re)load')
+    parser.add_argument(u'--dataset_name', help=u'Name of the dataset in cohd.dataset')
+    parser.add_argument(u'--dataset_description', help=u'Description of the dataset in cohd.dataset')
+    parser.add_argument(u'--patient_count', type=int, help=u'Number of patients. Default: read patient_count.txt')
+    parser.add_argument(u'--header', action=u'store_true', help=u'The files start with a header line')
+    parser.add_argument(u'--config', default=u'cohd_mysql.cnf', help=u'MySQL option file')
+    parser.add_argument(u'--sqlite', help=u'Load into this SQLite database file instead of MySQL')
+    parser.add_argument(u'--processes', type=int, default=None, help=u'Number of worker processes (MySQL only)')
+    parser.add_argument(u'--chunk_size', type=int, default=_CHUNK_SIZE, help=u'Number of rows per inserted chunk')
+    parser.add_argument(u'--skip_stats', action=u'store_true',
+                        help=u'Do not rebuild the association statistics in cohd.concept_pair_stats (MySQL only)')
+    parser.add_argument(u'--snapshot_dir',
+                        help=u'Re-export the co-occurrence snapshot of the dataset to this directory')
+    arguments = parser.parse_args()
+
+    load_target = _SQLiteTarget(arguments.sqlite) if arguments.sqlite else _MySQLTarget(arguments.config)
+    try:
+        load(load_target, arguments.data_dir, arguments.dataset_id, arguments.patient_count, arguments.dataset_name,
+             arguments.dataset_description, arguments.header, arguments.processes, arguments.chunk_size,
+             not arguments.skip_stats, arguments.snapshot_dir)
+    except LoadError as e:
+        print >> sys.stderr, u"Dataset not loaded:\n%s" % e
+        sys.exit(1)
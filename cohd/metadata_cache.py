@@ -0,0 +1,146 @@
+u"""
+In-memory metadata
+
+Keeps the datasets, domain counts, domain pair counts, patient counts, and vocabularies in memory so that the metadata
+and vocabularies endpoints are answered without a database connection, and the patient counts are available to other
+queries without a lookup. These tables only change when a dataset is loaded. The metadata is loaded when the worker
+starts, dropped when a dataset is invalidated, and checked for changes periodically: the small metadata tables are
+re-read and compared, and the vocabularies (a scan of cohd.concept) are only reloaded if they changed. Results are
+formatted like the corresponding SQL queries in query_cohd_mysql.
+"""
+
+import threading
+import time
+
+# Queries answered from memory: (service, method)
+SERVED_QUERIES = {
+    (u'metadata', u'datasets'),
+    (u'metadata', u'domainCounts'),
+    (u'metadata', u'domainPairCounts'),
+    (u'metadata', u'patientCount'),
+    (u'omop', u'vocabularies'),
+}
+
+_metadata = None
+# Time of the last load or version check
+_checked = 0
+_lock = threading.Lock()
+
+
+class Metadata(object):
+    """ Contents of the metadata tables """
+
+    def __init__(self, datasets, domain_counts, domain_pair_counts, patient_counts, vocabularies):
+        """
+        :param datasets: list of rows of cohd.dataset
+        :param domain_counts: list of rows of cohd.domain_concept_counts
+        :param domain_pair_counts: list of rows of cohd.domain_pair_concept_counts
+        :param patient_counts: list of rows of cohd.patient_count
+        :param vocabularies: list of rows of distinct vocabulary_ids
+        """
+        self.datasets = datasets
+        self.domain_counts = domain_counts
+        self.domain_pair_counts = domain_pair_counts
+        self.patient_counts = patient_counts
+        self.vocabularies = vocabularies
+
+        self._by_dataset = {}
+        for name, rows in ((u'domainCounts', domain_counts), (u'domainPairCounts', domain_pair_counts),
+                           (u'patientCount', patient_counts)):
+            for row in rows:
+                self._by_dataset.setdefault((name, row[u'dataset_id']), []).append(row)
+
+    def version(self):
+        """ The contents of the small metadata tables, which change whenever a dataset is loaded """
+        return self.datasets, self.domain_counts, self.domain_pair_counts, self.patient_counts
+
+    def results(self, service, method, dataset_id):
+        """ Same results as the metadata and vocabularies SQL queries
+
+        :param service: string
+        :param method: string
+        :param dataset_id: int
+        :return: list of rows, or None if the query is not in SERVED_QUERIES
+        """
+        if (service, method) not in SERVED_QUERIES:
+            return None
+        if method == u'datasets':
+            return self.datasets
+        elif method == u'vocabularies':
+            return self.vocabularies
+        return self._by_dataset.get((method, dataset_id), [])
+
+    def patient_count(self, dataset_id):
+        """ Number of patients in the dataset
+
+        :param dataset_id: int
+        :return: int, or None if the dataset does not exist
+        """
+        rows = self._by_dataset.get((u'patientCount', dataset_id))
+        return rows[0][u'count'] if rows else None
+
+
+def _load_tables(cur):
+    """ Reads the small metadata tables
+
+    :return: (datasets, domain_counts, domain_pair_counts, patient_counts)
+    """
+    tables = []
+    for sql in ('''SELECT * FROM cohd.dataset ORDER BY dataset_id;''',
+                '''SELECT * FROM cohd.domain_concept_counts ORDER BY dataset_id, domain_id;''',
+                '''SELECT * FROM cohd.domain_pair_concept_counts ORDER BY dataset_id, domain_id_1, domain_id_2;''',
+                '''SELECT * FROM cohd.patient_count ORDER BY dataset_id;'''):
+        cur.execute(sql)
+        tables.append(list(cur.fetchall()))
+    return tuple(tables)
+
+
+def due(check_interval):
+    """ Whether the metadata needs to be loaded or checked for changes
+
+    :param check_interval: Seconds between version checks, or None to never check
+    :return: boolean
+    """
+    return _metadata is None or (check_interval is not None and time.time() - _checked >= check_interval)
+
+
+def refresh(conn, check_interval):
+    """ Loads the metadata, or reloads it if the metadata tables have changed
+
+    :param conn: pymysql connection (DictCursor)
+    :param check_interval: Seconds between version checks, or None to never check
+    :return: Metadata
+    """
+    global _metadata, _checked
+
+    with _lock:
+        # Another thread may have checked the metadata while we were waiting
+        if not due(check_interval):
+            return _metadata
+
+        cur = conn.cursor()
+        try:
+            tables = _load_tables(cur)
+            if _metadata is None or _metadata.version() != tables:
+                print u"Loading metadata"
+                cur.execute('''SELECT DISTINCT vocabulary_id FROM concept;''')
+                _metadata = Metadata(*(tables + (list(cur.fetchall()),)))
+        finally:
+            cur.close()
+        _checked = time.time()
+        return _metadata
+
+
+def get_metadata():
+    """ The loaded metadata, without loading or checking it
+
+    :return: Metadata, or None if not loaded
+    """
+    return _metadata
+
+
+def clear():
+    """ Drops the metadata so that it is reloaded on next use """
+    global _metadata
+    with _lock:
+        _metadata = None
@@ -1,9 +1,31 @@
+import os
+import threading
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 import requests
 from numpy import argsort
+from oxo_cache import OxoCache, CircuitBreaker, CircuitOpen
+import concept_dictionary
+import request_metrics
 
 # OXO API configuration
 _URL_OXO_SEARCH = u'https://www.ebi.ac.uk/spot/oxo/api/search'
+# Seconds to wait for OxO to respond (connect and read)
+_oxo_timeout = 10
+# OxO search results, cached in memory only until configure_oxo sets a file
+_oxo_cache = OxoCache()
+_oxo_breaker = CircuitBreaker()
+# Concurrent OxO searches for multi-concept xrefFromOMOP: CURIEs per search, number of threads, and overall deadline
+_OXO_FANOUT_CHUNK_SIZE = 50
+_oxo_workers = 4
+_oxo_deadline = 30
+_oxo_pool = None
+_oxo_pool_pid = None
+_oxo_pool_lock = threading.Lock()
 _OXO_OMOP_MAPPING_TARGETS = [u'ICD9CM', u'ICD10CM', u'SNOMEDCT', u'MeSH']
+# Maximum number of CURIEs sent in one OxO search
+_OXO_SEARCH_MAX_IDS = 500
 _OXO_OMOP_VOCABULARIES = [u'ICD9CM', u'ICD10CM', u'SNOMED', u'MeSH']
 _OXO_PREFIX_TO_OMOP_VOCAB = {
     u'ICD9CM': u'ICD9CM',
@@ -36,10 +58,17 @@ def omop_vocab_to_oxo_prefix(vocab):
 def omop_concept_lookup(cur, concept_id):
     """ Look up concept info
 
+    Served from the concept dictionary if it is loaded (see CONCEPT_DICTIONARY in query_cohd_mysql)
+
     :param cur: SQL cursor
     :param concept_id: int - concept_id
     :return: row from concept table
     """
+    dictionary = concept_dictionary.loaded()
+    if dictionary is not None:
+        row = dictionary.lookup(int(concept_id))
+        return [row] if row is not None else []
+
     sql = '''SELECT *
         FROM cohd.concept
         WHERE concept_id = %(concept_id)s;'''
@@ -83,6 +112,108 @@ def omop_map_to_standard(cur, concept_code, vocabulary_id=None):
     return cur.fetchall()
 
 
+def omop_map_codes_to_standard(cur, codes):
+    """ OMOP map from many concept codes to standard concept_ids in one query
+
+    :param cur: sql cursor
+    :param codes: List of (vocabulary_id, concept_code) tuples
+    :return: dict - (vocabulary_id, concept_code) in lowercase -> list of mappings to standard concept_id
+    """
+    mappings = {}
+    if len(codes) == 0:
+        return mappings
+
+    # Group the codes by vocabulary so that each group can use the (concept_code, vocabulary_id) index
+    codes_by_vocab = {}
+    for vocabulary_id, concept_code in codes:
+        codes_by_vocab.setdefault(vocabulary_id, set()).add(concept_code)
+    conditions = []
+    params = []
+    for vocabulary_id, concept_codes in codes_by_vocab.items():
+        conditions.append('(c1.vocabulary_id = %%s AND c1.concept_code IN (%s))' %
+                          ','.join(['%s' for _ in concept_codes]))
+        params.append(vocabulary_id)
+        params += list(concept_codes)
+
+    sql = '''SELECT
+                c1.concept_id AS source_concept_id,
+                c1.concept_code AS source_concept_code,
+                c1.concept_name AS source_concept_name,
+                c1.vocabulary_id AS source_vocabulary_id,
+                c2.concept_id AS standard_concept_id,
+                c2.concept_name AS standard_concept_name,
+                c2.domain_id AS standard_domain_id
+            FROM concept c1
+            JOIN concept_relationship cr ON c1.concept_id = cr.concept_id_1
+            JOIN concept c2 ON cr.concept_id_2 = c2.concept_id
+            WHERE relationship_id = 'Maps to' AND (%s);''' % ' OR '.join(conditions)
+
+    cur.execute(sql, params)
+    for row in cur.fetchall():
+        # MySQL compares codes case-insensitively
+        key = (row[u'source_vocabulary_id'].lower(), row[u'source_concept_code'].lower())
+        mappings.setdefault(key, []).append(row)
+    return mappings
+
+
+def omop_concepts_lookup(cur, concept_ids):
+    """ Look up info of many concepts in one query
+
+    :param cur: SQL cursor
+    :param concept_ids: List of int - concept_ids
+    :return: dict - concept_id -> row from concept table
+    """
+    if len(concept_ids) == 0:
+        return {}
+
+    sql = '''SELECT *
+        FROM cohd.concept
+        WHERE concept_id IN (%s);''' % ','.join(['%s' for _ in concept_ids])
+    cur.execute(sql, list(concept_ids))
+    return {row[u'concept_id']: row for row in cur.fetchall()}
+
+
+def omop_map_from_standard_concepts(cur, concept_ids, vocabularies=None):
+    """ OMOP map from many standard concept_ids to concept codes in one query
+
+    :param cur: sql cursor
+    :param concept_ids: List of int
+    :param vocabularies: List of strings - target vocabularies to map to
+    :return: dict - concept_id -> list of mappings, ordered as in omop_map_from_standard
+    """
+    mappings = {concept_id: [] for concept_id in concept_ids}
+    if len(concept_ids) == 0:
+        return mappings
+
+    sql = '''SELECT
+            cr.concept_id_2 AS standard_concept_id,
+            c.concept_id,
+            c.concept_code,
+            c.concept_name,
+            c.domain_id,
+            c.vocabulary_id,
+            c.concept_class_id,
+            c.standard_concept
+        FROM concept_relationship cr
+        JOIN concept c ON cr.concept_id_1 = c.concept_id
+        WHERE cr.concept_id_2 IN (%s) AND relationship_id = 'Maps to'
+        ''' % ','.join(['%s' for _ in concept_ids])
+    params = list(concept_ids)
+
+    # Restrict by vocabulary_id if specified
+    if vocabularies is not None and len(vocabularies) > 0:
+        sql += '''    AND c.vocabulary_id IN (%s)
+            ''' % ','.join(['%s' for _ in vocabularies])
+        params += vocabularies
+
+    sql += 'ORDER BY c.vocabulary_id ASC, c.concept_code ASC;'
+
+    cur.execute(sql, params)
+    for row in cur.fetchall():
+        mappings[row.pop(u'standard_concept_id')].append(row)
+    return mappings
+
+
 def omop_map_from_standard(cur, concept_id, vocabularies=None):
     """ OMOP map from standard concept_id to concept codes
 
@@ -122,28 +253,199 @@ def omop_map_from_standard(cur, concept_id, vocabularies=None):
     return results
 
 
-def oxo_search(ids, input_source=None, mapping_targets=[], distance=2):
+class OxoUnavailable(Exception):
+    """ Raised when OxO fails, times out, or is suspended by the circuit breaker, and no cached result exists """
+    pass
+
+
+def configure_oxo(app_config):
+    """ Configures the OxO URL, timeout, cache, and circuit breaker from the Flask configuration
+
+    OXO_URL: URL of the OxO search method (e.g., a local stub server for testing)
+    OXO_TIMEOUT: seconds to wait for OxO
+    OXO_CACHE_FILE: SQLite file for persisting OxO results across restarts (in-memory only if not set)
+    OXO_CACHE_TTL: seconds before a cached result is refreshed. Stale results are still served if OxO is unavailable.
+    OXO_CACHE_MEMORY_SIZE: number of results kept in memory
+    OXO_CIRCUIT_FAILURES: consecutive failures after which calls to OxO are suspended
+    OXO_CIRCUIT_RESET: seconds before calls to OxO are retried
+    OXO_WORKERS: number of concurrent OxO searches for multi-concept xrefFromOMOP
+    OXO_DEADLINE: seconds after which multi-concept xrefFromOMOP returns partial results
+
+    :param app_config: Flask configuration
+    """
+    global _URL_OXO_SEARCH, _oxo_timeout, _oxo_cache, _oxo_breaker, _oxo_workers, _oxo_deadline
+    _URL_OXO_SEARCH = app_config.get(u'OXO_URL', _URL_OXO_SEARCH)
+    _oxo_timeout = app_config.get(u'OXO_TIMEOUT', _oxo_timeout)
+    _oxo_cache = OxoCache(path=app_config.get(u'OXO_CACHE_FILE'),
+                          ttl=app_config.get(u'OXO_CACHE_TTL', _oxo_cache.ttl),
+                          memory_size=app_config.get(u'OXO_CACHE_MEMORY_SIZE', _oxo_cache.memory_size))
+    _oxo_breaker = CircuitBreaker(failure_threshold=app_config.get(u'OXO_CIRCUIT_FAILURES', 5),
+                                  reset_timeout=app_config.get(u'OXO_CIRCUIT_RESET', 30))
+    _oxo_workers = app_config.get(u'OXO_WORKERS', _oxo_workers)
+    _oxo_deadline = app_config.get(u'OXO_DEADLINE', _oxo_deadline)
+
+
+def oxo_status():
+    """ State of the OxO circuit breaker for monitoring
+
+    :return: dict
+    """
+    return {
+        u'url': _URL_OXO_SEARCH,
+        u'timeout': _oxo_timeout,
+        u'circuit': _oxo_breaker.state(),
+        u'cache_file': _oxo_cache.path
+    }
+
+
+def oxo_search(ids, input_source=None, mapping_targets=[], distance=2, deadline=None):
     """ Wrapper to the OxO search method.
 
+    Results are served from the cache while fresh. If OxO fails, a stale cached result is returned if available.
+
     :param ids: List of strings - CURIEs to search for
     :param input_source: String
     :param mapping_targets: List of strings - Prefixes for target ontologies
     :param distance: Integer [1-3], default=2
+    :param deadline: time.time() after which the result is no longer needed (optional). OxO is not called after the
+                     deadline, and is given at most the time left before it to respond.
     :return: JSON return from /oxo/api/search
+    :raises OxoUnavailable: if OxO could not be reached and the result is not cached, or the deadline has passed
     """
+    key = OxoCache.key(ids, input_source, mapping_targets, distance)
+    json_return = _oxo_cache.get(key)
+    if json_return is not None:
+        return json_return
+
+    timeout = _oxo_timeout
+    if deadline is not None:
+        timeout = min(timeout, deadline - time.time())
+        if timeout <= 0:
+            raise OxoUnavailable(u'OxO search deadline passed')
+
     # Call OXO search to map from the CURIE to vocabularies that OMOP knows
     data = {
         "ids": ids,
         "inputSource": input_source,
         "mappingTarget": mapping_targets,
-        "distance": distance
+        "distance": distance,
+        "size": len(ids)
     }
 
-    r = requests.post(url=_URL_OXO_SEARCH, data=data)
-    json_return = r.json()
+    try:
+        _oxo_breaker.before_call()
+        try:
+            with request_metrics.phase(u'oxo'):
+                r = requests.post(url=_URL_OXO_SEARCH, data=data, timeout=timeout)
+            r.raise_for_status()
+            json_return = r.json()
+        except (requests.exceptions.RequestException, ValueError):
+            _oxo_breaker.failure()
+            raise
+        _oxo_breaker.success()
+    except (CircuitOpen, requests.exceptions.RequestException, ValueError) as e:
+        print u"OxO error: ", e
+        json_return = _oxo_cache.get(key, allow_stale=True)
+        if json_return is None:
+            raise OxoUnavailable(e)
+        return json_return
+
+    _oxo_cache.put(key, json_return)
     return json_return
 
 
+def oxo_search_results(ids, input_source=None, mapping_targets=[], distance=2, deadline=None):
+    """ OxO search results of any number of CURIEs, searched in chunks of at most _OXO_SEARCH_MAX_IDS
+
+    :param ids: List of strings - CURIEs to search for
+    :param input_source: String
+    :param mapping_targets: List of strings - Prefixes for target ontologies
+    :param distance: Integer [1-3], default=2
+    :param deadline: time.time() after which the results are no longer needed (optional, see oxo_search)
+    :return: List of search results in the same order as ids (None where OxO returned no result)
+    """
+    search_results = []
+    for start in range(0, len(ids), _OXO_SEARCH_MAX_IDS):
+        chunk = ids[start:start + _OXO_SEARCH_MAX_IDS]
+        j = oxo_search(chunk, input_source, mapping_targets, distance, deadline)
+        results = j.get(u'_embedded', {}).get(u'searchResults', [])
+        if len(results) == len(chunk):
+            # OxO returns the results in the order of the ids
+            search_results += results
+        else:
+            results_by_id = {result[u'queryId']: result for result in results}
+            search_results += [results_by_id.get(curie) for curie in chunk]
+    return search_results
+
+
+def xref_to_omop_standard_concepts(cur, curies, distance=2):
+    """ Map many CURIEs from external ontologies to OMOP
+
+    Same as xref_to_omop_standard_concept, but all CURIEs are searched in OxO together and all intermediate codes are
+    mapped to standard concepts in one query
+
+    :param cur: SQL cursor
+    :param curies: List of strings - CURIEs (e.g., ['DOID:8398', 'DOID:1612'])
+    :param distance: Integer - OxO distance parameter [1-3], default=2
+    :return: dict - CURIE -> list of mappings
+    """
+    # Call OxO to map to vocabularies that OMOP knows
+    curies = list(curies)
+    search_results = oxo_search_results(curies, mapping_targets=_OXO_OMOP_MAPPING_TARGETS, distance=distance)
+
+    # Collect the intermediate codes of all CURIEs
+    intermediates = []
+    for search_result in search_results:
+        mrl = search_result[u'mappingResponseList'] if search_result is not None else []
+        for mr in mrl:
+            prefix, concept_code = mr[u'curie'].split(u':', 1)
+
+            # Determine the corresponding vocabulary_id
+            vocabulary_id = _OXO_PREFIX_TO_OMOP_VOCAB.get(prefix)
+            if vocabulary_id is None:
+                # Conversion from OxO prefix to OMOP vocabulary_id is unknown
+                continue
+            intermediates.append((vocabulary_id, concept_code))
+
+    # Map all intermediate codes to standard concept_ids using OMOP concept_relationship 'Maps to'
+    standard_mappings = omop_map_codes_to_standard(cur, intermediates)
+
+    xrefs = {}
+    for curie, search_result in zip(curies, search_results):
+        mappings = []
+        total_distances = []
+        mrl = search_result[u'mappingResponseList'] if search_result is not None else []
+        for mr in mrl:
+            prefix, concept_code = mr[u'curie'].split(u':', 1)
+            vocabulary_id = _OXO_PREFIX_TO_OMOP_VOCAB.get(prefix)
+            if vocabulary_id is None:
+                continue
+
+            for result in standard_mappings.get((vocabulary_id.lower(), concept_code.lower()), []):
+                omop_distance = int(result[u'source_concept_id'] != result[u'standard_concept_id'])
+                oxo_distance = mr[u'distance']
+                total_distance = omop_distance + oxo_distance
+                mapping = {
+                    u'source_oxo_id': search_result[u'queryId'],
+                    u'source_oxo_label': search_result[u'label'],
+                    u'intermediate_oxo_id': mr[u'curie'],
+                    u'intermediate_oxo_label': mr[u'label'],
+                    u'oxo_distance': oxo_distance,
+                    u'omop_standard_concept_id': result[u'standard_concept_id'],
+                    u'omop_concept_name': result[u'standard_concept_name'],
+                    u'omop_domain_id': result[u'standard_domain_id'],
+                    u'omop_distance': omop_distance,
+                    u'total_distance': total_distance
+                }
+                mappings.append(mapping)
+                total_distances.append(total_distance)
+
+        # Sort the list of mappings by total distance
+        xrefs[curie] = [mappings[i] for i in argsort(total_distances, kind=u'mergesort')]
+
+    return xrefs
+
+
 def xref_to_omop_standard_concept(cur, curie, distance=2):
     """ Map from external ontologies to OMOP
 
@@ -155,49 +457,142 @@ def xref_to_omop_standard_concept(cur, curie, distance=2):
     :param distance: Integer - OxO distance parameter [1-3], default=2
     :return: List of mappings
     """
+    return xref_to_omop_standard_concepts(cur, [curie], distance)[curie]
 
-    mappings = []
-    total_distances = []
 
-    # Call OxO to map to a vocabulary that OMOP knows
-    j = oxo_search([curie], mapping_targets=_OXO_OMOP_MAPPING_TARGETS, distance=distance)
-    search_result = j[u'_embedded'][u'searchResults'][0]
-    mrl = search_result[u'mappingResponseList']
-
-    # Map each OxO mapping using OMOP concept_relationship 'Maps_to'
-    for mr in mrl:
-        prefix, concept_code = mr[u'curie'].split(u':')
-
-        # Determine the corresponding vocabulary_id
-        vocabulary_id = _OXO_PREFIX_TO_OMOP_VOCAB.get(prefix)
-        if prefix is None:
-            # Conversion from OxO prefix to OMOP vocabulary_id is unknown
+def _get_oxo_pool():
+    # Threads do not survive a fork, so each worker process creates its own pool on first use
+    global _oxo_pool, _oxo_pool_pid
+    with _oxo_pool_lock:
+        if _oxo_pool is None or _oxo_pool_pid != os.getpid():
+            _oxo_pool = ThreadPool(_oxo_workers)
+            _oxo_pool_pid = os.getpid()
+        return _oxo_pool
+
+
+def oxo_search_concurrent(ids, mapping_targets=[], distance=2):
+    """ OxO search results of many CURIEs, searched in chunks concurrently with an overall deadline
+
+    :param ids: List of strings - CURIEs to search for
+    :param mapping_targets: List of strings - Prefixes for target ontologies
+    :param distance: Integer [1-3], default=2
+    :return: (dict - CURIE -> search result, boolean - True if some chunks timed out or failed)
+    :raises OxoUnavailable: if no chunk succeeded
+    """
+    if len(ids) == 0:
+        return {}, False
+
+    pool = _get_oxo_pool()
+    deadline = time.time() + _oxo_deadline
+    chunks = [ids[start:start + _OXO_FANOUT_CHUNK_SIZE] for start in range(0, len(ids), _OXO_FANOUT_CHUNK_SIZE)]
+    # Each search is bounded by the deadline, so that searches that missed it do not hold up the pool for later requests
+    pending = [(chunk, pool.apply_async(oxo_search_results, (chunk, None, mapping_targets, distance, deadline)))
+               for chunk in chunks]
+
+    search_results = {}
+    failures = 0
+    error = None
+    for chunk, pending_result in pending:
+        try:
+            # Searches still running after the deadline stop calling OxO once the deadline has passed
+            with request_metrics.phase(u'oxo'):
+                chunk_results = pending_result.get(max(deadline - time.time(), 0))
+        except (TimeoutError, OxoUnavailable) as e:
+            failures += 1
+            error = e
             continue
+        search_results.update((curie, result) for curie, result in zip(chunk, chunk_results) if result is not None)
 
-        # Map to the standard concept_id
-        results = omop_map_to_standard(cur, concept_code, vocabulary_id)
-        for result in results:
-            omop_distance = int(result[u'source_concept_id'] != result[u'standard_concept_id'])
-            oxo_distance = mr[u'distance']
-            total_distance = omop_distance + oxo_distance
-            mapping = {
-                u'source_oxo_id': search_result[u'queryId'],
-                u'source_oxo_label': search_result[u'label'],
-                u'intermediate_oxo_id': mr[u'curie'],
-                u'intermediate_oxo_label': mr[u'label'],
-                u'oxo_distance': oxo_distance,
-                u'omop_standard_concept_id': result[u'standard_concept_id'],
-                u'omop_concept_name': result[u'standard_concept_name'],
-                u'omop_domain_id': result[u'standard_domain_id'],
-                u'omop_distance': omop_distance,
-                u'total_distance': total_distance
-            }
-            mappings.append(mapping)
-            total_distances.append(total_distance)
+    if failures == len(chunks):
+        raise OxoUnavailable(error)
+    return search_results, failures > 0
 
-    # Sort the list of mappings by total distance
-    mappings_sorted = [mappings[i] for i in argsort(total_distances)]
-    return mappings_sorted
+
+def xref_from_omop_standard_concepts(cur, concept_ids, mapping_targets=[], distance=2):
+    """ Map many OMOP concepts to external ontologies
+
+    Same as xref_from_omop_standard_concept, but the OMOP lookups for all concepts are done in set-based queries, and
+    the OxO searches are split into chunks that run concurrently. If some chunks do not finish before the deadline
+    (OXO_DEADLINE) or fail, the mappings found by the others are returned.
+
+    :param cur: SQL cursor
+    :param concept_ids: List of int - OMOP standard concept_ids
+    :param mapping_targets: List of string - target ontology prefixes
+    :param distance: OxO distance
+    :return: (dict - concept_id -> list of mappings, boolean - True if the results are partial)
+    """
+    source_infos = omop_concepts_lookup(cur, concept_ids)
+    omop_mappings_by_concept = omop_map_from_standard_concepts(cur, source_infos.keys(), _OXO_OMOP_VOCABULARIES)
+
+    # The intermediate CURIEs of each concept, and all distinct CURIEs
+    intermediates_by_concept = {}
+    curies = []
+    curies_set = set()
+    for concept_id, source_info in source_infos.items():
+        omop_mappings = omop_mappings_by_concept[concept_id]
+
+        # Add the source concept definition if not already in OMOP mappings (e.g., source concept is not a standard
+        # concept)
+        found_source = any(omop_mapping[u'concept_id'] == concept_id for omop_mapping in omop_mappings)
+        if not found_source and source_info[u'vocabulary_id'] in _OMOP_VOCAB_TO_OXO_PREFIX:
+            omop_mappings = omop_mappings + [source_info]
+
+        intermediates = []
+        for omop_mapping in omop_mappings:
+            curie = omop_vocab_to_oxo_prefix(omop_mapping[u'vocabulary_id']) + ':' + omop_mapping[u'concept_code']
+            intermediates.append((omop_mapping, curie))
+            if curie not in curies_set:
+                curies.append(curie)
+                curies_set.add(curie)
+        intermediates_by_concept[concept_id] = intermediates
+
+    # Call OxO to map to the target ontologies
+    search_results, partial = oxo_search_concurrent(curies, mapping_targets, distance)
+
+    # Combine OxO mappings with OMOP mappings
+    xrefs = {}
+    for concept_id in concept_ids:
+        if concept_id not in source_infos:
+            # concept_id not found, return empty results
+            xrefs[concept_id] = []
+            continue
+        source_info = source_infos[concept_id]
+
+        mappings = []
+        total_distances = []
+        for omop_mapping, curie in intermediates_by_concept[concept_id]:
+            search_result = search_results.get(curie)
+            if search_result is None:
+                continue
+
+            omop_distance = int(omop_mapping[u'concept_id'] != concept_id)
+            for mr in search_result[u'mappingResponseList']:
+                oxo_distance = mr[u'distance']
+                total_distance = omop_distance + oxo_distance
+                mapping = {
+                    u'source_omop_concept_id': concept_id,
+                    u'source_omop_concept_name': source_info[u'concept_name'],
+                    u'source_omop_vocabulary_id': source_info[u'vocabulary_id'],
+                    u'source_omop_concept_code': source_info[u'concept_code'],
+                    u'intermediate_omop_concept_id': omop_mapping[u'concept_id'],
+                    u'intermediate_omop_vocabulary_id': omop_mapping[u'vocabulary_id'],
+                    u'intermediate_omop_concept_code': omop_mapping[u'concept_code'],
+                    u'intermediate_omop_concept_name': omop_mapping[u'concept_name'],
+                    u'omop_distance': omop_distance,
+                    u'intermediate_oxo_curie': search_result[u'curie'],
+                    u'intermediate_oxo_label': search_result[u'label'],
+                    u'target_curie': mr[u'curie'],
+                    u'target_label': mr[u'label'],
+                    u'oxo_distance': oxo_distance,
+                    u'total_distance': total_distance
+                }
+                mappings.append(mapping)
+                total_distances.append(total_distance)
+
+        # sort the mappings by total distance
+        xrefs[concept_id] = [mappings[i] for i in argsort(total_distances, kind=u'mergesort')]
+
+    return xrefs, partial
 
 
 def xref_from_omop_standard_concept(cur, concept_id, mapping_targets=[], distance=2):
@@ -0,0 +1,157 @@
+u"""
+Caching and failure isolation for calls to the EBI OxO API
+
+OxO search results are cached on disk in SQLite, with a small in-memory LRU in front, so that repeated cross-reference
+lookups do not wait on EBI. A circuit breaker stops calling OxO for a while after repeated failures so that requests
+fail (or fall back to stale cache entries) immediately instead of each waiting for the timeout.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class OxoCache(object):
+    """ OxO search results cached in memory (LRU) and optionally in a SQLite file, with a TTL """
+
+    def __init__(self, path=None, ttl=30 * 24 * 3600, memory_size=1000):
+        """ Create a new cache
+
+        :param path: SQLite file for the persistent cache (None for in-memory only)
+        :param ttl: float - Seconds after which an entry is stale
+        :param memory_size: int - Number of entries kept in memory
+        """
+        self.path = path
+        self.ttl = ttl
+        self.memory_size = memory_size
+
+        self._lock = threading.Lock()
+        # key -> (time stored, result), least recently used first
+        self._memory = OrderedDict()
+        self._db = None
+        self._pid = None
+
+    @staticmethod
+    def key(ids, input_source, mapping_targets, distance):
+        """ Cache key of an OxO search. The order of ids is kept since results are returned in the same order. """
+        return json.dumps([list(ids), input_source, list(mapping_targets), distance])
+
+    def _connect(self):
+        # One connection per process. SQLite connections must not be shared across a fork.
+        if self._pid != os.getpid():
+            self._db = sqlite3.connect(self.path, timeout=1, check_same_thread=False)
+            self._db.execute('''CREATE TABLE IF NOT EXISTS oxo_search (
+                    key TEXT PRIMARY KEY,
+                    result TEXT NOT NULL,
+                    created REAL NOT NULL);''')
+            self._db.commit()
+            self._pid = os.getpid()
+        return self._db
+
+    def _remember(self, key, created, result):
+        self._memory.pop(key, None)
+        self._memory[key] = (created, result)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def get(self, key, allow_stale=False):
+        """ Look up a search result
+
+        :param key: Key from OxoCache.key
+        :param allow_stale: True to also return entries older than the TTL
+        :return: result, or None
+        """
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None and self.path is not None:
+                try:
+                    row = self._connect().execute('''SELECT created, result FROM oxo_search WHERE key = ?;''',
+                                                  [key]).fetchone()
+                except sqlite3.Error as e:
+                    print u"OxO cache error: ", e
+                    row = None
+                if row is not None:
+                    entry = (row[0], json.loads(row[1]))
+            if entry is None:
+                return None
+
+            self._remember(key, entry[0], entry[1])
+            if not allow_stale and time.time() - entry[0] >= self.ttl:
+                return None
+            return entry[1]
+
+    def put(self, key, result):
+        """ Cache a search result
+
+        :param key: Key from OxoCache.key
+        :param result: JSON-serializable result
+        """
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, result)
+            if self.path is not None:
+                try:
+                    db = self._connect()
+                    db.execute('''INSERT OR REPLACE INTO oxo_search (key, result, created) VALUES (?, ?, ?);''',
+                               [key, json.dumps(result), now])
+                    db.commit()
+                except sqlite3.Error as e:
+                    print u"OxO cache error: ", e
+
+
+class CircuitOpen(Exception):
+    """ Raised when calls are refused because of recent failures """
+    pass
+
+
+class CircuitBreaker(object):
+    """ Refuses calls for reset_timeout seconds after failure_threshold consecutive failures
+
+    After the timeout, a single trial call is let through. Success closes the circuit, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened = None
+        self._trial = False
+
+    def before_call(self):
+        """ Check whether a call may be made
+
+        :raises CircuitOpen: if the circuit is open
+        """
+        with self._lock:
+            if self._opened is None:
+                return
+            if not self._trial and time.time() - self._opened >= self.reset_timeout:
+                # Half-open: let one trial call through
+                self._trial = True
+                return
+            raise CircuitOpen(u'Calls suspended after %d consecutive failures' % self._failures)
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial or self._failures >= self.failure_threshold:
+                self._opened = time.time()
+                self._trial = False
+
+    def state(self):
+        """ closed, open, or half-open """
+        with self._lock:
+            if self._opened is None:
+                return u'closed'
+            return u'half-open' if self._trial else u'open'
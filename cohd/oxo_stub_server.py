@@ -0,0 +1,124 @@
+u"""
+Local stub of the OxO search API for testing
+
+Serves POST /spot/oxo/api/search with deterministic fake mappings, so that xrefToOMOP and xrefFromOMOP can be exercised
+without EBI. Latency and failures can be injected to test the OxO timeout, cache, and circuit breaker. Point COHD at it
+by setting OXO_URL in cohd_flask.conf.
+
+Usage:
+    python oxo_stub_server.py [--port 8099] [--delay 0] [--fail-rate 0]
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+_SEARCH_PATH = u'/spot/oxo/api/search'
+_DEFAULT_TARGETS = [u'ICD9CM', u'ICD10CM', u'SNOMEDCT', u'MeSH', u'DOID', u'UMLS']
+
+
+def _fake_code(curie, target):
+    # Deterministic code so that repeated searches return the same mappings
+    return str(int(hashlib.md5((curie + u'|' + target).encode(u'utf8')).hexdigest()[:8], 16) % 1000000)
+
+
+def search_results(ids, mapping_targets, distance):
+    """ Fake OxO search response: one mapping per target for each id, at distances up to the requested distance
+
+    :param ids: list of CURIEs
+    :param mapping_targets: list of target prefixes (all known targets if empty)
+    :param distance: int
+    :return: dict in the format of /oxo/api/search
+    """
+    results = []
+    for curie in ids:
+        prefix = curie.split(u':')[0]
+        mappings = []
+        for k, target in enumerate(mapping_targets or _DEFAULT_TARGETS):
+            if target == prefix:
+                continue
+            mapping_distance = k % distance + 1
+            target_curie = u'%s:%s' % (target, _fake_code(curie, target))
+            mappings.append({
+                u'curie': target_curie,
+                u'label': u'Stub mapping of %s to %s' % (curie, target),
+                u'sourcePrefixes': [u'STUB'],
+                u'targetPrefix': target,
+                u'distance': mapping_distance
+            })
+        results.append({
+            u'queryId': curie,
+            u'querySource': None,
+            u'curie': curie,
+            u'label': u'Stub term %s' % curie,
+            u'mappingResponseList': mappings
+        })
+    return {
+        u'_embedded': {u'searchResults': results},
+        u'page': {u'size': len(results), u'totalElements': len(results), u'totalPages': 1, u'number': 0}
+    }
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    delay = 0
+    fail_rate = 0
+
+    def do_POST(self):
+        if urlparse.urlparse(self.path).path != _SEARCH_PATH:
+            self.send_error(404)
+            return
+
+        time.sleep(self.delay)
+        if random.random() < self.fail_rate:
+            self.send_error(500)
+            return
+
+        length = int(self.headers.getheader(u'content-length', 0))
+        form = urlparse.parse_qs(self.rfile.read(length))
+        try:
+            distance = int(form.get(u'distance', [2])[0])
+        except ValueError:
+            distance = 2
+        body = json.dumps(search_results(form.get(u'ids', []), form.get(u'mappingTarget', []), max(distance, 1)))
+
+        self.send_response(200)
+        self.send_header(u'Content-Type', u'application/json')
+        self.send_header(u'Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_server(port=8099, delay=0, fail_rate=0):
+    """ Creates a stub OxO server on localhost. Call serve_forever() to run it.
+
+    :param port: int
+    :param delay: float - Seconds to wait before each response
+    :param fail_rate: float - Fraction of requests answered with HTTP 500
+    :return: StubServer
+    """
+    class Handler(_StubHandler):
+        pass
+    Handler.delay = delay
+    Handler.fail_rate = fail_rate
+    return StubServer((u'localhost', port), Handler)
+
+
+if __name__ == u"__main__":
+    parser = argparse.ArgumentParser(description=u'Local stub of the OxO search API')
+    parser.add_argument(u'--port', type=int, default=8099)
+    parser.add_argument(u'--delay', type=float, default=0, help=u'seconds to wait before each response')
+    parser.add_argument(u'--fail-rate', type=float, default=0, help=u'fraction of requests answered with HTTP 500')
+    args = parser.parse_args()
+
+    server = make_server(args.port, args.delay, args.fail_rate)
+    print u"OxO stub listening on http://localhost:%d%s" % (args.port, _SEARCH_PATH)
+    server.serve_forever()
@@ -1,18 +1,125 @@
+import ConfigParser
+import base64
+import json
+from collections import OrderedDict
+import numpy as np
 import pymysql
-from flask import jsonify
-from scipy.stats import chisquare
-from numpy import argsort
+from flask import jsonify, json as flask_json, Response
+from connection_pool import ConnectionPool, PoolTimeout
+from storage_backends import create_backend
+import cooccurrence
+import concept_search
+import concept_dictionary
+import metadata_cache
+import request_metrics
+import slow_query_log
+import response_formats
+from association_stats import chi_square, ln_ratio, rank_descending, page_mask
 from omop_xref import xref_to_omop_standard_concept, omop_map_to_standard, omop_map_from_standard, \
-    xref_from_omop_standard_concept
+    xref_from_omop_standard_concept, configure_oxo, OxoUnavailable, xref_to_omop_standard_concepts, \
+    xref_from_omop_standard_concepts
 
 # Configuration
 # log-in credentials for database
 CONFIG_FILE = u"cohd_mysql.cnf"
 DEFAULT_DATASET_ID = 1
 
+# Connection pool configuration. Defaults may be overridden in the [cohd_pool] section of CONFIG_FILE, which in turn
+# may be overridden by the MYSQL_POOL_* settings in cohd_flask.conf
+_POOL_CONFIG_SECTION = u'cohd_pool'
+_POOL_DEFAULTS = {
+    u'size': 5,
+    u'max_uses': 1000,
+    u'max_age': 3600,
+    u'timeout': 10,
+    u'ping_interval': 30
+}
+_pool = None
+
+# Serve the associated concept endpoints from the in-memory co-occurrence matrices instead of SQL. Enabled by setting
+# COOCCURRENCE_ENGINE = True in cohd_flask.conf
+_cooccurrence_enabled = False
+
+# Serve ranked associations from the precomputed cohd.concept_pair_stats table (see build_association_stats.py).
+# Enabled by setting ASSOCIATION_STATS_TABLE = True in cohd_flask.conf
+_association_stats_enabled = False
+
+# Serve findConceptIDs from in-memory concept name indexes instead of LIKE '%query%' scans of cohd.concept. Enabled by
+# setting CONCEPT_SEARCH_INDEX = True in cohd_flask.conf
+_concept_search_enabled = False
+
+# Read pairs from the canonically ordered cohd.concept_pair_counts (concept_id_1 < concept_id_2) and all partners of a
+# concept from cohd.concept_pair_adjacency (see build_canonical_pairs.py). Enabled by setting CANONICAL_PAIRS = True in
+# cohd_flask.conf
+_canonical_pairs_enabled = False
+
+# Stream large results from an unbuffered server-side cursor instead of building the whole response in memory. Enabled
+# by setting STREAM_RESULTS = True in cohd_flask.conf
+_streaming_enabled = False
+# Number of rows read from the server-side cursor per chunk of the streamed response
+_STREAM_FETCH_SIZE = 1000
+
+# Serve the metadata and vocabularies endpoints from memory instead of SQL. Enabled by setting METADATA_CACHE = True in
+# cohd_flask.conf. The metadata is checked for changes every _metadata_check_interval seconds (None to never check).
+_metadata_cache_enabled = False
+_metadata_check_interval = 300
+
+# Answer concepts lookups from the in-memory concept dictionary, and attach the names and domains of associated concepts
+# from it instead of joining cohd.concept. Enabled by setting CONCEPT_DICTIONARY = True in cohd_flask.conf
+_concept_dictionary_enabled = False
+
+# Statistic to rank by, columns to return, and the concept counts required (i.e., the inner joins on concept_counts in
+# the original queries) from cohd.concept_pair_stats for each association method
+_ASSOCIATION_STATS_COLUMNS = {
+    u'chiSquare': (u'chi_square', u's.chi_square, s.p_value AS `p-value`',
+                   u'AND s.concept_count_1 IS NOT NULL AND s.concept_count_2 IS NOT NULL'),
+    u'obsExpRatio': (u'ln_ratio', u's.concept_pair_count AS observed_count, s.expected_count, s.ln_ratio',
+                     u'AND s.concept_count_1 IS NOT NULL AND s.concept_count_2 IS NOT NULL'),
+    u'relativeFrequency': (u'relative_frequency',
+                           u's.concept_pair_count, s.concept_count_2 AS concept_2_count, s.relative_frequency',
+                           u'AND s.concept_count_2 IS NOT NULL')
+}
+
+# Columns to return and the joins on concept_counts and patient_count for each association method when reading all
+# partners of a concept from cohd.concept_pair_adjacency (see _adjacent_associations_sql)
+_ADJACENT_COUNTS_JOINS = u'''JOIN cohd.concept_counts c1 ON a.dataset_id = c1.dataset_id AND a.concept_id = c1.concept_id
+        JOIN cohd.concept_counts c2 ON a.dataset_id = c2.dataset_id AND a.associated_concept_id = c2.concept_id
+        JOIN cohd.patient_count pc ON a.dataset_id = pc.dataset_id'''
+_ADJACENT_ASSOCIATION_COLUMNS = {
+    u'chiSquare': (u'''a.concept_count AS concept_pair_count,
+            c1.concept_count AS concept_count_1,
+            c2.concept_count AS concept_count_2,
+            pc.count AS patient_count''', _ADJACENT_COUNTS_JOINS),
+    u'obsExpRatio': (u'''a.concept_count AS observed_count,
+            c1.concept_count * c2.concept_count / (pc.count + 0E0) AS expected_count,
+            log(a.concept_count * pc.count / (c1.concept_count * c2.concept_count + 0E0)) AS ln_ratio''',
+                     _ADJACENT_COUNTS_JOINS),
+    u'relativeFrequency': (u'''a.concept_count AS concept_pair_count,
+            c2.concept_count AS concept_2_count,
+            a.concept_count / (c2.concept_count + 0E0) AS relative_frequency''',
+                           u'JOIN cohd.concept_counts c2 ON a.dataset_id = c2.dataset_id '
+                           u'AND a.associated_concept_id = c2.concept_id')
+}
+
 # OXO API configuration
 URL_OXO_SEARCH = u'https://www.ebi.ac.uk/spot/oxo/api/search'
 _DEFAULT_OXO_DISTANCE = 2
+# Maximum number of CURIEs in one xrefToOMOP request
+_MAX_XREF_CURIES = 10000
+# Maximum number of concept_ids in one xrefFromOMOP request
+_MAX_XREF_CONCEPT_IDS = 1000
+
+# Maximum number of concepts in one pairwiseConceptFreq request, and the statistics it can compute
+_MAX_CONCEPT_SET_SIZE = 1000
+_PAIRWISE_STATISTICS = [u'chi_square', u'ln_ratio']
+
+# Values of the format parameter that select a layout of the JSON results rather than a response format, by endpoint
+_FORMAT_LAYOUTS = {
+    (u'frequencies', u'pairwiseConceptFreq'): (u'triplets', u'matrix')
+}
+
+# Maximum number of concepts or concept pairs in one merged query of a batch
+_BATCH_MERGE_SIZE = 1000
 DEFAULT_OXO_MAPPING_TARGETS = ["ICD9CM", "ICD10CM", "SNOMEDCT", "MeSH"]
 
 
@@ -26,19 +133,1130 @@ def _get_arg_datset_id(args):
     return dataset_id
 
 
+def _canonical_pair(concept_id_1, concept_id_2):
+    """ The order in which a pair is stored in the canonically ordered cohd.concept_pair_counts
+
+    :return: (smaller concept_id, larger concept_id)
+    """
+    return min(concept_id_1, concept_id_2), max(concept_id_1, concept_id_2)
+
+
+def _canonical_pair_condition(alias, params):
+    """ SQL condition that looks up the pair (params['concept_id_1'], params['concept_id_2']) in the canonically ordered
+    cohd.concept_pair_counts with one primary key lookup
+
+    :param alias: alias of cohd.concept_pair_counts in the query
+    :param params: dict of SQL parameters, updated with the pair in canonical order
+    :return: SQL condition
+    """
+    params['pair_id_1'], params['pair_id_2'] = _canonical_pair(params['concept_id_1'], params['concept_id_2'])
+    return '{0}.concept_id_1 = %(pair_id_1)s AND {0}.concept_id_2 = %(pair_id_2)s'.format(alias)
+
+
+def _association_pair_condition(params):
+    """ SQL condition that selects the pair (params['concept_id_1'], params['concept_id_2']) from
+    cohd.concept_pair_counts cp in the association queries
+
+    :param params: dict of SQL parameters
+    :return: SQL condition
+    """
+    if _canonical_pairs_enabled:
+        return _canonical_pair_condition(u'cp', params)
+    return 'cp.concept_id_1 IN (%(concept_id_1)s, %(concept_id_2)s) ' \
+           'AND cp.concept_id_2 IN (%(concept_id_1)s, %(concept_id_2)s)'
+
+
+def _concept_dictionary(conn):
+    """ The concept dictionary if enabled, loading it on first use
+
+    :param conn: pymysql connection used if the dictionary needs to be loaded
+    :return: ConceptDictionary, or None if disabled
+    """
+    if not _concept_dictionary_enabled:
+        return None
+    return concept_dictionary.get_dictionary(conn)
+
+
+def _concept_sql(dictionary, concept_id, name_alias, domain_alias):
+    """ SQL that attaches the name and domain of the associated concept by joining cohd.concept, or, with the concept
+    dictionary, NULL placeholders that _attach_concepts fills in after the query
+
+    Queries that filter the associated concepts by domain always join cohd.concept, so that the filter applies before
+    ranking and paging.
+
+    :param dictionary: ConceptDictionary, or None to join cohd.concept
+    :param concept_id: SQL expression of the associated concept_id
+    :param name_alias: name of the concept name column
+    :param domain_alias: name of the domain column
+    :return: (columns, join)
+    """
+    if dictionary is not None:
+        return u'NULL AS {name}, NULL AS {domain}'.format(name=name_alias, domain=domain_alias), u''
+    return u'c.concept_name AS {name}, c.domain_id AS {domain}'.format(name=name_alias, domain=domain_alias), \
+        u'JOIN cohd.concept c ON {concept_id} = c.concept_id'.format(concept_id=concept_id)
+
+
+def _attach_concepts(dictionary, results, id_key, name_key, domain_key):
+    """ Fills in the names and domains of the concepts of results read with _concept_sql
+
+    Results whose concept is not in cohd.concept are dropped, as the join would have.
+
+    :param dictionary: ConceptDictionary, or None if the query joined cohd.concept
+    :param results: list of results, or _StreamedQuery
+    :return: list of results, or _StreamedQuery
+    """
+    if dictionary is None:
+        return results
+    if isinstance(results, _StreamedQuery):
+        results.concepts = (dictionary, id_key, name_key, domain_key)
+        return results
+    return dictionary.attach(results, id_key, name_key, domain_key)
+
+
+def _query_association_stats(cur, method, args, page, dictionary):
+    """ Reads the associations between concept_id_1 and all other concepts from cohd.concept_pair_stats
+
+    Rows are read in ranked order from the index on the method's statistic, so no sorting is needed at request time.
+
+    :param cur: SQL cursor
+    :param method: chiSquare, obsExpRatio, or relativeFrequency
+    :param args: request arguments
+    :param page: dict of page parameters
+    :param dictionary: ConceptDictionary to attach the concept names from, or None to join cohd.concept
+    :return: (list of results, total number of results), or (error message, status code)
+    """
+    dataset_id = _get_arg_datset_id(args)
+    domain_id = args.get(u'domain')
+
+    # concept_id_1 is required
+    concept_id_1 = args.get(u'concept_id_1')
+    if concept_id_1 is None or concept_id_1 == [u''] or not concept_id_1.strip().isdigit():
+        return u'No concept_id_1 selected', 400
+
+    statistic, columns, count_filter = _ASSOCIATION_STATS_COLUMNS[method]
+    sql = '''SELECT {select}
+        FROM (SELECT
+            s.dataset_id,
+            s.concept_id_1,
+            s.concept_id_2,
+            {columns},
+            {concept_columns}
+        FROM cohd.concept_pair_stats s
+        {concept_join}
+        WHERE s.dataset_id = %(dataset_id)s
+            AND s.concept_id_1 = %(concept_id_1)s
+            {count_filter}
+            {domain_filter}
+            {conditions_1}
+        {order_limit_1}) x
+        {order_limit};'''
+    params = {
+        'dataset_id': dataset_id,
+        'concept_id_1': int(concept_id_1)
+    }
+
+    if domain_id is not None and not domain_id == [u'']:
+        # Restrict the associated concept by domain
+        domain_filter = 'AND c.domain_id = %(domain_id)s'
+        params['domain_id'] = domain_id
+        dictionary = None
+    else:
+        # Unrestricted domain
+        domain_filter = ''
+
+    concept_columns, concept_join = _concept_sql(dictionary, u's.concept_id_2', u'concept_2_name', u'concept_2_domain')
+    branches = [(u's.' + statistic, u's.concept_id_2', u's.concept_pair_count', None)]
+    results, total_count = _query_ranked(cur, sql, params, page, branches, (statistic, u'concept_id_2'),
+                                         columns=columns, count_filter=count_filter, domain_filter=domain_filter,
+                                         concept_columns=concept_columns, concept_join=concept_join)
+    return _attach_concepts(dictionary, results, u'concept_id_2', u'concept_2_name', u'concept_2_domain'), total_count
+
+
+def _query_adjacent_freqs(cur, dataset_id, concept_id, domain_id, page, dictionary):
+    """ Reads the co-occurrence frequencies of concept_id and all other concepts from cohd.concept_pair_adjacency
+
+    All partners are read with one range scan of (dataset_id, concept_id), instead of a UNION of scans on concept_id_1
+    and concept_id_2 of cohd.concept_pair_counts.
+
+    :param cur: SQL cursor
+    :param dataset_id: int
+    :param concept_id: int
+    :param domain_id: domain of the associated concepts, or None for all domains
+    :param page: dict of page parameters
+    :param dictionary: ConceptDictionary to attach the concept names from, or None to join cohd.concept
+    :return: (list of results, total number of results)
+    """
+    sql = '''SELECT {select}
+        FROM (SELECT
+            a.dataset_id,
+            a.concept_id,
+            a.associated_concept_id,
+            a.concept_count,
+            a.concept_count / (pc.count + 0E0) AS concept_frequency,
+            {concept_columns}
+        FROM cohd.concept_pair_adjacency a
+        {concept_join}
+        JOIN cohd.patient_count pc ON a.dataset_id = pc.dataset_id
+        WHERE a.dataset_id = %(dataset_id)s AND a.concept_id = %(concept_id)s
+            {domain_filter}
+            {conditions_1}
+        {order_limit_1}) x
+        {order_limit};'''
+    params = {
+        'dataset_id': dataset_id,
+        'concept_id': concept_id
+    }
+
+    if domain_id is not None:
+        domain_filter = 'AND c.domain_id = %(domain_id)s'
+        params['domain_id'] = domain_id
+        dictionary = None
+    else:
+        domain_filter = ''
+
+    concept_columns, concept_join = _concept_sql(dictionary, u'a.associated_concept_id', u'associated_concept_name',
+                                                 u'associated_domain_id')
+    branches = [(u'a.concept_count', u'a.associated_concept_id', u'a.concept_count',
+                 u'a.concept_count / (pc.count + 0E0)')]
+    results, total_count = _query_ranked(cur, sql, params, page, branches, (u'concept_count', u'associated_concept_id'),
+                                         domain_filter=domain_filter, concept_columns=concept_columns,
+                                         concept_join=concept_join)
+    return _attach_concepts(dictionary, results, u'associated_concept_id', u'associated_concept_name',
+                            u'associated_domain_id'), total_count
+
+
+def _adjacent_associations_sql(method, dictionary=None):
+    """ Query template for the associations between concept_id_1 and all other concepts from
+    cohd.concept_pair_adjacency, with the placeholders of _query_ranked and {domain_filter}
+
+    :param method: chiSquare, obsExpRatio, or relativeFrequency
+    :param dictionary: ConceptDictionary that the concept names will be attached from, or None to join cohd.concept
+    :return: SQL
+    """
+    columns, counts_joins = _ADJACENT_ASSOCIATION_COLUMNS[method]
+    concept_columns, concept_join = _concept_sql(dictionary, u'a.associated_concept_id', u'concept_2_name',
+                                                 u'concept_2_domain')
+    return '''SELECT {{select}}
+        FROM (SELECT
+            a.dataset_id,
+            a.concept_id AS concept_id_1,
+            a.associated_concept_id AS concept_id_2,
+            {columns},
+            {concept_columns}
+        FROM cohd.concept_pair_adjacency a
+        {counts_joins}
+        {concept_join}
+        WHERE a.dataset_id = %(dataset_id)s
+            AND a.concept_id = %(concept_id_1)s
+            {{domain_filter}}
+            {{conditions_1}}
+        {{order_limit_1}}) x
+        {{order_limit}};'''.format(columns=columns, counts_joins=counts_joins, concept_columns=concept_columns,
+                                   concept_join=concept_join)
+
+
+class _StreamedQuery(object):
+    """ A query whose results are streamed to the client after _query_db returns """
+
+    def __init__(self, sql, params=None):
+        self.sql = sql
+        self.params = params
+        # Additional top-level fields of the response, e.g., pagination
+        self.metadata = {}
+        # (ConceptDictionary, id_key, name_key, domain_key) to attach the names and domains of a concept column from
+        self.concepts = None
+
+    def transform(self, columns=None):
+        """ Function applied to each chunk of rows, e.g., to attach concept names
+
+        :param columns: column names of tuple rows, or None for dict rows
+        :return: function, or None if the rows are not transformed
+        """
+        if self.concepts is None:
+            return None
+        dictionary, id_key, name_key, domain_key = self.concepts
+        if columns is None:
+            return lambda rows: dictionary.attach(rows, id_key, name_key, domain_key)
+        indices = columns.index(id_key), columns.index(name_key), columns.index(domain_key)
+        return lambda rows: dictionary.attach_tuples(rows, *indices)
+
+
+def _cursor(conn, service, method, cursor_class=None):
+    """ Opens a cursor whose statements are timed for the request metrics and the slow-query log
+
+    :param conn: pymysql connection
+    :param service: string
+    :param method: string
+    :param cursor_class: pymysql cursor class, or None for the connection's default (DictCursor)
+    :return: cursor
+    """
+    cur = conn.cursor(cursor_class) if cursor_class is not None else conn.cursor()
+    return slow_query_log.logged_cursor(request_metrics.timed_cursor(cur), u'/api/%s/%s' % (service, method))
+
+
+def _fetch_results(cur, sql, params=None, stream=True, result_format=u'json'):
+    """ Executes the query and fetches all results, or defers the query to be streamed when streaming is enabled
+
+    :param cur: SQL cursor
+    :param sql: SQL query
+    :param params: SQL parameters
+    :param stream: False if the results will be processed further and must be fetched now
+    :param result_format: response format. Formats other than json are always streamed, since their rows are encoded
+        from the tuples of an unbuffered cursor without building dicts.
+    :return: list of results, or _StreamedQuery
+    """
+    if stream and (_streaming_enabled or result_format != u'json'):
+        return _StreamedQuery(sql, params)
+    cur.execute(sql, params)
+    return cur.fetchall()
+
+
+class _ResultStream(object):
+    """ Iterable response body that reads the results from an unbuffered cursor in chunks
+
+    The pooled connection is returned to the pool when the response is closed. A connection whose results were not read
+    to the end (e.g., the client disconnected) is discarded rather than drained.
+    """
+
+    def __init__(self, pool, conn, cur, metadata, transform=None, result_format=u'json', columns=None, reorder=None):
+        """
+        :param cur: unbuffered cursor with the results, returning dicts for json and tuples for the other formats
+        :param metadata: dict of additional top-level fields of the response
+        :param transform: function applied to each chunk of rows, or None
+        :param result_format: response format (see response_formats)
+        :param columns: column names of the tuple rows after reorder (formats other than json)
+        :param reorder: function that reorders the values of a tuple row into the order of columns, or None
+        """
+        self._pool = pool
+        self._conn = conn
+        self._cur = cur
+        self._metadata = metadata
+        self._transform = transform
+        self._format = result_format
+        self._columns = columns
+        self._reorder = reorder
+        self._completed = False
+        self._closed = False
+
+    def _chunks(self):
+        while True:
+            rows = self._cur.fetchmany(_STREAM_FETCH_SIZE)
+            if not rows:
+                break
+            if self._transform is not None:
+                rows = self._transform(list(rows))
+                if not rows:
+                    continue
+            if self._reorder is not None:
+                rows = [self._reorder(row) for row in rows]
+            yield rows
+
+    def __iter__(self):
+        if self._format != u'json':
+            for chunk in response_formats.encode(self._format, self._columns, self._chunks(), self._metadata):
+                yield chunk
+            self._completed = True
+            return
+
+        yield u'{"results": ['
+        first = True
+        for rows in self._chunks():
+            with request_metrics.phase(u'serialize'):
+                chunk = u', '.join(flask_json.dumps(row) for row in rows)
+            yield chunk if first else u', ' + chunk
+            first = False
+        yield u']' + u''.join(u', %s: %s' % (flask_json.dumps(key), flask_json.dumps(value))
+                              for key, value in sorted(self._metadata.items())) + u'}\n'
+        self._completed = True
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._completed:
+            self._cur.close()
+        self._pool.checkin(self._conn, discard=not self._completed)
+
+
+def _get_page_args(args):
+    """ Gets the optional top-k and keyset pagination parameters of the associated concept endpoints
+
+    limit: maximum number of results
+    min_count: minimum pair count
+    min_statistic: minimum value of the statistic (e.g., ln_ratio, or concept_frequency for frequencies)
+    cursor: opaque cursor returned as next_cursor with the previous page
+
+    :return: dict of page parameters, or (error message, status code)
+    """
+    page = {
+        u'limit': None,
+        u'min_count': None,
+        u'min_statistic': None,
+        u'cursor': None
+    }
+
+    limit = args.get(u'limit')
+    if limit is not None and limit.strip() != u'':
+        if not limit.strip().isdigit() or int(limit) == 0:
+            return u'limit parameter should be a positive integer', 400
+        page[u'limit'] = int(limit)
+
+    min_count = args.get(u'min_count')
+    if min_count is not None and min_count.strip() != u'':
+        if not min_count.strip().isdigit():
+            return u'min_count parameter should be an integer', 400
+        page[u'min_count'] = int(min_count)
+
+    min_statistic = args.get(u'min_statistic')
+    if min_statistic is not None and min_statistic.strip() != u'':
+        try:
+            page[u'min_statistic'] = float(min_statistic)
+        except ValueError:
+            return u'min_statistic parameter should be a number', 400
+
+    cursor = args.get(u'cursor')
+    if cursor is not None and cursor.strip() != u'':
+        try:
+            value, concept_id = json.loads(base64.urlsafe_b64decode(cursor.strip().encode(u'ascii')))
+            value = float(value) if value is not None else None
+            # Results without a value (NULL or NaN) are ranked last, and share the cursor value None
+            page[u'cursor'] = (value if value == value else None, int(concept_id))
+        except (TypeError, ValueError, UnicodeError):
+            return u'Invalid cursor', 400
+
+    return page
+
+
+def _fetch_page(page):
+    """ Page parameters for fetching one more result than the limit, to find out if there is a next page """
+    if page[u'limit'] is None:
+        return page
+    return dict(page, limit=page[u'limit'] + 1)
+
+
+def _page_sql(page, params, value, associated_id, pair_count, statistic=None, cursor=True):
+    """ SQL that applies the page parameters to one ranked (sub-)query
+
+    :param page: dict of page parameters
+    :param params: dict of SQL parameters, updated with the page parameters
+    :param value: SQL expression of the value the results are ranked by
+    :param associated_id: SQL expression of the associated concept_id (tie-breaker)
+    :param pair_count: SQL expression of the pair count compared to min_count
+    :param statistic: SQL expression compared to min_statistic, if different from value
+    :param cursor: False to ignore the cursor (e.g., when counting the total number of results)
+    :return: (conditions starting with AND, ORDER BY ... LIMIT clause)
+    """
+    if statistic is None:
+        statistic = value
+
+    conditions = u''
+    if page[u'min_count'] is not None:
+        conditions += u' AND {pair_count} >= %(min_count)s'
+        params['min_count'] = page[u'min_count']
+    if page[u'min_statistic'] is not None:
+        conditions += u' AND {statistic} >= %(min_statistic)s'
+        params['min_statistic'] = page[u'min_statistic']
+    if cursor and page[u'cursor'] is not None:
+        # Keyset pagination: continue after the last (value, id) of the previous page. NULL values are ranked last
+        # (ORDER BY ... DESC), and a cursor at a NULL value has the value None.
+        if page[u'cursor'][0] is None:
+            conditions += u' AND {value} IS NULL AND {associated_id} > %(cursor_id)s'
+        else:
+            conditions += u' AND ({value} < %(cursor_value)s ' \
+                          u'OR ({value} = %(cursor_value)s AND {associated_id} > %(cursor_id)s) OR {value} IS NULL)'
+        params['cursor_value'], params['cursor_id'] = page[u'cursor']
+
+    if page[u'limit'] is None and page[u'cursor'] is None:
+        # Without pagination, the original ORDER BY
+        order_limit = u'ORDER BY {value} DESC'
+    else:
+        # Keyset pagination needs a total order: ties are broken by the associated concept_id
+        order_limit = u'ORDER BY {value} DESC, {associated_id} ASC'
+    if page[u'limit'] is not None:
+        order_limit += u' LIMIT %(limit)s'
+        params['limit'] = page[u'limit']
+
+    expressions = {
+        u'value': value,
+        u'associated_id': associated_id,
+        u'pair_count': pair_count,
+        u'statistic': statistic
+    }
+    return conditions.format(**expressions), order_limit.format(**expressions)
+
+
+def _query_ranked(cur, sql, params, page, branches, ranking, **template):
+    """ Runs a ranked query over a UNION of branches, pushing the page parameters down into each branch
+
+    :param cur: SQL cursor
+    :param sql: Query template with {select} and {order_limit} placeholders for the outer query, and {conditions_i}
+                and {order_limit_i} placeholders for each branch i (1, 2, ...) of the UNION
+    :param params: dict of SQL parameters
+    :param page: dict of page parameters
+    :param branches: list of (value, associated_id, pair_count, statistic) SQL expressions for each branch
+    :param ranking: (value, associated_id) columns of the outer query
+    :param template: Other placeholders of the query template (e.g., domain_filter)
+    :return: (list of results, total number of results passing the filters or None if there is no limit)
+    """
+    fetch_page = _fetch_page(page)
+    sql_params = dict(params)
+    parts = dict(template, select=u'*')
+    for i, (value, associated_id, pair_count, statistic) in enumerate(branches):
+        parts[u'conditions_%d' % (i + 1)], parts[u'order_limit_%d' % (i + 1)] = \
+            _page_sql(fetch_page, sql_params, value, associated_id, pair_count, statistic)
+    parts[u'order_limit'] = _page_sql(fetch_page, {}, ranking[0], ranking[1], None)[1]
+    # Stream the results only if they are not trimmed to the page afterwards
+    results = _fetch_results(cur, sql.format(**parts), sql_params, stream=page[u'limit'] is None)
+
+    total_count = None
+    if page[u'limit'] is not None:
+        if page[u'cursor'] is None and len(results) <= page[u'limit']:
+            # Everything fit on the first page
+            total_count = len(results)
+        else:
+            count_params = dict(params)
+            parts = dict(template, select=u'COUNT(*) AS total_count', order_limit=u'')
+            for i, (value, associated_id, pair_count, statistic) in enumerate(branches):
+                parts[u'conditions_%d' % (i + 1)] = _page_sql(page, count_params, value, associated_id, pair_count,
+                                                              statistic, cursor=False)[0]
+                parts[u'order_limit_%d' % (i + 1)] = u''
+            count_params.pop('limit', None)
+            cur.execute(sql.format(**parts), count_params)
+            total_count = int(cur.fetchone()[u'total_count'])
+
+    return results, total_count
+
+
+def _page_results(results, page, value_key, id_key, total_count):
+    """ Trims the results fetched with _fetch_page to the page limit and builds the pagination response metadata
+
+    :param results: list of results, possibly with one more result than the limit
+    :param page: dict of page parameters
+    :param value_key: key of the ranked value in the results
+    :param id_key: key of the associated concept_id in the results
+    :param total_count: total number of results passing the filters
+    :return: (results, response metadata)
+    """
+    if page[u'limit'] is None:
+        return results, {}
+
+    next_cursor = None
+    if len(results) > page[u'limit']:
+        results = results[:page[u'limit']]
+        last = results[-1]
+        value = last[value_key]
+        if value is not None and value != value:
+            # NaN is ranked last, like NULL
+            value = None
+        next_cursor = base64.urlsafe_b64encode(json.dumps([value, last[id_key]]))
+
+    metadata = {
+        u'total_count': total_count,
+        u'next_cursor': next_cursor
+    }
+    return results, metadata
+
+
+def _read_pool_config(config_file):
+    """ Reads the connection pool settings from the [cohd_pool] section of the MySQL option file
+
+    :param config_file: Path to the MySQL option file
+    :return: dict of pool settings
+    """
+    settings = dict(_POOL_DEFAULTS)
+    parser = ConfigParser.RawConfigParser(allow_no_value=True)
+    parser.read(config_file)
+    if parser.has_section(_POOL_CONFIG_SECTION):
+        for key, default in _POOL_DEFAULTS.items():
+            if parser.has_option(_POOL_CONFIG_SECTION, key):
+                settings[key] = type(default)(parser.get(_POOL_CONFIG_SECTION, key))
+    return settings
+
+
+def configure_pool(app_config=None):
+    """ Creates the process-wide connection pool of the storage backend selected by STORAGE_BACKEND (see
+    storage_backends.create_backend)
+
+    Settings are read from the [cohd_pool] section of CONFIG_FILE and may be overridden with MYSQL_POOL_SIZE,
+    MYSQL_POOL_MAX_USES, MYSQL_POOL_MAX_AGE, MYSQL_POOL_TIMEOUT, and MYSQL_POOL_PING_INTERVAL in the Flask configuration
+
+    :param app_config: Flask configuration (optional)
+    :return: ConnectionPool
+    """
+    global _pool
+
+    settings = _read_pool_config(CONFIG_FILE)
+    if app_config is not None:
+        for key in _POOL_DEFAULTS:
+            config_key = u'MYSQL_POOL_' + key.upper()
+            if config_key in app_config:
+                settings[key] = app_config[config_key]
+
+    backend = create_backend(app_config, CONFIG_FILE)
+    _pool = ConnectionPool(backend.connect, **settings)
+    return _pool
+
+
+def configure_features(app_config):
+    """ Enables or disables optional query backends based on the Flask configuration
+
+    COOCCURRENCE_ENGINE: serve associated concepts from in-memory co-occurrence matrices, memory-mapped from the
+        snapshot files in COOCCURRENCE_SNAPSHOT_DIR if exported (see export_snapshot.py)
+    ASSOCIATION_STATS_TABLE: serve ranked associations from the precomputed concept_pair_stats table
+    STREAM_RESULTS: stream large results from an unbuffered server-side cursor
+    CONCEPT_SEARCH_INDEX: serve findConceptIDs from in-memory concept name indexes
+    METADATA_CACHE: serve the metadata and vocabularies endpoints from memory, loaded now and checked for changes every
+        METADATA_CACHE_CHECK_INTERVAL seconds
+    CONCEPT_DICTIONARY: serve concepts lookups and the names of associated concepts from the in-memory concept
+        dictionary, loaded now
+    CANONICAL_PAIRS: read canonically ordered pairs and the concept_pair_adjacency table. Always enabled with the
+        sqlite storage backend, whose database is built with canonical pairs by load_dataset.py.
+    OXO_*: OxO URL, timeout, result cache, and circuit breaker (see omop_xref.configure_oxo)
+    SLOW_QUERY_*: log statements slower than a threshold, optionally with their plans (see slow_query_log.configure)
+
+    :param app_config: Flask configuration
+    """
+    global _cooccurrence_enabled, _association_stats_enabled, _streaming_enabled, _concept_search_enabled, \
+        _canonical_pairs_enabled, _metadata_cache_enabled, _metadata_check_interval, _concept_dictionary_enabled
+    _cooccurrence_enabled = bool(app_config.get(u'COOCCURRENCE_ENGINE', False))
+    cooccurrence.configure_snapshots(app_config.get(u'COOCCURRENCE_SNAPSHOT_DIR'))
+    _association_stats_enabled = bool(app_config.get(u'ASSOCIATION_STATS_TABLE', False))
+    _streaming_enabled = bool(app_config.get(u'STREAM_RESULTS', False))
+    _concept_search_enabled = bool(app_config.get(u'CONCEPT_SEARCH_INDEX', False))
+    _canonical_pairs_enabled = bool(app_config.get(u'CANONICAL_PAIRS', False)) or \
+        app_config.get(u'STORAGE_BACKEND') == u'sqlite'
+    _metadata_cache_enabled = bool(app_config.get(u'METADATA_CACHE', False))
+    _metadata_check_interval = app_config.get(u'METADATA_CACHE_CHECK_INTERVAL', 300)
+    _concept_dictionary_enabled = bool(app_config.get(u'CONCEPT_DICTIONARY', False))
+    configure_oxo(app_config)
+    slow_query_log.configure(app_config, create_backend(app_config, CONFIG_FILE))
+
+    if _metadata_cache_enabled:
+        # Load the metadata before the first request (and before uWSGI forks the workers). If the database is not
+        # available yet, the metadata is loaded on first use.
+        _metadata()
+    if _concept_dictionary_enabled:
+        _load_concept_dictionary()
+
+
+def request_dataset_id(args):
+    """ The dataset_id that a request reads from (the default dataset if not specified)
+
+    :param args: request arguments
+    :return: int
+    """
+    return _get_arg_datset_id(args)
+
+
+def reload_dataset(dataset_id=None):
+    """ Drops the in-memory co-occurrence matrices and concept search indexes of a reloaded dataset, and the in-memory
+    metadata. The concept dictionary is dropped when all datasets are reloaded.
+
+    :param dataset_id: int, or None for all datasets
+    """
+    cooccurrence.clear(dataset_id)
+    concept_search.clear(dataset_id)
+    metadata_cache.clear()
+    if dataset_id is None:
+        concept_dictionary.clear()
+
+
+def _load_concept_dictionary():
+    """ Loads the concept dictionary on a pooled connection. If the database is not available, the dictionary is loaded
+    on first use instead.
+    """
+    pool = _pool if _pool is not None else configure_pool()
+    try:
+        conn = pool.checkout()
+    except PoolTimeout as e:
+        print u"Cannot load concept dictionary: ", e
+        return
+    try:
+        concept_dictionary.get_dictionary(conn)
+    except pymysql.err.Error as e:
+        print u"Cannot load concept dictionary: ", e
+        pool.checkin(conn, discard=True)
+        return
+    pool.checkin(conn)
+
+
+def concept_dictionary_stats():
+    """ Number of concepts and memory used by the concept dictionary, for sizing the workers
+
+    :return: dict
+    """
+    dictionary = concept_dictionary.loaded()
+    if dictionary is None:
+        return {}
+    return dictionary.stats()
+
+
+def _metadata(conn=None):
+    """ The in-memory metadata, loading it or checking it for changes if due
+
+    :param conn: pymysql connection, or None to check out a pooled connection if needed
+    :return: metadata_cache.Metadata, or None if it is not loaded and cannot be loaded now
+    """
+    if not metadata_cache.due(_metadata_check_interval):
+        return metadata_cache.get_metadata()
+
+    pool = _pool if _pool is not None else configure_pool()
+    checked_out = conn is None
+    try:
+        if checked_out:
+            with request_metrics.phase(u'connect'):
+                conn = pool.checkout()
+        metadata_cache.refresh(conn, _metadata_check_interval)
+    except (PoolTimeout, pymysql.err.Error) as e:
+        # Serve the metadata loaded previously, if any
+        print u"Cannot load metadata: ", e
+        if checked_out and conn is not None:
+            pool.checkin(conn, discard=not isinstance(e, PoolTimeout))
+        return metadata_cache.get_metadata()
+
+    if checked_out:
+        pool.checkin(conn)
+    return metadata_cache.get_metadata()
+
+
+def _query_metadata(service, method, args, conn=None, result_format=u'json'):
+    """ Answers the metadata and vocabularies queries from the in-memory metadata
+
+    :param conn: pymysql connection, or None to check out a pooled connection if the metadata needs to be loaded
+    :param result_format: response format (see response_formats)
+    :return: Response, or None if the query is not answered from memory
+    """
+    if not _metadata_cache_enabled or (service, method) not in metadata_cache.SERVED_QUERIES:
+        return None
+    metadata = _metadata(conn)
+    if metadata is None:
+        return None
+    return _format_results(metadata.results(service, method, _get_arg_datset_id(args)), {}, result_format)
+
+
+def _format_results(results, response_metadata, result_format):
+    """ Encodes the results of a query in the response format
+
+    :param results: list of rows (dicts), or other JSON-serializable results
+    :param response_metadata: dict of additional top-level fields, e.g., pagination
+    :param result_format: response format (see response_formats)
+    :return: Response, or (error message, status code) if the results cannot be encoded in the format
+    """
+    if result_format == u'json':
+        body = {u'results': results}
+        body.update(response_metadata)
+        with request_metrics.phase(u'serialize'):
+            return jsonify(body)
+
+    with request_metrics.phase(u'serialize'):
+        table = response_formats.dict_rows(results)
+    if table is not None:
+        columns, rows = table
+        data = b''.join(response_formats.encode(result_format, columns, [rows], response_metadata))
+    elif isinstance(results, dict) and result_format in (u'columns', u'msgpack'):
+        data = response_formats.encode_results(result_format, results, response_metadata)
+    else:
+        return u'format %s is not available for this query' % result_format, 400
+    return Response(data, mimetype=response_formats.MIMETYPES[result_format],
+                    headers=response_formats.headers(result_format, response_metadata))
+
+
+def _patient_count(cur, dataset_id):
+    """ Number of patients in the dataset, from the in-memory metadata if loaded
+
+    :return: int, or None if the dataset does not exist
+    """
+    metadata = metadata_cache.get_metadata() if _metadata_cache_enabled else None
+    if metadata is not None:
+        return metadata.patient_count(dataset_id)
+    cur.execute('''SELECT count FROM cohd.patient_count WHERE dataset_id = %s;''', [dataset_id])
+    row = cur.fetchone()
+    return row[u'count'] if row is not None else None
+
+
+def pool_stats():
+    """ Connection pool statistics (wait times, checkout counts, etc.) for monitoring
+
+    :return: dict
+    """
+    if _pool is None:
+        return {}
+    return _pool.stats()
+
+
 def query_db(service, method, args):
+    """ Runs the query on a pooled connection
+
+    If the connection turns out to be broken (e.g., the server closed it), the connection is discarded and the query is
+    retried once on a new connection. Streamed results are returned as a streaming Response, which keeps the connection
+    checked out until the response is closed. With METADATA_CACHE, the metadata and vocabularies queries are answered
+    from memory without a connection.
+    """
+    result_format, error = response_formats.request_format(args, _FORMAT_LAYOUTS.get((service, method), ()))
+    if error is not None:
+        return error
+
+    result = _query_metadata(service, method, args, result_format=result_format)
+    if result is not None:
+        return result
+
+    pool = _pool if _pool is not None else configure_pool()
+
+    for attempt in range(2):
+        try:
+            with request_metrics.phase(u'connect'):
+                conn = pool.checkout()
+        except PoolTimeout:
+            return u'Database busy, please try again later', 503
+
+        try:
+            result = _query_db(conn, service, method, args, result_format)
+            if isinstance(result, _StreamedQuery):
+                # Run the query before responding so that errors can still be retried. Rows are read while streaming,
+                # as tuples for the formats other than json.
+                cursor_class = pymysql.cursors.SSDictCursor if result_format == u'json' else pymysql.cursors.SSCursor
+                cur = _cursor(conn, service, method, cursor_class)
+                cur.execute(result.sql, result.params)
+                print cur._executed
+        except pymysql.err.OperationalError as e:
+            pool.checkin(conn, discard=True)
+            if attempt > 0:
+                raise
+            print u"Reconnecting after MySQL error: ", e
+            continue
+        except Exception:
+            pool.checkin(conn, discard=True)
+            raise
+
+        if isinstance(result, _StreamedQuery):
+            if result_format == u'json':
+                stream = _ResultStream(pool, conn, cur, result.metadata, result.transform())
+            else:
+                query_columns = [d[0] for d in cur.description]
+                columns, reorder = response_formats.sorted_columns(query_columns)
+                stream = _ResultStream(pool, conn, cur, result.metadata, result.transform(query_columns),
+                                       result_format, columns, reorder)
+            response = Response(iter(stream), mimetype=response_formats.MIMETYPES[result_format],
+                                headers=response_formats.headers(result_format, result.metadata))
+            response.call_on_close(stream.close)
+            return response
+
+        pool.checkin(conn)
+        return result
+
+
+def _pairwise_concept_freq(cur, dataset_id, concept_ids, statistics, matrix):
+    """ Co-occurrence counts and frequencies of all pairs in a set of concepts
+
+    The counts of all pairs are read in one query, and the statistics are computed for all pairs at once.
+
+    :param cur: SQL cursor
+    :param dataset_id: int
+    :param concept_ids: list of distinct concept_ids
+    :param statistics: list of statistics to compute (chi_square, ln_ratio)
+    :param matrix: True to return n x n matrices, False to return the observed pairs as triplets
+    :return: dict
+    """
+    placeholders = u','.join([u'%s' for _ in concept_ids])
+    patient_count = _patient_count(cur, dataset_id)
+
+    cur.execute('''SELECT concept_id, concept_count
+        FROM cohd.concept_counts
+        WHERE dataset_id = %s AND concept_id IN ({concepts});'''.format(concepts=placeholders),
+                [dataset_id] + concept_ids)
+    concept_counts = {r[u'concept_id']: r[u'concept_count'] for r in cur.fetchall()}
+
+    cur.execute('''SELECT concept_id_1, concept_id_2, concept_count
+        FROM cohd.concept_pair_counts
+        WHERE dataset_id = %s AND concept_id_1 IN ({concepts}) AND concept_id_2 IN ({concepts});'''.format(
+        concepts=placeholders), [dataset_id] + concept_ids + concept_ids)
+    pairs = cur.fetchall()
+
+    # Pairs as indices into concept_ids, with index_1 < index_2
+    index = {concept_id: i for i, concept_id in enumerate(concept_ids)}
+    index_1 = np.array([index[r[u'concept_id_1']] for r in pairs], dtype=np.int64)
+    index_2 = np.array([index[r[u'concept_id_2']] for r in pairs], dtype=np.int64)
+    index_1, index_2 = np.minimum(index_1, index_2), np.maximum(index_1, index_2)
+    pair_counts = np.array([r[u'concept_count'] for r in pairs], dtype=np.int64)
+    values = {
+        u'concept_count': pair_counts,
+        u'concept_frequency': pair_counts / (patient_count + 0.0) if patient_count else None
+    }
+
+    # Statistics need the counts of both concepts. Pairs whose concepts are not counted get null.
+    counts = np.array([concept_counts.get(concept_id, 0) for concept_id in concept_ids], dtype=np.int64)
+    counted = (counts[index_1] > 0) & (counts[index_2] > 0) if patient_count else np.zeros(len(pairs), dtype=bool)
+    if u'chi_square' in statistics:
+        chi_squares, p_values = chi_square(pair_counts[counted], counts[index_1][counted], counts[index_2][counted],
+                                           patient_count)
+        values[u'chi_square'] = np.full(len(pairs), np.nan)
+        values[u'chi_square'][counted] = chi_squares
+        values[u'p-value'] = np.full(len(pairs), np.nan)
+        values[u'p-value'][counted] = p_values
+    if u'ln_ratio' in statistics:
+        values[u'ln_ratio'] = np.full(len(pairs), np.nan)
+        values[u'ln_ratio'][counted] = ln_ratio(pair_counts[counted], counts[index_1][counted],
+                                                counts[index_2][counted], patient_count)
+
+    def to_list(array):
+        # NaN (not computed) is returned as null
+        return [None if v != v else v for v in array.tolist()] if array is not None else None
+
+    result = {
+        u'dataset_id': dataset_id,
+        u'patient_count': patient_count,
+        u'concept_ids': concept_ids,
+        u'concept_counts': [concept_counts.get(concept_id) for concept_id in concept_ids]
+    }
+    if matrix:
+        # Symmetric n x n matrices, with null for pairs that were not observed
+        n = len(concept_ids)
+        indices = zip(index_1.tolist(), index_2.tolist())
+        for name, array in values.items():
+            m = [[None] * n for _ in range(n)]
+            if array is not None:
+                for (i, j), value in zip(indices, to_list(array)):
+                    m[i][j] = value
+                    m[j][i] = value
+            result[name] = m
+    else:
+        # Observed pairs only, as parallel arrays of concept indices and values
+        result[u'concept_index_1'] = index_1.tolist()
+        result[u'concept_index_2'] = index_2.tolist()
+        for name, array in values.items():
+            result[name] = to_list(array)
+    return result
+
+
+def _batch_key(service, method, args):
+    # Arguments are normalized so that identical queries in a batch are recognized regardless of argument order
+    return service, method, tuple(sorted((name, tuple(values)) for name, values in args.lists()))
+
+
+def _parse_concept_ids(query):
+    """ Parses the q parameter of singleConceptFreq
+
+    :return: list of concept_ids, or None if q is invalid
+    """
+    if query is None or query.isspace():
+        return None
+    qs = query.split(u',')
+    if not all(x.strip().isdigit() for x in qs):
+        return None
+    return [int(x.strip()) for x in qs]
+
+
+def _parse_concept_pair(query):
+    """ Parses the q parameter of pairedConceptFreq
+
+    :return: (concept_id_1, concept_id_2), or None if q is invalid
+    """
+    if query is None:
+        return None
+    qs = query.split(u',')
+    if len(qs) != 2 or not qs[0].strip().isdigit() or not qs[1].strip().isdigit():
+        return None
+    return int(qs[0]), int(qs[1])
+
+
+def _single_concept_freqs(cur, dataset_id, concept_ids):
+    """ singleConceptFreq of many concepts in one query
+
+    :return: dict - concept_id -> result
+    """
+    sql = '''SELECT
+            cc.dataset_id,
+            cc.concept_id,
+            cc.concept_count,
+            cc.concept_count / (pc.count + 0E0) AS concept_frequency
+        FROM cohd.concept_counts cc
+        JOIN cohd.patient_count pc ON cc.dataset_id = pc.dataset_id
+        WHERE cc.dataset_id = %s AND concept_id IN ({concepts});'''.format(
+        concepts=','.join(['%s' for _ in concept_ids]))
+    cur.execute(sql, [dataset_id] + list(concept_ids))
+    return {row[u'concept_id']: row for row in cur.fetchall()}
+
+
+def _paired_concept_freqs(cur, dataset_id, pairs):
+    """ pairedConceptFreq of many concept pairs in one query
+
+    :return: dict - (smaller concept_id, larger concept_id) -> list of results
+    """
+    # Each pair may be stored in either order, unless pairs are stored canonically. Group the pairs by concept_id_1 to
+    # use the concept pair index. The dataset_id is repeated in each term, so that each term is a primary key lookup:
+    # SQLite does not combine a condition outside the OR with its terms, and would scan the whole dataset.
+    concept_ids_2 = {}
+    for concept_id_1, concept_id_2 in pairs:
+        concept_id_1, concept_id_2 = _canonical_pair(concept_id_1, concept_id_2)
+        concept_ids_2.setdefault(concept_id_1, set()).add(concept_id_2)
+        if not _canonical_pairs_enabled:
+            concept_ids_2.setdefault(concept_id_2, set()).add(concept_id_1)
+    conditions = []
+    params = []
+    for concept_id_1, concept_ids in concept_ids_2.items():
+        conditions.append('(cpc.dataset_id = %%s AND cpc.concept_id_1 = %%s AND cpc.concept_id_2 IN (%s))' %
+                          ','.join(['%s' for _ in concept_ids]))
+        params += [dataset_id, concept_id_1]
+        params += list(concept_ids)
+
+    sql = '''SELECT
+            cpc.dataset_id,
+            cpc.concept_id_1,
+            cpc.concept_id_2,
+            cpc.concept_count,
+            cpc.concept_count / (pc.count + 0E0) AS concept_frequency
+        FROM cohd.concept_pair_counts cpc
+        JOIN cohd.patient_count pc ON pc.dataset_id = cpc.dataset_id
+        WHERE {conditions};'''.format(conditions=' OR '.join(conditions))
+    cur.execute(sql, params)
+
+    results = {}
+    for row in cur.fetchall():
+        key = tuple(sorted([row[u'concept_id_1'], row[u'concept_id_2']]))
+        results.setdefault(key, []).append(row)
+    return results
+
+
+def _query_merged(conn, items):
+    """ Runs the singleConceptFreq and pairedConceptFreq queries of a batch on the same dataset as set-based queries
+
+    Queries with invalid arguments are left to _query_db, which reports the error.
+
+    :param conn: pymysql connection
+    :param items: list of (index, (service, method, args))
+    :return: dict - index -> (response body, 200)
+    """
+    singles = {}
+    pairs = {}
+    for i, (service, method, args) in items:
+        if service != u'frequencies':
+            continue
+        if method == u'singleConceptFreq':
+            concept_ids = _parse_concept_ids(args.get(u'q'))
+            if concept_ids is not None:
+                singles.setdefault(_get_arg_datset_id(args), []).append((i, concept_ids))
+        elif method == u'pairedConceptFreq':
+            pair = _parse_concept_pair(args.get(u'q'))
+            if pair is not None:
+                pairs.setdefault(_get_arg_datset_id(args), []).append((i, pair))
+
+    results = {}
+    cur = _cursor(conn, u'batch', u'merged')
+    try:
+        for dataset_id, requests in singles.items():
+            if len(requests) < 2:
+                continue
+            concept_ids = sorted(set(concept_id for _, ids in requests for concept_id in ids))
+            freqs = {}
+            for start in range(0, len(concept_ids), _BATCH_MERGE_SIZE):
+                freqs.update(_single_concept_freqs(cur, dataset_id, concept_ids[start:start + _BATCH_MERGE_SIZE]))
+            for i, ids in requests:
+                results[i] = ({u'results': [freqs[concept_id] for concept_id in sorted(set(ids))
+                                            if concept_id in freqs]}, 200)
+
+        for dataset_id, requests in pairs.items():
+            if len(requests) < 2:
+                continue
+            freqs = {}
+            for start in range(0, len(requests), _BATCH_MERGE_SIZE):
+                chunk = [pair for _, pair in requests[start:start + _BATCH_MERGE_SIZE]]
+                freqs.update(_paired_concept_freqs(cur, dataset_id, chunk))
+            for i, pair in requests:
+                results[i] = ({u'results': freqs.get(tuple(sorted(pair)), [])}, 200)
+    except pymysql.err.Error as e:
+        # Leave the remaining queries to be run one at a time (and retried if the connection is broken)
+        print u"Merged batch query failed: ", e
+    return results
+
+
+def _query_batch_item(conn, service, method, args):
+    """ Runs one query of a batch and converts the response
+
+    :return: (response body, 200), or (error message, status code)
+    """
+    result = _query_metadata(service, method, args, conn)
+    if result is None:
+        result = _query_db(conn, service, method, args)
+    if isinstance(result, _StreamedQuery):
+        # Batch responses are not streamed
+        cur = _cursor(conn, service, method)
+        cur.execute(result.sql, result.params)
+        rows = list(cur.fetchall())
+        transform = result.transform()
+        body = {u'results': transform(rows) if transform is not None else rows}
+        body.update(result.metadata)
+        return body, 200
+    if isinstance(result, tuple):
+        return result
+    if isinstance(result, Response):
+        return flask_json.loads(result.get_data()), result.status_code
+    # Error message without a status code
+    return result, 400
+
+
+def query_batch(items):
+    """ Runs many queries on one pooled connection
+
+    Identical queries are only run once, and singleConceptFreq and pairedConceptFreq queries on the same dataset are
+    merged into set-based queries. As in query_db, a query that fails because the connection is broken is retried once
+    on a new connection.
+
+    :param items: list of (service, method, args)
+    :return: list of (response body, 200) or (error message, status code), in the order of items
+    """
+    pool = _pool if _pool is not None else configure_pool()
+    results = [(u'Database busy, please try again later', 503)] * len(items)
+
+    unique = OrderedDict()
+    for i, (service, method, args) in enumerate(items):
+        unique.setdefault(_batch_key(service, method, args), []).append(i)
+
+    try:
+        with request_metrics.phase(u'connect'):
+            conn = pool.checkout()
+    except PoolTimeout:
+        return results
+
+    try:
+        merged = _query_merged(conn, [(indices[0], items[indices[0]]) for indices in unique.values()])
+
+        for indices in unique.values():
+            i = indices[0]
+            result = merged.get(i)
+            attempt = 0
+            while result is None:
+                try:
+                    result = _query_batch_item(conn, *items[i])
+                except Exception as e:
+                    pool.checkin(conn, discard=True)
+                    conn = None
+                    if isinstance(e, pymysql.err.OperationalError) and attempt == 0:
+                        print u"Reconnecting after MySQL error: ", e
+                    else:
+                        print u"Batch query failed: ", e
+                        result = u'Internal server error', 500
+                    attempt += 1
+                    with request_metrics.phase(u'connect'):
+                        conn = pool.checkout()
+
+            for j in indices:
+                results[j] = result
+    except PoolTimeout:
+        # The remaining queries keep the 'Database busy' result
+        pass
+    finally:
+        if conn is not None:
+            pool.checkin(conn)
 
-    print u"Connecting to the MySQL API..."
+    return results
 
-    # Connect to MySQL database
-    print u"Connecting to MySQL database"
 
-    conn = pymysql.connect(read_default_file=CONFIG_FILE,
-                           charset=u'utf8mb4',
-                           cursorclass=pymysql.cursors.DictCursor)
-    cur = conn.cursor()
+def _query_db(conn, service, method, args, result_format=u'json'):
+    cur = _cursor(conn, service, method)
 
     json_return = []
+    # Additional top-level fields of the response, e.g., pagination
+    response_metadata = {}
 
     query = args.get(u'q')
 
@@ -125,6 +1343,7 @@ def query_db(service, method, args):
             min_count = args.get(u'min_count')
             if min_count is None or min_count == [u'']:
                 # Default to set min_count = 1
+                min_count = 1
                 count_filter = 'AND cc.concept_count >= 1'
             else:
                 if min_count.strip().isdigit():
@@ -137,10 +1356,36 @@ def query_db(service, method, args):
                 else:
                     return 'min_count parameter should be an integer', 400
 
+            # Typo-tolerant search
+            fuzzy = args.get(u'fuzzy')
+            fuzzy = fuzzy is not None and fuzzy.strip().lower() in [u'1', u'true']
+            if fuzzy:
+                # Fuzzy searches run on the concept search index, which only contains concepts with counts
+                if not _concept_search_enabled:
+                    return u'Fuzzy search is not available on this server', 400
+                if min_count < 1:
+                    return u'Fuzzy search only covers concepts with counts: min_count should be at least 1', 400
+                max_distance = args.get(u'max_distance')
+                if max_distance is None or max_distance == [u''] or max_distance.isspace():
+                    max_distance = concept_search.DEFAULT_FUZZY_DISTANCE
+                elif max_distance.strip().isdigit() and int(max_distance) <= concept_search.MAX_FUZZY_DISTANCE:
+                    max_distance = int(max_distance)
+                else:
+                    return u'max_distance parameter should be an integer from 0 to %d' % \
+                        concept_search.MAX_FUZZY_DISTANCE, 400
+
             sql = sql.format(domain_filter=domain_filter, count_filter=count_filter)
 
-            cur.execute(sql, params)
-            json_return = cur.fetchall()
+            if fuzzy:
+                index = concept_search.get_index(conn, dataset_id)
+                json_return = index.fuzzy_search(query, max_distance, params.get('domain_id'), min_count)
+            elif _concept_search_enabled and min_count > 0 and concept_search.indexable(query):
+                # The index only contains concepts with counts, so searches that include concepts without counts
+                # (min_count=0) go to SQL
+                index = concept_search.get_index(conn, dataset_id)
+                json_return = index.search(query, params.get('domain_id'), min_count)
+            else:
+                json_return = _fetch_results(cur, sql, params, result_format=result_format)
 
         # Looks up concepts for a list of concept_ids
         # e.g. /api/v1/query?service=omop&meta=concepts&q=4196636,437643
@@ -159,8 +1404,11 @@ def query_db(service, method, args):
                 FROM cohd.concept
                 WHERE concept_id IN (%s);''' % ','.join(['%s' for _ in concept_ids])
 
-            cur.execute(sql, concept_ids)
-            json_return = cur.fetchall()
+            dictionary = _concept_dictionary(conn)
+            if dictionary is not None:
+                json_return = dictionary.concepts(concept_ids)
+            else:
+                json_return = _fetch_results(cur, sql, concept_ids, result_format=result_format)
 
         # Find concept_ids and concept_names that are similar to the query
         # e.g. /api/v1/query?service=omop&meta=mapToStandardConceptID&concept_code=715.3&vocabulary_id=ICD9CM
@@ -206,27 +1454,54 @@ def query_db(service, method, args):
 
         # Cross reference to OMOP using OXO service
         # e.g. /api/v1/query?service=omop&meta=xrefToOMOP?curie=DOID:8398&distance=1
+        # Multiple comma separated CURIEs return the mappings of each CURIE
+        # e.g. /api/v1/query?service=omop&meta=xrefToOMOP?curie=DOID:8398,DOID:1612&distance=1
         elif method == u'xrefToOMOP':
             # curie is required
             curie = args.get(u'curie')
-            if curie is None or curie == [u'']:
+            if curie is None or curie == [u''] or curie.strip() == u'':
                 return u'No curie was specified', 400
 
             distance = args.get(u'distance')
             if distance is None or distance == [u'']:
                 distance = _DEFAULT_OXO_DISTANCE
 
-            json_return = xref_to_omop_standard_concept(cur, curie, distance)
+            curies = [x.strip() for x in curie.split(u',') if x.strip() != u'']
+            if len(curies) > _MAX_XREF_CURIES:
+                return u'Too many CURIEs: at most %d may be specified' % _MAX_XREF_CURIES, 400
+
+            try:
+                if len(curies) == 1:
+                    json_return = xref_to_omop_standard_concept(cur, curies[0], distance)
+                else:
+                    # Remove duplicates, keeping the order
+                    unique_curies = []
+                    unique_curies_set = set()
+                    for x in curies:
+                        if x not in unique_curies_set:
+                            unique_curies.append(x)
+                            unique_curies_set.add(x)
+                    curies = unique_curies
+                    json_return = xref_to_omop_standard_concepts(cur, curies, distance)
+            except OxoUnavailable:
+                return u'OxO service unavailable, please try again later', 503
 
         # Cross reference from OMOP using OXO service
         # e.g. /api/v1/query?service=omop&meta=xrefFromOMOP?concept_id=192855&distance=1
+        # Multiple comma separated concept_ids return the mappings of each concept, with partial=true if some OxO
+        # searches did not finish before the deadline
+        # e.g. /api/v1/query?service=omop&meta=xrefFromOMOP?concept_id=192855,4196636&distance=1
         elif method == u'xrefFromOMOP':
             # curie is required
             concept_id = args.get(u'concept_id')
-            if concept_id is None or concept_id == [u''] or not concept_id.strip().isdigit():
+            if concept_id is None or concept_id == [u'']:
                 return u'No curie was specified', 400
-            else:
-                concept_id = int(concept_id)
+            concept_ids = [x.strip() for x in concept_id.split(u',') if x.strip() != u'']
+            if len(concept_ids) == 0 or not all(x.isdigit() for x in concept_ids):
+                return u'No curie was specified', 400
+            if len(concept_ids) > _MAX_XREF_CONCEPT_IDS:
+                return u'Too many concept_ids: at most %d may be specified' % _MAX_XREF_CONCEPT_IDS, 400
+            concept_ids = [int(x) for x in concept_ids]
 
             # get mapping_targets, if specified
             mapping_targets = args.get(u'mapping_targets')
@@ -241,7 +1516,15 @@ def query_db(service, method, args):
             if distance is None or distance == [u'']:
                 distance = _DEFAULT_OXO_DISTANCE
 
-            json_return = xref_from_omop_standard_concept(cur, concept_id, mapping_targets, distance)
+            try:
+                if len(concept_ids) == 1:
+                    json_return = xref_from_omop_standard_concept(cur, concept_ids[0], mapping_targets, distance)
+                else:
+                    json_return, partial = xref_from_omop_standard_concepts(cur, sorted(set(concept_ids)),
+                                                                            mapping_targets, distance)
+                    response_metadata = {u'partial': partial}
+            except OxoUnavailable:
+                return u'OxO service unavailable, please try again later', 503
 
     elif service == u'frequencies':
         # Looks up observed clinical frequencies for a comma separated list of concepts
@@ -271,8 +1554,7 @@ def query_db(service, method, args):
                 concepts=','.join(['%s' for _ in concept_ids]))
             params = [dataset_id] + concept_ids
 
-            cur.execute(sql, params)
-            json_return = cur.fetchall()
+            json_return = _fetch_results(cur, sql, params, result_format=result_format)
 
         # Looks up observed clinical frequencies for a comma separated list of concepts
         # e.g. /api/v1/query?service=frequencies&meta=pairedConceptFreq&dataset_id=1&q=4196636,437643
@@ -290,7 +1572,7 @@ def query_db(service, method, args):
 
             concept_id_1 = int(qs[0])
             concept_id_2 = int(qs[1])
-            sql = '''SELECT 
+            sql = '''SELECT
                     cpc.dataset_id,
                     cpc.concept_id_1,
                     cpc.concept_id_2,
@@ -298,17 +1580,20 @@ def query_db(service, method, args):
                     cpc.concept_count / (pc.count + 0E0) AS concept_frequency
                 FROM cohd.concept_pair_counts cpc
                 JOIN cohd.patient_count pc ON pc.dataset_id = cpc.dataset_id
-                WHERE cpc.dataset_id = %(dataset_id)s AND  
-                    ((concept_id_1 = %(concept_id_1)s AND concept_id_2 = %(concept_id_2)s) OR 
-                    (concept_id_1 = %(concept_id_2)s AND concept_id_2 = %(concept_id_1)s));'''
+                WHERE cpc.dataset_id = %(dataset_id)s AND ({pair_condition});'''
             params = {
                 'dataset_id': dataset_id,
                 'concept_id_1': concept_id_1,
                 'concept_id_2': concept_id_2
             }
+            if _canonical_pairs_enabled:
+                pair_condition = _canonical_pair_condition(u'cpc', params)
+            else:
+                pair_condition = '(concept_id_1 = %(concept_id_1)s AND concept_id_2 = %(concept_id_2)s) OR ' \
+                                 '(concept_id_1 = %(concept_id_2)s AND concept_id_2 = %(concept_id_1)s)'
+            sql = sql.format(pair_condition=pair_condition)
 
-            cur.execute(sql, params)
-            json_return = cur.fetchall()
+            json_return = _fetch_results(cur, sql, params, result_format=result_format)
 
         # Looks up observed clinical frequencies of all pairs of concepts given a concept id
         # e.g. /api/v1/query?service=frequencies&meta=associatedConceptFreq&dataset_id=1&q=4196636
@@ -324,41 +1609,66 @@ def query_db(service, method, args):
 
             concept_id = int(query)
 
-            sql = '''SELECT *
-                FROM
-                    ((SELECT 
-                        cpc.dataset_id, 
-                        cpc.concept_id_1 AS concept_id,
-                        cpc.concept_id_2 AS associated_concept_id,                    
-                        cpc.concept_count, 
-                        cpc.concept_count / (pc.count + 0E0) AS concept_frequency,
-                        c.concept_name AS associated_concept_name, 
-                        c.domain_id AS associated_domain_id
-                    FROM cohd.concept_pair_counts cpc
-                    JOIN cohd.concept c ON concept_id_2 = c.concept_id     
-                    JOIN cohd.patient_count pc ON cpc.dataset_id = pc.dataset_id          
-                    WHERE cpc.dataset_id = %(dataset_id)s AND concept_id_1 = %(concept_id)s)
-                    UNION
-                    (SELECT 
-                        cpc.dataset_id, 
-                        cpc.concept_id_2 AS concept_id,
-                        cpc.concept_id_1 AS associated_concept_id,                    
-                        cpc.concept_count, 
-                        cpc.concept_count / (pc.count + 0E0) AS concept_frequency,
-                        c.concept_name AS associated_concept_name, 
-                        c.domain_id AS associated_domain_id
-                    FROM cohd.concept_pair_counts cpc
-                    JOIN cohd.concept c ON concept_id_1 = c.concept_id             
-                    JOIN cohd.patient_count pc ON cpc.dataset_id = pc.dataset_id      
-                    WHERE cpc.dataset_id = %(dataset_id)s AND concept_id_2 = %(concept_id)s)) x
-                ORDER BY concept_count DESC;'''
-            params = {
-                'dataset_id': dataset_id,
-                'concept_id': concept_id
-            }
+            page = _get_page_args(args)
+            if isinstance(page, tuple):
+                return page
+
+            if _cooccurrence_enabled:
+                matrix = cooccurrence.get_matrix(conn, dataset_id)
+                json_return, total_count = matrix.associated_concept_freq(concept_id, page=_fetch_page(page)) \
+                    if matrix is not None else ([], 0)
+            elif _canonical_pairs_enabled:
+                json_return, total_count = _query_adjacent_freqs(cur, dataset_id, concept_id, None, page,
+                                                                   _concept_dictionary(conn))
+            else:
+                sql = '''SELECT {select}
+                    FROM
+                        ((SELECT 
+                            cpc.dataset_id, 
+                            cpc.concept_id_1 AS concept_id,
+                            cpc.concept_id_2 AS associated_concept_id,                    
+                            cpc.concept_count, 
+                            cpc.concept_count / (pc.count + 0E0) AS concept_frequency,
+                            c.concept_name AS associated_concept_name, 
+                            c.domain_id AS associated_domain_id
+                        FROM cohd.concept_pair_counts cpc
+                        JOIN cohd.concept c ON concept_id_2 = c.concept_id     
+                        JOIN cohd.patient_count pc ON cpc.dataset_id = pc.dataset_id          
+                        WHERE cpc.dataset_id = %(dataset_id)s AND concept_id_1 = %(concept_id)s
+                            {conditions_1}
+                        {order_limit_1})
+                        UNION
+                        (SELECT 
+                            cpc.dataset_id, 
+                            cpc.concept_id_2 AS concept_id,
+                            cpc.concept_id_1 AS associated_concept_id,                    
+                            cpc.concept_count, 
+                            cpc.concept_count / (pc.count + 0E0) AS concept_frequency,
+                            c.concept_name AS associated_concept_name, 
+                            c.domain_id AS associated_domain_id
+                        FROM cohd.concept_pair_counts cpc
+                        JOIN cohd.concept c ON concept_id_1 = c.concept_id             
+                        JOIN cohd.patient_count pc ON cpc.dataset_id = pc.dataset_id      
+                        WHERE cpc.dataset_id = %(dataset_id)s AND concept_id_2 = %(concept_id)s
+                            {conditions_2}
+                        {order_limit_2})) x
+                    {order_limit};'''
+                params = {
+                    'dataset_id': dataset_id,
+                    'concept_id': concept_id
+                }
 
-            cur.execute(sql, params)
-            json_return = cur.fetchall()
+                branches = [
+                    (u'cpc.concept_count', u'cpc.concept_id_2', u'cpc.concept_count',
+                     u'cpc.concept_count / (pc.count + 0E0)'),
+                    (u'cpc.concept_count', u'cpc.concept_id_1', u'cpc.concept_count',
+                     u'cpc.concept_count / (pc.count + 0E0)')
+                ]
+                json_return, total_count = _query_ranked(cur, sql, params, page, branches,
+                                                         (u'concept_count', u'associated_concept_id'))
+
+            json_return, response_metadata = _page_results(json_return, page, u'concept_count',
+                                                           u'associated_concept_id', total_count)
 
         # Looks up observed clinical frequencies of all pairs of concepts given a concept id restricted by domain of the
         # associated concept_id
@@ -379,44 +1689,102 @@ def query_db(service, method, args):
 
             concept_id = int(concept_id)
 
-            sql = '''SELECT *
-                FROM
-                    ((SELECT 
-                        cpc.dataset_id, 
-                        cpc.concept_id_1 AS concept_id,
-                        cpc.concept_id_2 AS associated_concept_id,                    
-                        cpc.concept_count, 
-                        cpc.concept_count / (pc.count + 0E0) AS concept_frequency,
-                        c.concept_name AS associated_concept_name, 
-                        c.domain_id AS associated_domain_id
-                    FROM cohd.concept_pair_counts cpc
-                    JOIN cohd.concept c ON concept_id_2 = c.concept_id     
-                    JOIN cohd.patient_count pc ON cpc.dataset_id = pc.dataset_id          
-                    WHERE cpc.dataset_id = %(dataset_id)s AND concept_id_1 = %(concept_id)s
-                        AND c.domain_id = %(domain_id)s)
-                    UNION
-                    (SELECT 
-                        cpc.dataset_id, 
-                        cpc.concept_id_2 AS concept_id,
-                        cpc.concept_id_1 AS associated_concept_id,                    
-                        cpc.concept_count, 
-                        cpc.concept_count / (pc.count + 0E0) AS concept_frequency,
-                        c.concept_name AS associated_concept_name, 
-                        c.domain_id AS associated_domain_id
-                    FROM cohd.concept_pair_counts cpc
-                    JOIN cohd.concept c ON concept_id_1 = c.concept_id             
-                    JOIN cohd.patient_count pc ON cpc.dataset_id = pc.dataset_id      
-                    WHERE cpc.dataset_id = %(dataset_id)s AND concept_id_2 = %(concept_id)s
-                        AND c.domain_id = %(domain_id)s)) x
-                ORDER BY concept_count DESC;'''
-            params = {
-                'dataset_id': dataset_id,
-                'concept_id': concept_id,
-                'domain_id': domain_id
-            }
+            page = _get_page_args(args)
+            if isinstance(page, tuple):
+                return page
+
+            if _cooccurrence_enabled:
+                matrix = cooccurrence.get_matrix(conn, dataset_id)
+                json_return, total_count = matrix.associated_concept_freq(concept_id, domain_id, page=_fetch_page(page)) \
+                    if matrix is not None else ([], 0)
+            elif _canonical_pairs_enabled:
+                json_return, total_count = _query_adjacent_freqs(cur, dataset_id, concept_id, domain_id, page,
+                                                                   _concept_dictionary(conn))
+            else:
+                sql = '''SELECT {select}
+                    FROM
+                        ((SELECT 
+                            cpc.dataset_id, 
+                            cpc.concept_id_1 AS concept_id,
+                            cpc.concept_id_2 AS associated_concept_id,                    
+                            cpc.concept_count, 
+                            cpc.concept_count / (pc.count + 0E0) AS concept_frequency,
+                            c.concept_name AS associated_concept_name, 
+                            c.domain_id AS associated_domain_id
+                        FROM cohd.concept_pair_counts cpc
+                        JOIN cohd.concept c ON concept_id_2 = c.concept_id     
+                        JOIN cohd.patient_count pc ON cpc.dataset_id = pc.dataset_id          
+                        WHERE cpc.dataset_id = %(dataset_id)s AND concept_id_1 = %(concept_id)s
+                            AND c.domain_id = %(domain_id)s
+                            {conditions_1}
+                        {order_limit_1})
+                        UNION
+                        (SELECT 
+                            cpc.dataset_id, 
+                            cpc.concept_id_2 AS concept_id,
+                            cpc.concept_id_1 AS associated_concept_id,                    
+                            cpc.concept_count, 
+                            cpc.concept_count / (pc.count + 0E0) AS concept_frequency,
+                            c.concept_name AS associated_concept_name, 
+                            c.domain_id AS associated_domain_id
+                        FROM cohd.concept_pair_counts cpc
+                        JOIN cohd.concept c ON concept_id_1 = c.concept_id             
+                        JOIN cohd.patient_count pc ON cpc.dataset_id = pc.dataset_id      
+                        WHERE cpc.dataset_id = %(dataset_id)s AND concept_id_2 = %(concept_id)s
+                            AND c.domain_id = %(domain_id)s
+                            {conditions_2}
+                        {order_limit_2})) x
+                    {order_limit};'''
+                params = {
+                    'dataset_id': dataset_id,
+                    'concept_id': concept_id,
+                    'domain_id': domain_id
+                }
 
-            cur.execute(sql, params)
-            json_return = cur.fetchall()
+                branches = [
+                    (u'cpc.concept_count', u'cpc.concept_id_2', u'cpc.concept_count',
+                     u'cpc.concept_count / (pc.count + 0E0)'),
+                    (u'cpc.concept_count', u'cpc.concept_id_1', u'cpc.concept_count',
+                     u'cpc.concept_count / (pc.count + 0E0)')
+                ]
+                json_return, total_count = _query_ranked(cur, sql, params, page, branches,
+                                                         (u'concept_count', u'associated_concept_id'))
+
+            json_return, response_metadata = _page_results(json_return, page, u'concept_count',
+                                                           u'associated_concept_id', total_count)
+
+        # Looks up observed clinical frequencies of all pairs in a comma separated list of concepts, optionally with
+        # chi_square and/or ln_ratio. Returns the observed pairs as triplets, or n x n matrices with format=matrix.
+        # e.g. /api/v1/query?service=frequencies&meta=pairwiseConceptFreq&dataset_id=1&q=4196636,437643,192855&
+        # statistics=chi_square,ln_ratio&format=matrix
+        elif method == u'pairwiseConceptFreq':
+            dataset_id = _get_arg_datset_id(args)
+
+            # Check q parameter
+            if query is None or query == [u''] or query.isspace():
+                return u'q parameter is missing', 400
+            concept_ids = _parse_concept_ids(query)
+            if concept_ids is None:
+                return u'Error in q: concept_ids should be integers', 400
+
+            # Remove duplicates, keeping the order
+            unique_concept_ids = []
+            seen = set()
+            for concept_id in concept_ids:
+                if concept_id not in seen:
+                    unique_concept_ids.append(concept_id)
+                    seen.add(concept_id)
+            if len(unique_concept_ids) > _MAX_CONCEPT_SET_SIZE:
+                return u'Error in q: at most %d concept_ids may be specified' % _MAX_CONCEPT_SET_SIZE, 400
+
+            statistics = args.get(u'statistics')
+            statistics = [x.strip() for x in statistics.split(u',') if x.strip() != u''] if statistics else []
+            if any(x not in _PAIRWISE_STATISTICS for x in statistics):
+                return u'statistics should be a comma separated list of %s' % u', '.join(_PAIRWISE_STATISTICS), 400
+
+            # format is either the layout of the pairs (triplets or matrix) or a response format of the triplets
+            json_return = _pairwise_concept_freq(cur, dataset_id, unique_concept_ids, statistics,
+                                                 args.get(u'format') == u'matrix')
 
         # Returns most common single concept frequencies
         # e.g. /api/v1/query?service=frequencies&meta=mostFrequentConcept&dataset_id=1&q=100
@@ -437,30 +1805,53 @@ def query_db(service, method, args):
                         cc.concept_id, 
                         cc.concept_count, 
                         cc.concept_count / (pc.count + 0E0) AS concept_frequency,
-                        c.domain_id, c.concept_name 
+                        {concept_columns}
                     FROM cohd.concept_counts cc
-                    JOIN cohd.concept c ON cc.concept_id = c.concept_id
+                    {concept_join}
                     JOIN cohd.patient_count pc ON cc.dataset_id = pc.dataset_id
                     WHERE cc.dataset_id = %(dataset_id)s
                     '''
 
             # Check domain parameter
             domain_id = args.get(u'domain')
+            dictionary = None
             if domain_id is not None and domain_id != [u''] and not domain_id.isspace():
                 sql += '''    AND c.domain_id = %(domain_id)s
                     '''
                 params['domain_id'] = domain_id
+            else:
+                dictionary = _concept_dictionary(conn)
 
             sql += '''ORDER BY concept_count DESC 
                     LIMIT %(limit_n)s;'''
 
-            cur.execute(sql, params)
-            json_return = cur.fetchall()
+            concept_columns, concept_join = _concept_sql(dictionary, u'cc.concept_id', u'concept_name', u'domain_id')
+            sql = sql.format(concept_columns=concept_columns, concept_join=concept_join)
+            json_return = _attach_concepts(dictionary, _fetch_results(cur, sql, params, result_format=result_format),
+                                           u'concept_id', u'concept_name', u'domain_id')
 
     elif service == u'association':
+        concept_id_2 = args.get(u'concept_id_2')
+        all_pairs = concept_id_2 is None or not concept_id_2.strip().isdigit()
+
+        # Top-k and pagination parameters
+        page = _get_page_args(args)
+        if isinstance(page, tuple):
+            return page
+
+        # Returns associations between concept_id_1 and all other concepts from the precomputed statistics
+        if all_pairs and _association_stats_enabled and method in _ASSOCIATION_STATS_COLUMNS:
+            results = _query_association_stats(cur, method, args, page, _concept_dictionary(conn))
+            if isinstance(results[0], unicode):
+                # Error message and status
+                return results
+            json_return, total_count = results
+            json_return, response_metadata = _page_results(json_return, page, _ASSOCIATION_STATS_COLUMNS[method][0],
+                                                           u'concept_id_2', total_count)
+
         # Returns chi-square between pairs of concepts
         # e.g. /api/v1/query?service=association&meta=chiSquare&dataset_id=1&concept_id_1=192855&concept_id_2=2008271
-        if method == u'chiSquare':
+        elif method == u'chiSquare':
             # Get non-required parameters
             dataset_id = _get_arg_datset_id(args)
             concept_id_2 = args.get(u'concept_id_2')
@@ -471,6 +1862,8 @@ def query_db(service, method, args):
             if concept_id_1 is None or concept_id_1 == [u''] or not concept_id_1.strip().isdigit():
                 return u'No concept_id_1 selected', 400
             concept_id_1 = int(concept_id_1)
+            # Concept dictionary that the names of the associated concepts are attached from, if any
+            dictionary = None
 
             if concept_id_2 is not None and concept_id_2.strip().isdigit():
                 # concept_id_2 is specified, only return the chi-square for the pair (concept_id_1, concept_id_2)
@@ -490,13 +1883,13 @@ def query_db(service, method, args):
                     WHERE cp.dataset_id = %(dataset_id)s 
                         AND c1.dataset_id = %(dataset_id)s 
                         AND c2.dataset_id = %(dataset_id)s
-                        AND cp.concept_id_1 IN (%(concept_id_1)s, %(concept_id_2)s)
-                        AND cp.concept_id_2 IN (%(concept_id_1)s, %(concept_id_2)s);'''
+                        AND {pair_condition};'''
                 params = {
                     'dataset_id': dataset_id,
                     'concept_id_1': concept_id_1,
                     'concept_id_2': concept_id_2
                 }
+                sql = sql.format(pair_condition=_association_pair_condition(params))
 
             else:
                 # If concept_id_2 is not specified, get results for all pairs that include concept_id_1
@@ -554,41 +1947,60 @@ def query_db(service, method, args):
                     params['domain_id'] = domain_id
                 else:
                     domain_filter = ''
-                sql = sql.format(domain_filter=domain_filter)
+                if _canonical_pairs_enabled:
+                    # One range scan of all partners of concept_id_1
+                    dictionary = _concept_dictionary(conn) if domain_filter == '' else None
+                    sql = _adjacent_associations_sql(method, dictionary).format(select=u'*',
+                                                                                domain_filter=domain_filter,
+                                                                                conditions_1=u'', order_limit_1=u'',
+                                                                                order_limit=u'')
+                else:
+                    sql = sql.format(domain_filter=domain_filter)
 
-            cur.execute(sql, params)
-            results = cur.fetchall()
-
-            # Calculate the p-value using chi-square distribution with 1 degree of freedom
-            chi_squares = []
-            for r in results:
-                # Get observed counts
-                cpc = float(r[u'concept_pair_count'])
-                c1 = float(r[u'concept_count_1'])
-                c2 = float(r[u'concept_count_2'])
-                pts = float(r[u'patient_count'])
-                neg = pts - c1 - c2 + cpc
-
-                # Create the observed and expected RxC tables and perform chi-square
-                o = [neg, c1 - cpc, c2 - cpc, cpc]
-                e = [(pts - c1) * (pts - c2) / pts, c1 * (pts - c2) / pts, c2 * (pts - c1) / pts, c1 * c2 / pts]
-                cs = chisquare(o, e, 2)
+            if concept_id_2 is None and _cooccurrence_enabled:
+                matrix = cooccurrence.get_matrix(conn, dataset_id)
+                results = matrix.chi_square_counts(concept_id_1, domain_id) if matrix is not None else []
+            else:
+                cur.execute(sql, params)
+                results = _attach_concepts(dictionary, list(cur.fetchall()), u'concept_id_2', u'concept_2_name',
+                                           u'concept_2_domain')
+
+            # Calculate the chi-square and p-value for all pairs at once
+            chi_squares, p_values = chi_square([r[u'concept_pair_count'] for r in results],
+                                               [r[u'concept_count_1'] for r in results],
+                                               [r[u'concept_count_2'] for r in results],
+                                               [r[u'patient_count'] for r in results])
+
+            # Filter and sort results by chi-square, only building the rows that are returned
+            fetch_page = _fetch_page(page)
+            ids = np.array([r[u'concept_id_2'] for r in results], dtype=np.int64)
+            selected, total_count = page_mask(chi_squares, ids, np.array([r[u'concept_pair_count'] for r in results]),
+                                              fetch_page)
+            selected = np.flatnonzero(selected)
+            if fetch_page[u'limit'] is None and fetch_page[u'cursor'] is None:
+                # Without pagination, rank as the original per-row implementation did, with tied rows in reverse order
+                # of the query results
+                order = selected[np.argsort(chi_squares[selected])[::-1]]
+            else:
+                # Keyset pagination needs a total order: ties are broken by concept_id_2
+                order = selected[rank_descending(chi_squares[selected], fetch_page[u'limit'], ids[selected])]
+            for i in order:
+                r = results[i]
                 new_r = {
                     u'dataset_id': r[u'dataset_id'],
                     u'concept_id_1': r[u'concept_id_1'],
                     u'concept_id_2': r[u'concept_id_2'],
-                    u'chi_square': cs.statistic,
-                    u'p-value': cs.pvalue
+                    u'chi_square': float(chi_squares[i]),
+                    u'p-value': float(p_values[i])
                 }
                 if concept_id_2 is None:
                     new_r[u'concept_2_name'] = r[u'concept_2_name']
                     new_r[u'concept_2_domain'] = r[u'concept_2_domain']
 
                 json_return.append(new_r)
-                chi_squares.append(cs.statistic)
 
-            # Sort results by chi-square
-            json_return = [json_return[i] for i in list(reversed(argsort(chi_squares)))]
+            json_return, response_metadata = _page_results(json_return, page, u'chi_square', u'concept_id_2',
+                                                           total_count)
 
         # Returns ratio of observed to expected frequency between pairs of concepts
         # e.g. /api/v1/query?service=association&meta=obsExpRatio&dataset_id=1&concept_id_1=192855&concept_id_2=2008271
@@ -603,7 +2015,8 @@ def query_db(service, method, args):
             if concept_id_1 is None or concept_id_1 == [u''] or not concept_id_1.strip().isdigit():
                 return u'No concept_id_1 selected', 400
 
-            if concept_id_2 is not None and concept_id_2.strip().isdigit():
+            all_pairs = concept_id_2 is None or not concept_id_2.strip().isdigit()
+            if not all_pairs:
                 # concept_id_2 is specified, only return the results for the pair (concept_id_1, concept_id_2)
                 sql = '''SELECT 
                         cp.dataset_id, 
@@ -619,17 +2032,17 @@ def query_db(service, method, args):
                     WHERE cp.dataset_id = %(dataset_id)s 
                         AND c1.dataset_id = %(dataset_id)s 
                         AND c2.dataset_id = %(dataset_id)s
-                        AND cp.concept_id_1 IN (%(concept_id_1)s, %(concept_id_2)s)
-                        AND cp.concept_id_2 IN (%(concept_id_1)s, %(concept_id_2)s);'''
+                        AND {pair_condition};'''
                 params = {
                     'dataset_id': dataset_id,
-                    'concept_id_1': concept_id_1,
+                    'concept_id_1': int(concept_id_1),
                     'concept_id_2': int(concept_id_2)
                 }
+                sql = sql.format(pair_condition=_association_pair_condition(params))
 
             else:
                 # If concept_id_2 is not specified, get results for all pairs that include concept_id_1
-                sql = '''SELECT * 
+                sql = '''SELECT {select} 
                     FROM
                         ((SELECT 
                             cp.dataset_id, 
@@ -649,7 +2062,9 @@ def query_db(service, method, args):
                             AND c1.dataset_id = %(dataset_id)s 
                             AND c2.dataset_id = %(dataset_id)s
                             AND cp.concept_id_1 = %(concept_id_1)s 
-                            {domain_filter})
+                            {domain_filter}
+                            {conditions_1}
+                        {order_limit_1})
                         UNION
                         (SELECT 
                             cp.dataset_id, 
@@ -669,8 +2084,10 @@ def query_db(service, method, args):
                             AND c1.dataset_id = %(dataset_id)s 
                             AND c2.dataset_id = %(dataset_id)s
                             AND cp.concept_id_2 = %(concept_id_1)s 
-                            {domain_filter})) x
-                    ORDER BY ln_ratio DESC;'''
+                            {domain_filter}
+                            {conditions_2}
+                        {order_limit_2})) x
+                    {order_limit};'''
                 params = {
                     'dataset_id': dataset_id,
                     'concept_id_1': concept_id_1,
@@ -683,10 +2100,35 @@ def query_db(service, method, args):
                 else:
                     # Unrestricted domain
                     domain_filter = ''
-                sql = sql.format(domain_filter=domain_filter)
 
-            cur.execute(sql, params)
-            json_return = cur.fetchall()
+            if not all_pairs:
+                cur.execute(sql, params)
+                json_return = cur.fetchall()
+            else:
+                if _cooccurrence_enabled:
+                    matrix = cooccurrence.get_matrix(conn, dataset_id)
+                    json_return, total_count = matrix.obs_exp_ratio(int(concept_id_1), domain_id, _fetch_page(page)) \
+                        if matrix is not None else ([], 0)
+                elif _canonical_pairs_enabled:
+                    ln_ratio_sql = u'log(a.concept_count * pc.count / (c1.concept_count * c2.concept_count + 0E0))'
+                    branches = [(ln_ratio_sql, u'a.associated_concept_id', u'a.concept_count', None)]
+                    dictionary = _concept_dictionary(conn) if domain_filter == '' else None
+                    json_return, total_count = _query_ranked(cur, _adjacent_associations_sql(method, dictionary),
+                                                             params, page, branches, (u'ln_ratio', u'concept_id_2'),
+                                                             domain_filter=domain_filter)
+                    json_return = _attach_concepts(dictionary, json_return, u'concept_id_2', u'concept_2_name',
+                                                   u'concept_2_domain')
+                else:
+                    ln_ratio_sql = u'log(cp.concept_count * pc.count / (c1.concept_count * c2.concept_count + 0E0))'
+                    branches = [
+                        (ln_ratio_sql, u'cp.concept_id_2', u'cp.concept_count', None),
+                        (ln_ratio_sql, u'cp.concept_id_1', u'cp.concept_count', None)
+                    ]
+                    json_return, total_count = _query_ranked(cur, sql, params, page, branches,
+                                                             (u'ln_ratio', u'concept_id_2'),
+                                                             domain_filter=domain_filter)
+                json_return, response_metadata = _page_results(json_return, page, u'ln_ratio', u'concept_id_2',
+                                                               total_count)
 
         # Returns relative frequency between pairs of concepts
         # e.g. /api/v1/query?service=association&meta=relativeFrequency&dataset_id=1&concept_id_1=192855&concept_id_2=2008271
@@ -701,7 +2143,8 @@ def query_db(service, method, args):
             if concept_id_1 is None or concept_id_1 == [u''] or not concept_id_1.strip().isdigit():
                 return u'No concept_id_1 selected', 400
 
-            if concept_id_2 is not None and concept_id_2.strip().isdigit():
+            all_pairs = concept_id_2 is None or not concept_id_2.strip().isdigit()
+            if not all_pairs:
                 # concept_id_2 is specified, only return the results for the pair (concept_id_1, concept_id_2)
                 sql = '''(SELECT
                         cp.dataset_id,
@@ -732,13 +2175,28 @@ def query_db(service, method, args):
                         AND cp.concept_id_2 = %(concept_id_1)s);'''
                 params = {
                     'dataset_id': dataset_id,
-                    'concept_id_1': concept_id_1,
+                    'concept_id_1': int(concept_id_1),
                     'concept_id_2': int(concept_id_2)
                 }
 
+                if _canonical_pairs_enabled:
+                    # One primary key lookup of the pair, returned in the requested orientation
+                    sql = '''SELECT
+                            cp.dataset_id,
+                            %(concept_id_1)s AS concept_id_1,
+                            %(concept_id_2)s AS concept_id_2,
+                            cp.concept_count AS concept_pair_count,
+                            cc.concept_count AS concept_2_count,
+                            cp.concept_count / (cc.concept_count + 0E0) AS relative_frequency
+                        FROM cohd.concept_pair_counts cp
+                        JOIN cohd.concept_counts cc ON cc.concept_id = %(concept_id_2)s
+                        WHERE cp.dataset_id = %(dataset_id)s
+                            AND cc.dataset_id = %(dataset_id)s
+                            AND {pair_condition};'''.format(pair_condition=_canonical_pair_condition(u'cp', params))
+
             else:
                 # If concept_id_2 is not specified, get results for all pairs that include concept_id_1
-                sql = '''SELECT *
+                sql = '''SELECT {select}
                     FROM
                         ((SELECT
                             cp.dataset_id,
@@ -755,7 +2213,9 @@ def query_db(service, method, args):
                         WHERE cp.dataset_id = %(dataset_id)s
                             AND cc.dataset_id = %(dataset_id)s
                             AND cp.concept_id_1 = %(concept_id_1)s
-                            {domain_filter})
+                            {domain_filter}
+                            {conditions_1}
+                        {order_limit_1})
                         UNION
                         (SELECT
                             cp.dataset_id,
@@ -772,8 +2232,10 @@ def query_db(service, method, args):
                         WHERE cp.dataset_id = %(dataset_id)s
                             AND cc.dataset_id = %(dataset_id)s
                             AND cp.concept_id_2 = %(concept_id_1)s
-                            {domain_filter})) x
-                    ORDER BY relative_frequency DESC;'''
+                            {domain_filter}
+                            {conditions_2}
+                        {order_limit_2})) x
+                    {order_limit};'''
                 params = {
                     'dataset_id': dataset_id,
                     'concept_id_1': concept_id_1,
@@ -786,18 +2248,52 @@ def query_db(service, method, args):
                 else:
                     # Unrestricted domain
                     domain_filter = ''
-                sql = sql.format(domain_filter=domain_filter)
 
-            cur.execute(sql, params)
-            json_return = cur.fetchall()
+            if not all_pairs:
+                cur.execute(sql, params)
+                json_return = cur.fetchall()
+            else:
+                if _cooccurrence_enabled:
+                    matrix = cooccurrence.get_matrix(conn, dataset_id)
+                    json_return, total_count = \
+                        matrix.relative_frequency(int(concept_id_1), domain_id, _fetch_page(page)) \
+                        if matrix is not None else ([], 0)
+                elif _canonical_pairs_enabled:
+                    relative_frequency = u'a.concept_count / (c2.concept_count + 0E0)'
+                    branches = [(relative_frequency, u'a.associated_concept_id', u'a.concept_count', None)]
+                    dictionary = _concept_dictionary(conn) if domain_filter == '' else None
+                    json_return, total_count = _query_ranked(cur, _adjacent_associations_sql(method, dictionary),
+                                                             params, page, branches,
+                                                             (u'relative_frequency', u'concept_id_2'),
+                                                             domain_filter=domain_filter)
+                    json_return = _attach_concepts(dictionary, json_return, u'concept_id_2', u'concept_2_name',
+                                                   u'concept_2_domain')
+                else:
+                    relative_frequency = u'cp.concept_count / (cc.concept_count + 0E0)'
+                    branches = [
+                        (relative_frequency, u'cp.concept_id_2', u'cp.concept_count', None),
+                        (relative_frequency, u'cp.concept_id_1', u'cp.concept_count', None)
+                    ]
+                    json_return, total_count = _query_ranked(cur, sql, params, page, branches,
+                                                             (u'relative_frequency', u'concept_id_2'),
+                                                             domain_filter=domain_filter)
+                json_return, response_metadata = _page_results(json_return, page, u'relative_frequency',
+                                                               u'concept_id_2', total_count)
+
+    if isinstance(json_return, _StreamedQuery):
+        # The query is run and its results are streamed by query_db
+        cur.close()
+        json_return.metadata = response_metadata
+        return json_return
 
     print cur._executed
     # print(json_return)
 
     cur.close()
-    conn.close()
-
-    json_return = {u"results": json_return}
-    json_return = jsonify(json_return)
 
-    return json_return
+    response = _format_results(json_return, response_metadata, result_format)
+    if response_metadata.get(u'partial') and isinstance(response, Response):
+        # Partial results are not cached (by the response cache or by clients), so that the complete results are
+        # returned once OxO recovers
+        response.headers[u'Cache-Control'] = u'no-store'
+    return response
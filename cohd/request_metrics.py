@@ -0,0 +1,422 @@
+u"""
+Per-request timing and Prometheus metrics
+
+Each API request is timed by phase: connect (waiting for a pooled connection), sql (executing queries and fetching
+rows), serialize (encoding the JSON response), oxo (OxO requests), analytics (queueing the Google Analytics hit), and
+compute (the rest: statistics, result processing, and Flask). The phases, the total duration, the number of result rows,
+and the response bytes are recorded per (service, meta) as Prometheus counters and histograms, and rendered in the
+Prometheus text format by the /metrics endpoint.
+
+uWSGI workers are separate processes, so with METRICS_DIR each process keeps its values in its own memory-mapped file
+in that directory, and /metrics sums the files of all processes, whichever worker handles the scrape. The files are
+named by uWSGI worker id (metrics_worker_<id>.db), and a respawned worker continues the counters of the worker it
+replaces, so that counters never go backwards and there is one file per worker. Outside of uWSGI, the files are named by
+pid (metrics_<pid>.db). Empty the directory when the service is started.
+Without METRICS_DIR, the values are kept in memory and only cover the process that handles the scrape.
+"""
+
+import bisect
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import timeit
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+# Upper bounds of the duration histogram buckets, in seconds
+_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float(u'inf'))
+_PHASES = (u'connect', u'sql', u'serialize', u'oxo', u'analytics')
+
+# name: (type, help)
+_METRICS = {
+    u'cohd_requests_total': (u'counter', u'Requests by service, meta, and status code'),
+    u'cohd_request_duration_seconds': (u'histogram', u'Duration of the requests'),
+    u'cohd_request_phase_seconds': (u'histogram', u'Time spent in each phase of the requests'),
+    u'cohd_result_rows_total': (u'counter', u'Rows fetched from the database'),
+    u'cohd_response_bytes_total': (u'counter', u'Bytes of the response bodies'),
+}
+
+# Size of a new metrics file; it is doubled when full
+_INITIAL_FILE_SIZE = 1 << 16
+
+_enabled = False
+_directory = None
+_values = None
+_values_pid = None
+_values_lock = threading.Lock()
+_current = threading.local()
+
+
+class _MemoryValues(object):
+    """ Values of this process, in memory """
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, key, amount):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def items(self):
+        with self._lock:
+            return list(self._values.items())
+
+
+class _FileValues(object):
+    """ Values of this process, in a memory-mapped file that other processes read
+
+    The file starts with the number of bytes used (int64), followed by entries of a key length (int32), the UTF-8 key
+    padded to a multiple of 8 bytes, and the value (float64). Entries are only appended, and values are updated in
+    place. An existing file (e.g., of the worker that a respawned uWSGI worker replaces) is continued, not truncated.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._offsets = {}
+        if os.path.exists(path):
+            self._file = open(path, u'r+b')
+            size = max(os.fstat(self._file.fileno()).st_size, _INITIAL_FILE_SIZE)
+        else:
+            self._file = open(path, u'w+b')
+            size = _INITIAL_FILE_SIZE
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._used = 8
+        for key, offset, _ in self._entries(self._map):
+            self._offsets[key] = offset
+            self._used = offset + 8
+        struct.pack_into(u'<q', self._map, 0, self._used)
+
+    def _add(self, key):
+        encoded = key.encode(u'utf-8')
+        padded = len(encoded) + (-(4 + len(encoded)) % 8)
+        size = 4 + padded + 8
+        if self._used + size > len(self._map):
+            new_size = len(self._map)
+            while self._used + size > new_size:
+                new_size *= 2
+            self._map.close()
+            self._file.truncate(new_size)
+            self._map = mmap.mmap(self._file.fileno(), new_size)
+        struct.pack_into(u'<i%ds' % padded, self._map, self._used, len(encoded), encoded)
+        offset = self._used + 4 + padded
+        struct.pack_into(u'<d', self._map, offset, 0.0)
+        self._used += size
+        # Publish the entry only after it is written
+        struct.pack_into(u'<q', self._map, 0, self._used)
+        self._offsets[key] = offset
+        return offset
+
+    def inc(self, key, amount):
+        with self._lock:
+            offset = self._offsets.get(key)
+            if offset is None:
+                offset = self._add(key)
+            value = struct.unpack_from(u'<d', self._map, offset)[0]
+            struct.pack_into(u'<d', self._map, offset, value + amount)
+
+    @staticmethod
+    def _entries(data):
+        """ Entries of the contents of a metrics file
+
+        :return: generator of (key, offset of the value, value)
+        """
+        if len(data) < 8:
+            return
+        used = min(struct.unpack_from(u'<q', data, 0)[0], len(data))
+        position = 8
+        while position + 4 <= used:
+            length = struct.unpack_from(u'<i', data, position)[0]
+            padded = length + (-(4 + length) % 8)
+            offset = position + 4 + padded
+            if length < 0 or offset + 8 > used:
+                return
+            key = data[position + 4:position + 4 + length].decode(u'utf-8')
+            yield key, offset, struct.unpack_from(u'<d', data, offset)[0]
+            position = offset + 8
+
+    @staticmethod
+    def read(path):
+        """ Reads the entries of a metrics file
+
+        :return: list of (key, value)
+        """
+        with open(path, u'rb') as f:
+            data = f.read()
+        return [(key, value) for key, _, value in _FileValues._entries(data)]
+
+
+def configure(app_config):
+    """ Enables the request metrics if REQUEST_METRICS is set in the Flask configuration
+
+    METRICS_DIR: directory of the per-process metrics files, to aggregate the metrics of all uWSGI workers
+
+    :param app_config: Flask configuration
+    """
+    global _enabled, _directory, _values
+    _enabled = bool(app_config.get(u'REQUEST_METRICS', False))
+    _directory = app_config.get(u'METRICS_DIR')
+    if _enabled and _directory and not os.path.isdir(_directory):
+        os.makedirs(_directory)
+    with _values_lock:
+        _values = None
+
+
+def _file_name():
+    """ Name of the metrics file of this process: by uWSGI worker id, so that a respawned worker reuses the file of the
+    worker it replaces, or by pid outside of uWSGI workers
+    """
+    worker_id = uwsgi.worker_id() if uwsgi is not None else 0
+    if worker_id > 0:
+        return u'metrics_worker_%d.db' % worker_id
+    return u'metrics_%d.db' % os.getpid()
+
+
+def _process_values():
+    """ The values of this process, created on first use in each process (uWSGI forks the workers after loading) """
+    global _values, _values_pid
+    pid = os.getpid()
+    if _values is not None and _values_pid == pid:
+        return _values
+    with _values_lock:
+        if _values is None or _values_pid != pid:
+            if _directory:
+                _values = _FileValues(os.path.join(_directory, _file_name()))
+            else:
+                _values = _MemoryValues()
+            _values_pid = pid
+        return _values
+
+
+def _key(name, labels):
+    return json.dumps([name, labels])
+
+
+def _observe(values, name, labels, seconds):
+    le = _BUCKETS[min(bisect.bisect_left(_BUCKETS, seconds), len(_BUCKETS) - 1)]
+    values.inc(_key(name + u'_bucket', labels + [[u'le', le]]), 1)
+    values.inc(_key(name + u'_sum', labels), seconds)
+    values.inc(_key(name + u'_count', labels), 1)
+
+
+class RequestTimer(object):
+    """ Times the phases of one request """
+
+    def __init__(self, service, meta):
+        self.labels = [[u'service', service], [u'meta', meta]]
+        self.start = timeit.default_timer()
+        self.phases = dict.fromkeys(_PHASES, 0.0)
+        self.rows = 0
+        self.response_bytes = 0
+        self._finished = False
+
+    def finish(self, status):
+        """ Records the request
+
+        :param status: HTTP status code
+        """
+        if self._finished:
+            return
+        self._finished = True
+        if getattr(_current, u'timer', None) is self:
+            _current.timer = None
+
+        duration = timeit.default_timer() - self.start
+        values = _process_values()
+        values.inc(_key(u'cohd_requests_total', self.labels + [[u'status', unicode(status)]]), 1)
+        values.inc(_key(u'cohd_result_rows_total', self.labels), self.rows)
+        values.inc(_key(u'cohd_response_bytes_total', self.labels), self.response_bytes)
+        _observe(values, u'cohd_request_duration_seconds', self.labels, duration)
+        for phase, seconds in self.phases.items():
+            _observe(values, u'cohd_request_phase_seconds', self.labels + [[u'phase', phase]], seconds)
+        _observe(values, u'cohd_request_phase_seconds', self.labels + [[u'phase', u'compute']],
+                 max(duration - sum(self.phases.values()), 0.0))
+
+    def count_bytes(self, chunks):
+        """ Counts the bytes of a streamed response body as it is sent """
+        for chunk in chunks:
+            self.response_bytes += len(chunk.encode(u'utf-8') if isinstance(chunk, unicode) else chunk)
+            yield chunk
+
+
+def start(service, meta):
+    """ Starts timing a request in this thread
+
+    :return: RequestTimer, or None if the metrics are disabled
+    """
+    if not _enabled:
+        return None
+    _current.timer = RequestTimer(service, meta)
+    return _current.timer
+
+
+def finish(timer, response):
+    """ Records the request when its response has been sent
+
+    :param timer: RequestTimer from start(), or None
+    :param response: Flask Response, (body, status code), or body
+    :return: response
+    """
+    if timer is None:
+        return response
+    if isinstance(response, (tuple, basestring)):
+        body, status = response if isinstance(response, tuple) else (response, 200)
+        timer.response_bytes = len(body.encode(u'utf-8') if isinstance(body, unicode) else body)
+        timer.finish(status)
+    elif response.is_streamed:
+        # Streamed responses are recorded when they are closed, after the rows have been fetched and sent
+        response.response = timer.count_bytes(response.response)
+        response.call_on_close(lambda: timer.finish(response.status_code))
+    else:
+        timer.response_bytes = response.content_length or 0
+        timer.finish(response.status_code)
+    return response
+
+
+class _Phase(object):
+    """ Adds the time spent in the block to a phase of the current request """
+
+    def __init__(self, name):
+        self._name = name
+        self._timer = None
+        self._start = None
+
+    def __enter__(self):
+        self._timer = getattr(_current, u'timer', None)
+        if self._timer is not None:
+            self._start = timeit.default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._timer is not None:
+            self._timer.phases[self._name] += timeit.default_timer() - self._start
+        return False
+
+
+def phase(name):
+    """ Context manager that times a phase of the current request: with request_metrics.phase(u'oxo'): ... """
+    return _Phase(name)
+
+
+class _TimedCursor(object):
+    """ Cursor that adds the time spent executing and fetching to the sql phase, and counts the fetched rows """
+
+    def __init__(self, cur, timer):
+        self._cur = cur
+        self._timer = timer
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def _timed(self, method, *args):
+        start = timeit.default_timer()
+        try:
+            return method(*args)
+        finally:
+            self._timer.phases[u'sql'] += timeit.default_timer() - start
+
+    def execute(self, sql, params=None):
+        return self._timed(self._cur.execute, sql, params)
+
+    def fetchone(self):
+        row = self._timed(self._cur.fetchone)
+        if row is not None:
+            self._timer.rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._timed(self._cur.fetchmany, size) if size is not None else self._timed(self._cur.fetchmany)
+        self._timer.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(self._cur.fetchall)
+        self._timer.rows += len(rows)
+        return rows
+
+
+def timed_cursor(cur):
+    """ Times the queries of a cursor in the current request
+
+    :param cur: DB-API cursor
+    :return: the cursor, wrapped if a request is being timed in this thread
+    """
+    timer = getattr(_current, u'timer', None)
+    return _TimedCursor(cur, timer) if timer is not None else cur
+
+
+def _format_value(value):
+    if value == float(u'inf'):
+        return u'+Inf'
+    return repr(float(value)) if value != int(value) else u'%d' % value
+
+
+def _format_labels(labels):
+    return u'{' + u','.join(u'%s="%s"' % (name, unicode(value).replace(u'\\', u'\\\\').replace(u'"', u'\\"'))
+                            for name, value in labels) + u'}'
+
+
+def render():
+    """ The metrics of all processes in the Prometheus text format
+
+    :return: string
+    """
+    if not _enabled:
+        return u''
+
+    totals = {}
+    if _directory:
+        _process_values()
+        sources = [_FileValues.read(path) for path in glob.glob(os.path.join(_directory, u'metrics_*.db'))]
+    else:
+        sources = [_process_values().items()]
+    for items in sources:
+        for key, value in items:
+            totals[key] = totals.get(key, 0.0) + value
+
+    # Group the samples by metric and series
+    series = {}
+    for key, value in totals.items():
+        name, labels = json.loads(key)
+        labels = [tuple(label) for label in labels]
+        if name.endswith(u'_bucket'):
+            name = name[:-len(u'_bucket')]
+            le = labels.pop()[1]
+            series.setdefault(name, {}).setdefault(tuple(labels), {}).setdefault(u'buckets', {})[le] = value
+        elif name.endswith(u'_sum') or name.endswith(u'_count'):
+            base, suffix = name.rsplit(u'_', 1)
+            series.setdefault(base, {}).setdefault(tuple(labels), {})[suffix] = value
+        else:
+            series.setdefault(name, {})[tuple(labels)] = value
+
+    lines = []
+    for name in sorted(series):
+        kind, description = _METRICS.get(name, (u'untyped', u''))
+        lines.append(u'# HELP %s %s' % (name, description))
+        lines.append(u'# TYPE %s %s' % (name, kind))
+        for labels in sorted(series[name]):
+            sample = series[name][labels]
+            if kind != u'histogram':
+                lines.append(u'%s%s %s' % (name, _format_labels(labels), _format_value(sample)))
+                continue
+            # Bucket counts are stored per bucket and reported cumulatively
+            cumulative = 0.0
+            for le in _BUCKETS:
+                cumulative += sample.get(u'buckets', {}).get(le, 0.0)
+                lines.append(u'%s_bucket%s %s' % (name, _format_labels(labels + ((u'le', _format_value(le)),)),
+                                                  _format_value(cumulative)))
+            lines.append(u'%s_sum%s %s' % (name, _format_labels(labels), _format_value(sample.get(u'sum', 0.0))))
+            lines.append(u'%s_count%s %s' % (name, _format_labels(labels),
+                                             _format_value(sample.get(u'count', 0.0))))
+    return u'\n'.join(lines) + u'\n'
@@ -0,0 +1,128 @@
+u"""
+Cache of serialized API responses
+
+The COHD data only changes when a dataset is reloaded, so identical requests return identical responses. Responses are
+cached as serialized JSON bodies, so that a hit skips both the database and jsonify. Entries are tagged with the dataset
+they were computed from so that the entries of a reloaded dataset can be invalidated.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache(object):
+    """ Thread-safe LRU cache of response bodies, bounded by number of entries and total size, with an optional TTL """
+
+    def __init__(self, max_entries=1000, max_bytes=100 * 1024 * 1024, ttl=None):
+        """ Create a new cache
+
+        :param max_entries: int - Maximum number of cached responses
+        :param max_bytes: int - Maximum total size of the cached response bodies
+        :param ttl: float - Seconds after which an entry expires (None for no expiry)
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        # key -> (dataset_id, body, mimetype, time stored), least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._stats = {
+            u'hits': 0,
+            u'misses': 0,
+            u'evictions': 0,
+            u'expirations': 0,
+            u'invalidations': 0
+        }
+
+    @staticmethod
+    def key(service, method, args):
+        """ Cache key of a request. Arguments are normalized so that their order does not matter.
+
+        :param service: string
+        :param method: string
+        :param args: request arguments (MultiDict)
+        :return: hashable key
+        """
+        return service, method, tuple(sorted((name, tuple(values)) for name, values in args.lists()
+                                             if name not in (u'service', u'meta')))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= len(entry[1])
+
+    def get(self, key):
+        """ Look up a response
+
+        :param key: Key from ResponseCache.key
+        :return: (body, mimetype), or None if the response is not cached
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry[3] >= self.ttl:
+                self._remove(key)
+                self._stats[u'expirations'] += 1
+                entry = None
+
+            if entry is None:
+                self._stats[u'misses'] += 1
+                return None
+
+            # Move to the most recently used end
+            del self._entries[key]
+            self._entries[key] = entry
+            self._stats[u'hits'] += 1
+            return entry[1], entry[2]
+
+    def put(self, key, dataset_id, body, mimetype):
+        """ Cache a response
+
+        :param key: Key from ResponseCache.key
+        :param dataset_id: dataset the response was computed from
+        :param body: Serialized response body
+        :param mimetype: Response mimetype
+        """
+        if len(body) > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (dataset_id, body, mimetype, time.time())
+            self._bytes += len(body)
+
+            # Evict the least recently used entries
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._stats[u'evictions'] += 1
+
+    def invalidate(self, dataset_id=None):
+        """ Remove the cached responses of a dataset
+
+        :param dataset_id: dataset to invalidate, or None to remove all entries
+        :return: Number of entries removed
+        """
+        with self._lock:
+            keys = [key for key, entry in self._entries.items() if dataset_id is None or entry[0] == dataset_id]
+            for key in keys:
+                self._remove(key)
+            self._stats[u'invalidations'] += len(keys)
+        return len(keys)
+
+    def stats(self):
+        """ Cache statistics for monitoring
+
+        :return: dict
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats[u'entries'] = len(self._entries)
+            stats[u'bytes'] = self._bytes
+        stats[u'max_entries'] = self.max_entries
+        stats[u'max_bytes'] = self.max_bytes
+        stats[u'ttl'] = self.ttl
+        lookups = stats[u'hits'] + stats[u'misses']
+        stats[u'hit_rate'] = stats[u'hits'] / float(lookups) if lookups else 0.0
+        return stats
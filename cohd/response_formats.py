@@ -0,0 +1,185 @@
+u"""
+Compact and columnar response formats
+
+The format parameter of the query endpoints selects how the results are encoded:
+    json     (default) an array of objects, one per row
+    columns  JSON with one array per column: {"columns": [...], "results": {"concept_id": [...], ...}}
+    csv      comma-separated values with a header line, streamed
+    tsv      tab-separated values with a header line, streamed
+    msgpack  MessagePack encoding of the columns format (requires the msgpack package)
+The other top-level fields of the JSON responses (e.g., pagination) are included in the columns and msgpack bodies, and
+sent in the X-COHD-Metadata header (as JSON) with csv and tsv. Rows are encoded from tuples in the column order of the
+header (the column names sorted, as in the JSON objects), so results streamed from a cursor are never turned into dicts.
+Values that are not scalars (e.g., lists in the xref results) are written as JSON in csv and tsv. Results that are not
+rows (the triplets and matrix of pairwiseConceptFreq) are encoded as they are in columns and msgpack, and are not
+available in csv and tsv.
+"""
+
+import csv
+import cStringIO
+from decimal import Decimal
+from operator import itemgetter
+from flask import json as flask_json
+import request_metrics
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+FORMATS = (u'json', u'columns', u'csv', u'tsv', u'msgpack')
+MIMETYPES = {
+    u'json': u'application/json',
+    u'columns': u'application/json',
+    u'csv': u'text/csv',
+    u'tsv': u'text/tab-separated-values',
+    u'msgpack': u'application/x-msgpack'
+}
+METADATA_HEADER = u'X-COHD-Metadata'
+
+
+
+def request_format(args, layouts=()):
+    """ The response format requested with the format parameter
+
+    :param args: request arguments
+    :param layouts: values of the format parameter that select a layout of the JSON results of the endpoint (e.g.,
+                    triplets or matrix for pairwiseConceptFreq)
+    :return: (format, None), or (None, (error message, status code))
+    """
+    value = args.get(u'format')
+    if value is None or value.strip() == u'' or value in layouts:
+        return u'json', None
+    value = value.strip().lower()
+    if value not in FORMATS:
+        return None, (u'format should be one of %s' % u', '.join(FORMATS), 400)
+    if value == u'msgpack' and msgpack is None:
+        return None, (u'The msgpack format is not available on this server', 400)
+    return value, None
+
+
+def sorted_columns(columns):
+    """ Orders the columns of tuple rows by name
+
+    :param columns: list of column names, in the order of the rows
+    :return: (sorted column names, function that reorders a row, or None if already sorted)
+    """
+    order = sorted(range(len(columns)), key=lambda i: columns[i])
+    if order == range(len(columns)):
+        return list(columns), None
+    getter = itemgetter(*order) if len(order) > 1 else (lambda row: (row[order[0]],))
+    return [columns[i] for i in order], getter
+
+
+def dict_rows(results):
+    """ Columns and tuple rows of a list of dicts
+
+    :param results: list of dicts
+    :return: (column names, list of tuples), or None if the results are not a list of dicts
+    """
+    if not isinstance(results, list) or not all(isinstance(row, dict) for row in results):
+        return None
+    columns = sorted(set(key for row in results for key in row))
+    return columns, [tuple(row.get(column) for column in columns) for row in results]
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode(u'utf-8')
+    if isinstance(value, (list, dict)):
+        return flask_json.dumps(value)
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _decoded(value):
+    """ Decodes the byte strings of metadata (e.g., base64 cursors), which msgpack would encode as binary """
+    if isinstance(value, str):
+        return value.decode(u'utf-8')
+    if isinstance(value, dict):
+        return dict((_decoded(k), _decoded(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_decoded(v) for v in value]
+    return value
+
+
+def _msgpack_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    return unicode(value)
+
+
+def _columnar(columns, chunks, metadata):
+    # Column names from cursors and dict keys may be byte strings, which msgpack would encode as binary
+    columns = [column if isinstance(column, unicode) else column.decode(u'utf-8') for column in columns]
+    body = _decoded(metadata)
+    values = [[] for _ in columns]
+    for rows in chunks:
+        with request_metrics.phase(u'serialize'):
+            for column_values, values_in_chunk in zip(values, zip(*rows)):
+                column_values.extend(values_in_chunk)
+    body.update({u'columns': columns, u'results': dict(zip(columns, values))})
+    return body
+
+
+def encode(result_format, columns, chunks, metadata):
+    """ Encodes tuple rows in a response format other than json
+
+    csv and tsv are encoded chunk by chunk; columns and msgpack need all rows before the body can be written.
+
+    :param result_format: columns, csv, tsv, or msgpack
+    :param columns: column names, in the order of the values of the rows
+    :param chunks: iterable of lists of tuple rows
+    :param metadata: dict of additional top-level fields (not written in csv and tsv)
+    :return: generator of body chunks (byte strings)
+    """
+    if result_format in (u'csv', u'tsv'):
+        buf = cStringIO.StringIO()
+        writer = csv.writer(buf, delimiter=',' if result_format == u'csv' else '\t', lineterminator='\n')
+        writer.writerow([_csv_value(column) for column in columns])
+        yield buf.getvalue()
+        for rows in chunks:
+            with request_metrics.phase(u'serialize'):
+                buf.seek(0)
+                buf.truncate()
+                writer.writerows([_csv_value(value) for value in row] for row in rows)
+                chunk = buf.getvalue()
+            yield chunk
+    elif result_format in (u'columns', u'msgpack'):
+        yield _encode_body(result_format, _columnar(columns, chunks, metadata))
+    else:
+        raise ValueError(u'Unknown format: %s' % result_format)
+
+
+def encode_results(result_format, results, metadata):
+    """ Encodes results that are already column-oriented (e.g., pairwiseConceptFreq) as columns or msgpack
+
+    :param result_format: columns or msgpack
+    :param results: dict
+    :param metadata: dict of additional top-level fields
+    :return: byte string
+    """
+    body = _decoded(metadata)
+    body[u'results'] = results
+    return _encode_body(result_format, body)
+
+
+def _encode_body(result_format, body):
+    with request_metrics.phase(u'serialize'):
+        if result_format == u'msgpack':
+            return msgpack.packb(body, default=_msgpack_default, use_bin_type=True)
+        data = flask_json.dumps(body) + u'\n'
+        return data.encode(u'utf-8') if isinstance(data, unicode) else data
+
+
+def headers(result_format, metadata):
+    """ Response headers of a format
+
+    :return: dict
+    """
+    if result_format in (u'csv', u'tsv') and metadata:
+        return {METADATA_HEADER: flask_json.dumps(metadata)}
+    return {}
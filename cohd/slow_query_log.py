@@ -0,0 +1,284 @@
+u"""
+Structured log of slow SQL statements
+
+Statements run by query_db that take longer than the threshold are appended to the log file as JSON lines with the
+endpoint, the normalized SQL (whitespace collapsed, literals and placeholders replaced by ?, and lists collapsed, so
+that the same query shape has the same text for any concepts), a fingerprint of the normalized SQL, the parameters, the
+number of rows fetched, and the duration including fetching the rows. Only a sample of the requests is timed, so that
+the overhead stays negligible under load.
+
+Optionally, the plan of a slow statement is captured with EXPLAIN (EXPLAIN QUERY PLAN on SQLite) by a background
+thread on its own database connection, at most once per query shape every explain interval, and logged as a separate
+plan line with the same fingerprint. summarize_slow_queries.py summarizes the log into the top query shapes.
+"""
+
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import timeit
+from Queue import Queue, Full
+
+# Maximum number of plans waiting to be captured; slow statements are not explained when the queue is full
+_MAX_EXPLAIN_QUEUE = 100
+
+_COMMENT = re.compile(r'--[^\n]*|/\*.*?\*/', re.S)
+_STRING = re.compile(r"'(?:[^'\\]|\\.)*'")
+_NUMBER = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?(?![\w.])')
+_PLACEHOLDER = re.compile(r'%\(\w+\)s|%s')
+_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+
+_enabled = False
+_path = None
+_threshold = 1.0
+_sample_rate = 1.0
+_explain_connect = None
+_explain_prefix = None
+_explain_interval = 3600
+_write_lock = threading.Lock()
+
+
+def normalize(sql):
+    """ The shape of a statement: literals and placeholders replaced by ?, lists collapsed, whitespace collapsed
+
+    :param sql: SQL statement
+    :return: string
+    """
+    sql = _COMMENT.sub(u' ', sql)
+    sql = _STRING.sub(u'?', sql)
+    sql = _PLACEHOLDER.sub(u'?', sql)
+    sql = _NUMBER.sub(u'?', sql)
+    sql = _WHITESPACE.sub(u' ', sql).strip()
+    return _LIST.sub(u'(...)', sql)
+
+
+def fingerprint(normalized_sql):
+    return hashlib.md5(normalized_sql.encode(u'utf-8')).hexdigest()[:16]
+
+
+def configure(app_config, backend):
+    """ Enables the slow-query log if SLOW_QUERY_LOG is set in the Flask configuration
+
+    SLOW_QUERY_LOG: path of the log file (JSON lines)
+    SLOW_QUERY_THRESHOLD: statements taking longer than this many seconds are logged (default 1)
+    SLOW_QUERY_SAMPLE_RATE: fraction of the requests whose statements are timed (default 1)
+    SLOW_QUERY_EXPLAIN: capture the plans of slow statements on a separate connection
+    SLOW_QUERY_EXPLAIN_INTERVAL: seconds between two plans of the same query shape (default 3600)
+
+    :param app_config: Flask configuration
+    :param backend: storage backend (see storage_backends) that plans are captured on
+    """
+    global _enabled, _path, _threshold, _sample_rate, _explain_connect, _explain_prefix, _explain_interval
+    _path = app_config.get(u'SLOW_QUERY_LOG')
+    _enabled = bool(_path)
+    _threshold = app_config.get(u'SLOW_QUERY_THRESHOLD', 1.0)
+    _sample_rate = app_config.get(u'SLOW_QUERY_SAMPLE_RATE', 1.0)
+    _explain_interval = app_config.get(u'SLOW_QUERY_EXPLAIN_INTERVAL', 3600)
+    if app_config.get(u'SLOW_QUERY_EXPLAIN', False):
+        _explain_connect = backend.connect
+        _explain_prefix = u'EXPLAIN QUERY PLAN ' if backend.name == u'sqlite' else u'EXPLAIN '
+    else:
+        _explain_connect = None
+
+
+def _write(entry):
+    line = json.dumps(entry, default=unicode, sort_keys=True) + '\n'
+    # One write per line on a file opened for appending, so that the lines of several processes do not interleave
+    with _write_lock:
+        with open(_path, u'ab') as f:
+            f.write(line)
+
+
+class _Explainer(object):
+    """ Captures plans on its own connection in a background thread, started on first use in each process """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        # fingerprint -> time of the last plan
+        self._explained = {}
+
+    def submit(self, fingerprint_, sql, params):
+        now = time.time()
+        with self._lock:
+            if now - self._explained.get(fingerprint_, 0) < _explain_interval:
+                return
+            self._explained[fingerprint_] = now
+            if self._pid != os.getpid():
+                # Threads do not survive a fork, so each worker process starts its own thread
+                self._queue = Queue(_MAX_EXPLAIN_QUEUE)
+                worker = threading.Thread(target=self._run, args=(self._queue,), name=u'slow-query-explain')
+                worker.daemon = True
+                worker.start()
+                self._pid = os.getpid()
+            queue = self._queue
+        try:
+            queue.put_nowait((fingerprint_, sql, params))
+        except Full:
+            pass
+
+    @staticmethod
+    def _run(queue):
+        conn = None
+        while True:
+            fingerprint_, sql, params = queue.get()
+            try:
+                if conn is None:
+                    conn = _explain_connect()
+                cur = conn.cursor()
+                cur.execute(_explain_prefix + sql.strip(), params)
+                plan = list(cur.fetchall())
+                cur.close()
+                # End the transaction, so that the connection does not hold metadata locks on the explained tables
+                # between plans, which would block the RENAME TABLE swaps of the build and load scripts
+                conn.rollback()
+            except Exception as e:
+                print u"Cannot explain slow query: ", e
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                    conn = None
+                continue
+            _write({u'type': u'plan', u'time': time.time(), u'fingerprint': fingerprint_, u'plan': plan})
+
+
+_explainer = _Explainer()
+
+
+class _LoggedCursor(object):
+    """ Cursor that times each statement, from its execution until the next statement or until the cursor is closed,
+    and logs it if slow
+    """
+
+    def __init__(self, cur, endpoint):
+        self._cur = cur
+        self._endpoint = endpoint
+        self._statement = None
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def __del__(self):
+        self._finish()
+
+    def _finish(self):
+        statement = self._statement
+        self._statement = None
+        if statement is None or statement[u'duration'] < _threshold:
+            return
+        sql = statement.pop(u'sql')
+        shape = normalize(sql)
+        statement.update({
+            u'type': u'query',
+            u'endpoint': self._endpoint,
+            u'sql': shape,
+            u'fingerprint': fingerprint(shape),
+            u'duration_ms': round(statement.pop(u'duration') * 1000, 3),
+            u'pid': os.getpid()
+        })
+        _write(statement)
+        if _explain_connect is not None:
+            _explainer.submit(statement[u'fingerprint'], sql, statement[u'params'])
+
+    def _timed(self, method, *args):
+        start = timeit.default_timer()
+        try:
+            return method(*args)
+        finally:
+            if self._statement is not None:
+                self._statement[u'duration'] += timeit.default_timer() - start
+
+    def execute(self, sql, params=None):
+        self._finish()
+        self._statement = {u'time': time.time(), u'sql': sql, u'params': params, u'rows': 0, u'duration': 0.0}
+        return self._timed(self._cur.execute, sql, params)
+
+    def fetchone(self):
+        row = self._timed(self._cur.fetchone)
+        if row is not None and self._statement is not None:
+            self._statement[u'rows'] += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._timed(self._cur.fetchmany, size) if size is not None else self._timed(self._cur.fetchmany)
+        if self._statement is not None:
+            self._statement[u'rows'] += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(self._cur.fetchall)
+        if self._statement is not None:
+            self._statement[u'rows'] += len(rows)
+        return rows
+
+    def close(self):
+        self._finish()
+        return self._cur.close()
+
+
+def logged_cursor(cur, endpoint):
+    """ Logs the slow statements of a cursor, for a sample of the requests
+
+    :param cur: DB-API cursor
+    :param endpoint: endpoint that the statements are logged with, e.g., /api/association/chiSquare
+    :return: the cursor, wrapped if the request is sampled
+    """
+    if not _enabled or (_sample_rate < 1 and random.random() >= _sample_rate):
+        return cur
+    return _LoggedCursor(cur, endpoint)
+
+
+def summarize(lines):
+    """ Groups the slow statements of a log by query shape
+
+    :param lines: iterable of log lines
+    :return: list of dicts, one per query shape
+    """
+    shapes = {}
+    plans = {}
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        if entry.get(u'type') == u'plan':
+            plans[entry[u'fingerprint']] = entry[u'plan']
+            continue
+        shape = shapes.setdefault(entry[u'fingerprint'], {
+            u'fingerprint': entry[u'fingerprint'],
+            u'sql': entry[u'sql'],
+            u'endpoints': set(),
+            u'durations': [],
+            u'rows': 0,
+            u'slowest_params': None
+        })
+        shape[u'endpoints'].add(entry[u'endpoint'])
+        if not shape[u'durations'] or entry[u'duration_ms'] > max(shape[u'durations']):
+            shape[u'slowest_params'] = entry[u'params']
+        shape[u'durations'].append(entry[u'duration_ms'])
+        shape[u'rows'] += entry[u'rows']
+
+    results = []
+    for fingerprint_, shape in shapes.items():
+        durations = sorted(shape.pop(u'durations'))
+        shape.update({
+            u'count': len(durations),
+            u'total_ms': round(sum(durations), 3),
+            u'median_ms': durations[len(durations) // 2],
+            u'max_ms': durations[-1],
+            u'mean_rows': round(shape.pop(u'rows') / float(len(durations)), 1),
+            u'endpoints': sorted(shape[u'endpoints']),
+            u'plan': plans.get(fingerprint_)
+        })
+        results.append(shape)
+    return results
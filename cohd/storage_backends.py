@@ -0,0 +1,179 @@
+u"""
+Storage backends for the COHD queries
+
+A backend opens DB-API connections that behave like pymysql connections with the DictCursor cursor class: queries use
+pymysql's %s and %(name)s placeholders, cursor(pymysql.cursors.Cursor) and cursor(pymysql.cursors.SSCursor) return
+tuples, other cursors return dicts, and database errors are raised as pymysql.err exceptions. The queries and the
+connection pool in query_cohd_mysql therefore run unchanged on either backend.
+
+MySQLBackend connects to the remote MySQL server. SQLiteBackend opens a SQLite database file built by
+load_dataset.py --sqlite from the same data files, read-only and memory-mapped, so that each API node can serve the
+data without a database server or network round trips.
+"""
+
+import math
+import re
+import sqlite3
+import pymysql
+
+# pymysql placeholders: %(name)s, %s, and %% for a literal %
+_PLACEHOLDER = re.compile(r'%\((\w+)\)s|%s|%%')
+_DEFAULT_MMAP_SIZE = 4 * 1024 * 1024 * 1024
+
+
+class MySQLBackend(object):
+    """ Remote MySQL server """
+
+    name = u'mysql'
+
+    def __init__(self, config_file):
+        """
+        :param config_file: MySQL option file with the log-in credentials
+        """
+        self.config_file = config_file
+
+    def connect(self):
+        # Autocommit, so that pooled connections do not keep a REPEATABLE READ snapshot and metadata locks while they
+        # are idle: the snapshot would hide reloaded data, and the locks would block the RENAME TABLE swaps of the
+        # build and load scripts
+        return pymysql.connect(read_default_file=self.config_file,
+                               charset=u'utf8mb4',
+                               cursorclass=pymysql.cursors.DictCursor,
+                               autocommit=True)
+
+
+class SQLiteBackend(object):
+    """ Embedded SQLite database file, opened read-only and memory-mapped """
+
+    name = u'sqlite'
+
+    def __init__(self, path, mmap_size=_DEFAULT_MMAP_SIZE):
+        """
+        :param path: SQLite database file built by load_dataset.py --sqlite
+        :param mmap_size: int - Maximum number of bytes of the file to memory-map (0 to disable)
+        """
+        self.path = path
+        self.mmap_size = mmap_size
+
+    def connect(self):
+        # The file is attached as the cohd schema, so that both cohd.concept and unqualified table names resolve.
+        # Pooled connections are used by one thread at a time, but not always by the thread that opened them.
+        conn = sqlite3.connect(u':memory:', check_same_thread=False)
+        try:
+            conn.execute(u'ATTACH DATABASE ? AS cohd;', [u'file:%s?mode=ro' % self.path])
+            conn.execute(u'PRAGMA cohd.mmap_size = %d;' % int(self.mmap_size))
+            conn.execute(u'PRAGMA query_only = ON;')
+        except sqlite3.Error as e:
+            conn.close()
+            raise pymysql.err.OperationalError(u'Cannot open %s: %s' % (self.path, e))
+        # MySQL's log() is the natural logarithm and returns NULL for non-positive values
+        conn.create_function(u'log', 1, lambda x: math.log(x) if x is not None and x > 0 else None)
+        return _SQLiteConnection(conn)
+
+
+class _SQLiteConnection(object):
+    """ pymysql-compatible wrapper of a read-only sqlite3 connection """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self, cursor_class=None):
+        dict_rows = cursor_class is None or issubclass(cursor_class, pymysql.cursors.DictCursorMixin)
+        return _SQLiteCursor(self._conn.cursor(), dict_rows)
+
+    def ping(self, reconnect=True):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self._conn.close()
+
+
+class _SQLiteCursor(object):
+    """ pymysql-compatible wrapper of a sqlite3 cursor """
+
+    def __init__(self, cur, dict_rows):
+        self._cur = cur
+        self._dict_rows = dict_rows
+        self._columns = None
+        self._executed = None
+
+    @staticmethod
+    def _translate(sql, params):
+        """ Converts pymysql placeholders to sqlite3 placeholders """
+        if params is None:
+            return sql, ()
+
+        def replace(match):
+            if match.group(1) is not None:
+                return u':' + match.group(1)
+            return u'?' if match.group(0) == u'%s' else u'%'
+        return _PLACEHOLDER.sub(replace, sql), params
+
+    def execute(self, sql, params=None):
+        sql, params = self._translate(sql, params)
+        self._executed = sql
+        try:
+            self._cur.execute(sql, params)
+        except sqlite3.OperationalError as e:
+            raise pymysql.err.ProgrammingError(unicode(e))
+        except sqlite3.Error as e:
+            raise pymysql.err.DatabaseError(unicode(e))
+        self._columns = [d[0] for d in self._cur.description] if self._cur.description else None
+        return self._cur.rowcount
+
+    @property
+    def description(self):
+        return self._cur.description
+
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
+    def _row(self, row):
+        if row is None or not self._dict_rows:
+            return row
+        return dict(zip(self._columns, row))
+
+    def fetchone(self):
+        return self._row(self._cur.fetchone())
+
+    def fetchmany(self, size=None):
+        rows = self._cur.fetchmany(size) if size is not None else self._cur.fetchmany()
+        return [self._row(row) for row in rows] if self._dict_rows else rows
+
+    def fetchall(self):
+        rows = self._cur.fetchall()
+        return [self._row(row) for row in rows] if self._dict_rows else rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def close(self):
+        self._cur.close()
+
+
+def create_backend(app_config, mysql_config_file):
+    """ Creates the backend selected by STORAGE_BACKEND (mysql or sqlite) in the Flask configuration
+
+    SQLITE_DATABASE: SQLite database file (required for sqlite)
+    SQLITE_MMAP_SIZE: maximum number of bytes of the SQLite file to memory-map
+
+    :param app_config: Flask configuration, or None for MySQL
+    :param mysql_config_file: MySQL option file
+    :return: MySQLBackend or SQLiteBackend
+    """
+    name = app_config.get(u'STORAGE_BACKEND', u'mysql') if app_config is not None else u'mysql'
+    if name == u'mysql':
+        return MySQLBackend(mysql_config_file)
+    elif name == u'sqlite':
+        if not app_config.get(u'SQLITE_DATABASE'):
+            raise ValueError(u'SQLITE_DATABASE must be set when STORAGE_BACKEND is sqlite')
+        return SQLiteBackend(app_config[u'SQLITE_DATABASE'],
+                             app_config.get(u'SQLITE_MMAP_SIZE', _DEFAULT_MMAP_SIZE))
+    raise ValueError(u'Unknown STORAGE_BACKEND: %s' % name)
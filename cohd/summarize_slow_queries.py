@@ -0,0 +1,56 @@
+u"""
+Summarizes the slow-query log into the top query shapes
+
+Groups the statements of the log written with SLOW_QUERY_LOG (see slow_query_log.py) by normalized SQL, and prints the
+shapes with the highest total duration (or count or maximum duration): the number of slow executions, the total, median
+and maximum durations, the mean number of rows, the endpoints, the parameters of the slowest execution, and the last
+captured plan.
+
+Run from the cohd directory:
+    python summarize_slow_queries.py /var/log/cohd/slow_queries.log --top 10
+    python summarize_slow_queries.py /var/log/cohd/slow_queries.log --sort max --json
+"""
+
+import argparse
+import json
+import slow_query_log
+
+_SORT_KEYS = {
+    u'total': u'total_ms',
+    u'count': u'count',
+    u'max': u'max_ms'
+}
+
+
+def _print_shape(rank, shape):
+    print u"%d. %s" % (rank, shape[u'sql'])
+    print u"   fingerprint %s, %d slow executions, total %.1f ms, median %.1f ms, max %.1f ms, %.1f rows on average" % \
+        (shape[u'fingerprint'], shape[u'count'], shape[u'total_ms'], shape[u'median_ms'], shape[u'max_ms'],
+         shape[u'mean_rows'])
+    print u"   endpoints: %s" % u', '.join(shape[u'endpoints'])
+    print u"   slowest parameters: %s" % json.dumps(shape[u'slowest_params'])
+    if shape[u'plan']:
+        print u"   plan:"
+        for row in shape[u'plan']:
+            print u"     %s" % json.dumps(row, sort_keys=True)
+    print
+
+
+if __name__ == u"__main__":
+    parser = argparse.ArgumentParser(description=u'Summarize the slow-query log into the top query shapes')
+    parser.add_argument(u'log', help=u'Slow-query log file')
+    parser.add_argument(u'--top', type=int, default=20, help=u'Number of query shapes to show')
+    parser.add_argument(u'--sort', choices=sorted(_SORT_KEYS), default=u'total', help=u'Order of the query shapes')
+    parser.add_argument(u'--json', action=u'store_true', help=u'Print the summary as JSON')
+    arguments = parser.parse_args()
+
+    with open(arguments.log, u'rb') as f:
+        shapes = slow_query_log.summarize(f)
+    shapes.sort(key=lambda shape: shape[_SORT_KEYS[arguments.sort]], reverse=True)
+    shapes = shapes[:arguments.top]
+
+    if arguments.json:
+        print json.dumps(shapes, indent=2, sort_keys=True)
+    else:
+        for i, shape in enumerate(shapes, 1):
+            _print_shape(i, shape)
@@ -0,0 +1,170 @@
+u"""
+Tests of the OxO cache and circuit breaker
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import requests
+import omop_xref
+from oxo_cache import OxoCache, CircuitBreaker, CircuitOpen
+
+
+class _Response(object):
+    """ Successful response of requests.post """
+
+    def __init__(self, json_return):
+        self._json_return = json_return
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._json_return
+
+
+def _search_result(curie):
+    return {u'queryId': curie, u'curie': curie, u'label': curie, u'mappingResponseList': []}
+
+
+class OxoCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, u'oxo_cache.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_key_keeps_id_order(self):
+        self.assertEqual(OxoCache.key([u'a', u'b'], None, [u'ICD9CM'], 2),
+                         OxoCache.key((u'a', u'b'), None, (u'ICD9CM',), 2))
+        self.assertNotEqual(OxoCache.key([u'a', u'b'], None, [], 2), OxoCache.key([u'b', u'a'], None, [], 2))
+        self.assertNotEqual(OxoCache.key([u'a'], None, [], 2), OxoCache.key([u'a'], None, [], 3))
+
+    def test_get_put(self):
+        cache = OxoCache()
+        key = OxoCache.key([u'a'], None, [], 2)
+        self.assertIsNone(cache.get(key))
+        cache.put(key, {u'result': 1})
+        self.assertEqual(cache.get(key), {u'result': 1})
+
+    def test_stale_entries(self):
+        cache = OxoCache(ttl=0)
+        cache.put(u'key', {u'result': 1})
+        self.assertIsNone(cache.get(u'key'))
+        self.assertEqual(cache.get(u'key', allow_stale=True), {u'result': 1})
+
+    def test_memory_lru(self):
+        cache = OxoCache(memory_size=2)
+        cache.put(u'a', 1)
+        cache.put(u'b', 2)
+        cache.get(u'a')
+        cache.put(u'c', 3)
+        self.assertEqual(cache.get(u'a'), 1)
+        self.assertIsNone(cache.get(u'b'))
+        self.assertEqual(cache.get(u'c'), 3)
+
+    def test_persistent(self):
+        cache = OxoCache(path=self.path, memory_size=1)
+        cache.put(u'a', {u'result': 1})
+        cache.put(u'b', {u'result': 2})
+        # a was evicted from memory and is read back from the file, also by another cache on the same file
+        self.assertEqual(cache.get(u'a'), {u'result': 1})
+        self.assertEqual(OxoCache(path=self.path).get(u'b'), {u'result': 2})
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+        for _ in range(2):
+            breaker.before_call()
+            breaker.failure()
+        self.assertEqual(breaker.state(), u'closed')
+        breaker.before_call()
+        breaker.failure()
+        self.assertEqual(breaker.state(), u'open')
+        self.assertRaises(CircuitOpen, breaker.before_call)
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        self.assertEqual(breaker.state(), u'closed')
+        breaker.before_call()
+
+    def test_half_open_trial_success_closes(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.failure()
+        self.assertEqual(breaker.state(), u'open')
+        # After the timeout, one trial call is let through and other calls are refused until it completes
+        breaker.before_call()
+        self.assertEqual(breaker.state(), u'half-open')
+        self.assertRaises(CircuitOpen, breaker.before_call)
+        breaker.success()
+        self.assertEqual(breaker.state(), u'closed')
+        breaker.before_call()
+
+    def test_half_open_trial_failure_opens(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0)
+        for _ in range(3):
+            breaker.failure()
+        breaker.before_call()
+        self.assertEqual(breaker.state(), u'half-open')
+        # A failed trial opens the circuit again, without waiting for failure_threshold failures
+        breaker.failure()
+        self.assertEqual(breaker.state(), u'open')
+        breaker.reset_timeout = 60
+        self.assertRaises(CircuitOpen, breaker.before_call)
+
+
+class OxoSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = (omop_xref.requests.post, omop_xref._oxo_cache, omop_xref._oxo_breaker)
+        omop_xref._oxo_cache = OxoCache()
+        omop_xref._oxo_breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        self.calls = []
+        self.down = False
+        omop_xref.requests.post = self._post
+
+    def tearDown(self):
+        omop_xref.requests.post, omop_xref._oxo_cache, omop_xref._oxo_breaker = self.saved
+
+    def _post(self, url, data, timeout):
+        self.calls.append(data[u'ids'])
+        if self.down:
+            raise requests.exceptions.ConnectionError(u'OxO is down')
+        return _Response({u'_embedded': {u'searchResults': [_search_result(curie) for curie in data[u'ids']]}})
+
+    def test_cached(self):
+        first = omop_xref.oxo_search([u'ICD9CM:1'])
+        self.assertEqual(omop_xref.oxo_search([u'ICD9CM:1']), first)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_circuit_opens_and_stale_results_are_served(self):
+        omop_xref._oxo_cache.ttl = 0
+        omop_xref.oxo_search([u'ICD9CM:1'])
+        self.down = True
+        # OxO fails: the stale result is returned until the circuit opens, and then OxO is no longer called
+        for _ in range(3):
+            self.assertEqual(omop_xref.oxo_search([u'ICD9CM:1'])[u'_embedded'][u'searchResults'][0][u'queryId'],
+                             u'ICD9CM:1')
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(omop_xref._oxo_breaker.state(), u'open')
+        self.assertRaises(omop_xref.OxoUnavailable, omop_xref.oxo_search, [u'ICD9CM:2'])
+        self.assertEqual(len(self.calls), 3)
+
+    def test_circuit_closes_after_successful_trial(self):
+        omop_xref._oxo_breaker.reset_timeout = 0
+        self.down = True
+        for _ in range(2):
+            self.assertRaises(omop_xref.OxoUnavailable, omop_xref.oxo_search, [u'ICD9CM:1'])
+        self.assertEqual(omop_xref._oxo_breaker.state(), u'open')
+        self.down = False
+        omop_xref.oxo_search([u'ICD9CM:1'])
+        self.assertEqual(omop_xref._oxo_breaker.state(), u'closed')
+
+
+if __name__ == u'__main__':
+    unittest.main()
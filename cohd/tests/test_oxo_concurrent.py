@@ -0,0 +1,129 @@
+u"""
+Tests of the concurrent OxO searches of multi-concept xrefFromOMOP, and of their deadline
+"""
+
+import threading
+import time
+import unittest
+import requests
+import omop_xref
+from oxo_cache import OxoCache, CircuitBreaker
+from tests.test_oxo import _Response, _search_result
+
+
+class OxoSearchConcurrentTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = (omop_xref.oxo_search_results, omop_xref._oxo_deadline, omop_xref._OXO_FANOUT_CHUNK_SIZE)
+        omop_xref._oxo_deadline = 0.2
+        omop_xref._OXO_FANOUT_CHUNK_SIZE = 2
+        self.release = threading.Event()
+        self.slow = set()
+        self.failing = set()
+        self.deadlines = []
+        omop_xref.oxo_search_results = self._search_results
+
+    def tearDown(self):
+        self.release.set()
+        omop_xref.oxo_search_results, omop_xref._oxo_deadline, omop_xref._OXO_FANOUT_CHUNK_SIZE = self.saved
+
+    def _search_results(self, ids, input_source=None, mapping_targets=[], distance=2, deadline=None):
+        self.deadlines.append(deadline)
+        if self.slow.intersection(ids):
+            self.release.wait(5)
+        if self.failing.intersection(ids):
+            raise omop_xref.OxoUnavailable(u'OxO is down')
+        return [_search_result(curie) for curie in ids]
+
+    def test_all_chunks(self):
+        ids = [u'ICD9CM:%d' % i for i in range(5)]
+        start = time.time()
+        results, partial = omop_xref.oxo_search_concurrent(ids)
+        self.assertEqual(sorted(results), ids)
+        self.assertFalse(partial)
+        # Every chunk is searched with the deadline of the request
+        self.assertEqual(len(self.deadlines), 3)
+        self.assertEqual(len(set(self.deadlines)), 1)
+        self.assertAlmostEqual(self.deadlines[0], start + 0.2, delta=0.1)
+
+    def test_empty(self):
+        self.assertEqual(omop_xref.oxo_search_concurrent([]), ({}, False))
+
+    def test_timeout_returns_partial_results(self):
+        ids = [u'ICD9CM:%d' % i for i in range(5)]
+        self.slow.add(u'ICD9CM:2')
+        results, partial = omop_xref.oxo_search_concurrent(ids)
+        # The chunk of ICD9CM:2 and ICD9CM:3 missed the deadline
+        self.assertEqual(sorted(results), [u'ICD9CM:0', u'ICD9CM:1', u'ICD9CM:4'])
+        self.assertTrue(partial)
+
+    def test_failed_chunk_returns_partial_results(self):
+        ids = [u'ICD9CM:%d' % i for i in range(4)]
+        self.failing.add(u'ICD9CM:0')
+        results, partial = omop_xref.oxo_search_concurrent(ids)
+        self.assertEqual(sorted(results), [u'ICD9CM:2', u'ICD9CM:3'])
+        self.assertTrue(partial)
+
+    def test_all_chunks_fail(self):
+        self.failing.update([u'ICD9CM:0', u'ICD9CM:2'])
+        self.assertRaises(omop_xref.OxoUnavailable, omop_xref.oxo_search_concurrent,
+                          [u'ICD9CM:%d' % i for i in range(4)])
+
+
+class OxoSearchDeadlineTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = (omop_xref.requests.post, omop_xref._oxo_cache, omop_xref._oxo_breaker, omop_xref._oxo_timeout,
+                      omop_xref._oxo_deadline, omop_xref._OXO_FANOUT_CHUNK_SIZE)
+        omop_xref._oxo_cache = OxoCache()
+        omop_xref._oxo_breaker = CircuitBreaker(failure_threshold=1000)
+        omop_xref._oxo_timeout = 5
+        omop_xref._oxo_deadline = 0.2
+        omop_xref._OXO_FANOUT_CHUNK_SIZE = 1
+        self.timeouts = []
+        self.slow = True
+        omop_xref.requests.post = self._post
+
+    def tearDown(self):
+        (omop_xref.requests.post, omop_xref._oxo_cache, omop_xref._oxo_breaker, omop_xref._oxo_timeout,
+         omop_xref._oxo_deadline, omop_xref._OXO_FANOUT_CHUNK_SIZE) = self.saved
+
+    def _post(self, url, data, timeout):
+        self.timeouts.append(timeout)
+        if self.slow:
+            # OxO does not respond before the timeout
+            time.sleep(timeout)
+            raise requests.exceptions.Timeout(u'OxO is slow')
+        return _Response({u'_embedded': {u'searchResults': [_search_result(curie) for curie in data[u'ids']]}})
+
+    def test_timeout_bounded_by_deadline(self):
+        self.slow = False
+        omop_xref.oxo_search([u'ICD9CM:1'], deadline=time.time() + 1)
+        omop_xref.oxo_search([u'ICD9CM:2'])
+        self.assertLessEqual(self.timeouts[0], 1)
+        self.assertEqual(self.timeouts[1], 5)
+
+    def test_deadline_passed(self):
+        self.assertRaises(omop_xref.OxoUnavailable, omop_xref.oxo_search, [u'ICD9CM:1'], deadline=time.time())
+        self.assertEqual(self.timeouts, [])
+
+    def test_deadline_passed_cached(self):
+        self.slow = False
+        first = omop_xref.oxo_search([u'ICD9CM:1'])
+        self.assertEqual(omop_xref.oxo_search([u'ICD9CM:1'], deadline=time.time()), first)
+        self.assertEqual(len(self.timeouts), 1)
+
+    def test_searches_after_deadline_do_not_hold_up_the_pool(self):
+        # More chunks than threads: while OxO is slow, all searches stop by the deadline of their request...
+        ids = [u'ICD9CM:%d' % i for i in range(3 * omop_xref._oxo_workers)]
+        self.assertRaises(omop_xref.OxoUnavailable, omop_xref.oxo_search_concurrent, ids)
+        time.sleep(0.3)
+        self.assertTrue(all(timeout <= 0.2 for timeout in self.timeouts))
+
+        # ...so that the searches of the next request run as soon as OxO recovers
+        self.slow = False
+        results, partial = omop_xref.oxo_search_concurrent(ids)
+        self.assertEqual(sorted(results), sorted(ids))
+        self.assertFalse(partial)
+
+
+if __name__ == u'__main__':
+    unittest.main()
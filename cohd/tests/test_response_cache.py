@@ -0,0 +1,102 @@
+u"""
+Tests of the response cache keys, eviction, expiry, and invalidation
+"""
+
+import unittest
+from werkzeug.datastructures import MultiDict
+from response_cache import ResponseCache
+
+
+def _key(args, service=u'association', method=u'chiSquare'):
+    return ResponseCache.key(service, method, MultiDict(args))
+
+
+class ResponseCacheKeyTest(unittest.TestCase):
+    def test_argument_order(self):
+        self.assertEqual(_key([(u'dataset_id', u'1'), (u'concept_id_1', u'192855')]),
+                         _key([(u'concept_id_1', u'192855'), (u'dataset_id', u'1')]))
+
+    def test_service_and_meta_arguments(self):
+        # service and meta are part of the key through the route, not through the arguments
+        self.assertEqual(_key([(u'service', u'association'), (u'meta', u'chiSquare'), (u'concept_id_1', u'1')]),
+                         _key([(u'concept_id_1', u'1')]))
+        self.assertNotEqual(_key([(u'concept_id_1', u'1')]), _key([(u'concept_id_1', u'1')], method=u'obsExpRatio'))
+
+    def test_argument_values(self):
+        self.assertNotEqual(_key([(u'concept_id_1', u'1')]), _key([(u'concept_id_1', u'2')]))
+        self.assertNotEqual(_key([(u'concept_id_1', u'1')]), _key([(u'concept_id_1', u'1'), (u'dataset_id', u'2')]))
+        self.assertNotEqual(_key([(u'concept_id_1', u'1'), (u'format', u'csv')]), _key([(u'concept_id_1', u'1')]))
+
+    def test_repeated_arguments(self):
+        # The order of the values of a repeated argument is kept
+        self.assertNotEqual(_key([(u'q', u'a'), (u'q', u'b')]), _key([(u'q', u'b'), (u'q', u'a')]))
+        self.assertNotEqual(_key([(u'q', u'a'), (u'q', u'b')]), _key([(u'q', u'a')]))
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def test_get_put(self):
+        cache = ResponseCache()
+        self.assertIsNone(cache.get(u'a'))
+        cache.put(u'a', 1, b'{}', u'application/json')
+        self.assertEqual(cache.get(u'a'), (b'{}', u'application/json'))
+        stats = cache.stats()
+        self.assertEqual((stats[u'hits'], stats[u'misses'], stats[u'entries'], stats[u'bytes']), (1, 1, 1, 2))
+
+    def test_replace(self):
+        cache = ResponseCache()
+        cache.put(u'a', 1, b'1234', u'application/json')
+        cache.put(u'a', 1, b'12', u'application/json')
+        self.assertEqual(cache.get(u'a'), (b'12', u'application/json'))
+        self.assertEqual(cache.stats()[u'bytes'], 2)
+
+    def test_evicts_least_recently_used(self):
+        cache = ResponseCache(max_entries=2)
+        cache.put(u'a', 1, b'a', u'text/csv')
+        cache.put(u'b', 1, b'b', u'text/csv')
+        cache.get(u'a')
+        cache.put(u'c', 1, b'c', u'text/csv')
+        self.assertIsNotNone(cache.get(u'a'))
+        self.assertIsNone(cache.get(u'b'))
+        self.assertIsNotNone(cache.get(u'c'))
+        self.assertEqual(cache.stats()[u'evictions'], 1)
+
+    def test_max_bytes(self):
+        cache = ResponseCache(max_bytes=10)
+        cache.put(u'large', 1, b'x' * 11, u'text/csv')
+        self.assertIsNone(cache.get(u'large'))
+        cache.put(u'a', 1, b'x' * 6, u'text/csv')
+        cache.put(u'b', 1, b'x' * 6, u'text/csv')
+        self.assertIsNone(cache.get(u'a'))
+        self.assertIsNotNone(cache.get(u'b'))
+        self.assertEqual(cache.stats()[u'bytes'], 6)
+
+    def test_ttl(self):
+        cache = ResponseCache(ttl=0)
+        cache.put(u'a', 1, b'a', u'text/csv')
+        self.assertIsNone(cache.get(u'a'))
+        stats = cache.stats()
+        self.assertEqual((stats[u'expirations'], stats[u'entries'], stats[u'bytes']), (1, 0, 0))
+
+    def test_invalidate_dataset(self):
+        cache = ResponseCache()
+        cache.put(u'a', 1, b'a', u'text/csv')
+        cache.put(u'b', 2, b'bb', u'text/csv')
+        cache.put(u'c', 1, b'ccc', u'text/csv')
+        self.assertEqual(cache.invalidate(1), 2)
+        self.assertIsNone(cache.get(u'a'))
+        self.assertIsNone(cache.get(u'c'))
+        self.assertIsNotNone(cache.get(u'b'))
+        stats = cache.stats()
+        self.assertEqual((stats[u'invalidations'], stats[u'entries'], stats[u'bytes']), (2, 1, 2))
+
+    def test_invalidate_all(self):
+        cache = ResponseCache()
+        cache.put(u'a', 1, b'a', u'text/csv')
+        cache.put(u'b', 2, b'b', u'text/csv')
+        self.assertEqual(cache.invalidate(), 2)
+        self.assertEqual(cache.stats()[u'entries'], 0)
+        self.assertEqual(cache.invalidate(3), 0)
+
+
+if __name__ == u'__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+u"""
+Tests of the compact and columnar response formats
+"""
+
+import json
+import unittest
+from decimal import Decimal
+from werkzeug.datastructures import MultiDict
+import response_formats
+
+_COLUMNS = [u'concept_id', u'concept_name', u'concept_count']
+_CHUNKS = [[(1, u'Caf\xe9', 10), (2, u'a, "b"', None)], [(3, u'c\td', 2.5)]]
+
+
+def _encoded(result_format, columns=_COLUMNS, chunks=_CHUNKS, metadata=None):
+    return b''.join(response_formats.encode(result_format, columns, chunks, metadata or {}))
+
+
+class RequestFormatTest(unittest.TestCase):
+    def test_default(self):
+        self.assertEqual(response_formats.request_format(MultiDict()), (u'json', None))
+        self.assertEqual(response_formats.request_format(MultiDict({u'format': u' '})), (u'json', None))
+
+    def test_formats(self):
+        for result_format in response_formats.FORMATS:
+            if result_format == u'msgpack' and response_formats.msgpack is None:
+                continue
+            self.assertEqual(response_formats.request_format(MultiDict({u'format': result_format.upper()})),
+                             (result_format, None))
+
+    def test_invalid(self):
+        result_format, error = response_formats.request_format(MultiDict({u'format': u'xml'}))
+        self.assertIsNone(result_format)
+        self.assertEqual(error[1], 400)
+
+    def test_layouts(self):
+        # Layouts select the JSON results of one endpoint, and are invalid formats elsewhere
+        args = MultiDict({u'format': u'matrix'})
+        self.assertEqual(response_formats.request_format(args, (u'triplets', u'matrix')), (u'json', None))
+        self.assertEqual(response_formats.request_format(args)[1][1], 400)
+
+    def test_msgpack_unavailable(self):
+        saved = response_formats.msgpack
+        response_formats.msgpack = None
+        try:
+            result_format, error = response_formats.request_format(MultiDict({u'format': u'msgpack'}))
+        finally:
+            response_formats.msgpack = saved
+        self.assertIsNone(result_format)
+        self.assertEqual(error[1], 400)
+
+
+class RowsTest(unittest.TestCase):
+    def test_sorted_columns(self):
+        columns, getter = response_formats.sorted_columns(_COLUMNS)
+        self.assertEqual(columns, [u'concept_count', u'concept_id', u'concept_name'])
+        self.assertEqual(getter((1, u'a', 10)), (10, 1, u'a'))
+        self.assertEqual(response_formats.sorted_columns([u'a', u'b']), ([u'a', u'b'], None))
+
+    def test_sorted_single_column(self):
+        columns, getter = response_formats.sorted_columns([u'a'])
+        self.assertEqual(columns, [u'a'])
+        self.assertIsNone(getter)
+
+    def test_dict_rows(self):
+        self.assertEqual(response_formats.dict_rows([{u'b': 1, u'a': 2}, {u'a': 3, u'c': 4}]),
+                         ([u'a', u'b', u'c'], [(2, 1, None), (3, None, 4)]))
+        self.assertIsNone(response_formats.dict_rows({u'a': [1]}))
+
+
+class EncodeTest(unittest.TestCase):
+    def test_csv(self):
+        self.assertEqual(_encoded(u'csv'),
+                         b'concept_id,concept_name,concept_count\n'
+                         b'1,Caf\xc3\xa9,10\n'
+                         b'2,"a, ""b""",\n'
+                         b'3,c\td,2.5\n')
+
+    def test_tsv(self):
+        self.assertEqual(_encoded(u'tsv'),
+                         b'concept_id\tconcept_name\tconcept_count\n'
+                         b'1\tCaf\xc3\xa9\t10\n'
+                         b'2\t"a, ""b"""\t\n'
+                         b'3\t"c\td"\t2.5\n')
+
+    def test_csv_json_values(self):
+        self.assertEqual(_encoded(u'csv', [u'mappings'], [[([u'a', u'b'],)]]), b'mappings\n"[""a"", ""b""]"\n')
+
+    def test_csv_streamed(self):
+        chunks = list(response_formats.encode(u'csv', _COLUMNS, _CHUNKS, {}))
+        self.assertEqual(len(chunks), 3)
+
+    def test_columns(self):
+        body = json.loads(_encoded(u'columns', metadata={u'next_cursor': b'abc'}))
+        self.assertEqual(body, {
+            u'columns': _COLUMNS,
+            u'results': {u'concept_id': [1, 2, 3], u'concept_name': [u'Caf\xe9', u'a, "b"', u'c\td'],
+                         u'concept_count': [10, None, 2.5]},
+            u'next_cursor': u'abc'
+        })
+
+    def test_empty(self):
+        self.assertEqual(_encoded(u'csv', chunks=[]), b'concept_id,concept_name,concept_count\n')
+        body = json.loads(_encoded(u'columns', chunks=[]))
+        self.assertEqual(body[u'results'], {u'concept_id': [], u'concept_name': [], u'concept_count': []})
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, _encoded, u'xml')
+
+    @unittest.skipIf(response_formats.msgpack is None, u'msgpack is not installed')
+    def test_msgpack(self):
+        # Byte strings in the column names and metadata are encoded as strings, not binary
+        data = _encoded(u'msgpack', [b'concept_id', u'concept_count'], [[(1, Decimal(u'2.5'))]],
+                        {u'next_cursor': b'abc', u'pages': [{b'key': b'value'}]})
+        body = response_formats.msgpack.unpackb(data, raw=False)
+        self.assertEqual(body, {
+            u'columns': [u'concept_id', u'concept_count'],
+            u'results': {u'concept_id': [1], u'concept_count': [2.5]},
+            u'next_cursor': u'abc',
+            u'pages': [{u'key': u'value'}]
+        })
+
+    def test_encode_results(self):
+        results = {u'concept_ids': [1, 2], u'counts': [[0, 3], [3, 0]]}
+        body = json.loads(response_formats.encode_results(u'columns', results, {u'dataset_id': 1}))
+        self.assertEqual(body, {u'results': results, u'dataset_id': 1})
+
+    @unittest.skipIf(response_formats.msgpack is None, u'msgpack is not installed')
+    def test_encode_results_msgpack(self):
+        results = {u'concept_ids': [1, 2], u'counts': [3]}
+        data = response_formats.encode_results(u'msgpack', results, {u'next_cursor': b'abc'})
+        self.assertEqual(response_formats.msgpack.unpackb(data, raw=False),
+                         {u'results': results, u'next_cursor': u'abc'})
+
+    def test_metadata_does_not_change(self):
+        metadata = {u'next_cursor': u'abc'}
+        _encoded(u'columns', metadata=metadata)
+        self.assertEqual(metadata, {u'next_cursor': u'abc'})
+
+
+class HeadersTest(unittest.TestCase):
+    def test_metadata_header(self):
+        headers = response_formats.headers(u'csv', {u'next_cursor': u'abc'})
+        self.assertEqual(json.loads(headers[response_formats.METADATA_HEADER]), {u'next_cursor': u'abc'})
+        self.assertEqual(response_formats.headers(u'tsv', {}), {})
+        self.assertEqual(response_formats.headers(u'columns', {u'next_cursor': u'abc'}), {})
+
+
+if __name__ == u'__main__':
+    unittest.main()
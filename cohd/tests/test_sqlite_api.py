@@ -0,0 +1,438 @@
+u"""
+Tests of the API served from an embedded SQLite database
+
+A small dataset is loaded with load_dataset.py into a temporary SQLite file, and the endpoints are requested through the
+Flask test client. The optional query backends (co-occurrence engine and snapshots, concept dictionary, concept search
+index, metadata cache, and result streaming) must return the same results as the SQL queries. concept_pair_stats
+(ASSOCIATION_STATS_TABLE) is only built on MySQL, and is not covered here.
+"""
+
+import json
+import math
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+from contextlib import contextmanager
+import numpy as np
+import cohd
+import export_snapshot
+import load_dataset
+import query_cohd_mysql
+from storage_backends import SQLiteBackend
+
+_DATASET_ID = 1
+_PATIENT_COUNT = 1000
+_CONCEPT_IDS = range(100, 140)
+# Source concepts mapped to the standard concepts 100-104
+_SOURCE_CONCEPT_IDS = range(900, 905)
+# Concept observed in every patient: its chi-square statistics are infinite
+_EVERY_PATIENT = 100
+# Concept without pairs, and concept without counts
+_UNPAIRED = 139
+_UNKNOWN = 999
+
+_DOMAINS = [u'Condition', u'Drug', u'Procedure']
+_WORDS = [u'acute', u'chronic', u'renal', u'cardiac', u'pulmonary']
+_NOUNS = [u'failure', u'disease', u'infection', u'therapy']
+
+# Background threads of the API may still write to standard output after a request
+_DEVNULL = open(os.devnull, u'w')
+
+_FEATURES = [
+    {u'COOCCURRENCE_ENGINE': True},
+    {u'CONCEPT_DICTIONARY': True},
+    {u'CONCEPT_SEARCH_INDEX': True},
+    {u'METADATA_CACHE': True},
+    {u'STREAM_RESULTS': True},
+    {u'COOCCURRENCE_ENGINE': True, u'CONCEPT_DICTIONARY': True, u'CONCEPT_SEARCH_INDEX': True,
+     u'METADATA_CACHE': True, u'STREAM_RESULTS': True},
+]
+
+_RANKED = [
+    # (path, parameters, ranked value, associated concept_id)
+    (u'/api/frequencies/associatedConceptFreq', {u'q': u'101'}, u'concept_frequency', u'associated_concept_id'),
+    (u'/api/frequencies/associatedConceptDomainFreq', {u'concept_id': u'101', u'domain': u'Drug'},
+     u'concept_frequency', u'associated_concept_id'),
+    (u'/api/association/chiSquare', {u'concept_id_1': u'101'}, u'chi_square', u'concept_id_2'),
+    (u'/api/association/chiSquare', {u'concept_id_1': u'%d' % _EVERY_PATIENT}, u'chi_square', u'concept_id_2'),
+    (u'/api/association/chiSquare', {u'concept_id_1': u'102', u'domain': u'Condition'}, u'chi_square',
+     u'concept_id_2'),
+    (u'/api/association/obsExpRatio', {u'concept_id_1': u'101'}, u'ln_ratio', u'concept_id_2'),
+    (u'/api/association/obsExpRatio', {u'concept_id_1': u'103', u'domain': u'Procedure'}, u'ln_ratio',
+     u'concept_id_2'),
+    (u'/api/association/relativeFrequency', {u'concept_id_1': u'101'}, u'relative_frequency', u'concept_id_2'),
+]
+
+
+def _concept(concept_id):
+    i = concept_id - _CONCEPT_IDS[0]
+    name = u'%s %s %s' % (_WORDS[i % len(_WORDS)], _WORDS[(i // 5) % len(_WORDS)], _NOUNS[i % len(_NOUNS)])
+    return [concept_id, name, _DOMAINS[i % len(_DOMAINS)], u'SNOMED', u'Clinical Finding', u'S', u'C%d' % concept_id]
+
+
+def _write_dataset(data_dir, seed=0, patient_count=_PATIENT_COUNT):
+    """ Writes a small dataset in the format of load_dataset.py, with many tied counts """
+    random = np.random.RandomState(seed)
+    counts = {concept_id: int(random.choice([5, 10, 10, 20, 50, 100, 500])) for concept_id in _CONCEPT_IDS}
+    counts[_EVERY_PATIENT] = patient_count
+
+    pairs = []
+    for i, concept_id_1 in enumerate(_CONCEPT_IDS[:-1]):
+        for concept_id_2 in _CONCEPT_IDS[i + 1:-1]:
+            if random.rand() < 0.4:
+                pair_count = min(int(random.choice([1, 2, 2, 3, 5])), counts[concept_id_1], counts[concept_id_2])
+                # Some pairs in reverse order, which the loader stores in canonical order
+                pair = [concept_id_1, concept_id_2] if random.rand() < 0.5 else [concept_id_2, concept_id_1]
+                pairs.append(pair + [pair_count, pair_count / float(patient_count)])
+
+    concepts = [_concept(concept_id) for concept_id in _CONCEPT_IDS]
+    relationships = []
+    for source_id, concept_id in zip(_SOURCE_CONCEPT_IDS, _CONCEPT_IDS):
+        concepts.append([source_id, u'source of %d' % concept_id, _DOMAINS[0], u'ICD9CM', u'3-dig billing code', u'',
+                         u'%d.1' % concept_id])
+        relationships += [[source_id, concept_id, u'Maps to'], [concept_id, source_id, u'Mapped from']]
+
+    _write(data_dir, u'concept.txt', concepts)
+    _write(data_dir, u'concept_relationship.txt', relationships)
+    _write(data_dir, u'concept_counts.txt',
+           [[concept_id, count, count / float(patient_count)] for concept_id, count in sorted(counts.items())])
+    _write(data_dir, u'concept_pair_counts.txt', pairs)
+    _write(data_dir, u'patient_count.txt', [[patient_count]])
+
+
+def _write(data_dir, name, rows):
+    with open(os.path.join(data_dir, name), u'wb') as f:
+        for row in rows:
+            f.write(u'\t'.join(unicode(value) for value in row).encode(u'utf-8') + b'\n')
+
+
+@contextmanager
+def _quiet():
+    """ The loader and the API log to standard output """
+    stdout = sys.stdout
+    sys.stdout = _DEVNULL
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
+
+
+def _load(path, data_dir, dataset_id=_DATASET_ID):
+    with _quiet():
+        load_dataset.load(load_dataset._SQLiteTarget(path), data_dir, dataset_id, dataset_name=u'Test dataset %d' %
+                          dataset_id, dataset_description=u'Synthetic')
+
+
+def _configure(path, settings=None):
+    """ Serves the SQLite database with the optional backends in settings, dropping the in-memory data """
+    config = cohd.app.config
+    for features in _FEATURES:
+        for key in features:
+            config.pop(key, None)
+    config.pop(u'COOCCURRENCE_SNAPSHOT_DIR', None)
+    # No Google Analytics hits
+    config.pop(u'GA_TID', None)
+    config.update({
+        u'STORAGE_BACKEND': u'sqlite',
+        u'SQLITE_DATABASE': path,
+        u'RESPONSE_CACHE_SIZE': 0
+    })
+    config.update(settings or {})
+    with _quiet():
+        query_cohd_mysql.reload_dataset()
+        cohd.configure(config)
+
+
+def _is_nan(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def _rank_key(value_key, id_key):
+    """ Descending order of the ranked value with NULL and NaN last, ties by ascending concept_id """
+    return lambda r: (_is_nan(r[value_key]), 0 if _is_nan(r[value_key]) else -r[value_key], r[id_key])
+
+
+class _ApiTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.path = os.path.join(cls.directory, u'cohd.sqlite')
+        cls.data_dir = os.path.join(cls.directory, u'dataset')
+        os.mkdir(cls.data_dir)
+        _write_dataset(cls.data_dir)
+        _load(cls.path, cls.data_dir)
+        cls.client = cohd.app.test_client()
+        cls.config = dict(cohd.app.config)
+
+    @classmethod
+    def tearDownClass(cls):
+        cohd.app.config.clear()
+        cohd.app.config.update(cls.config)
+        with _quiet():
+            query_cohd_mysql.reload_dataset()
+            cohd.configure(cohd.app.config)
+        shutil.rmtree(cls.directory)
+
+    def get(self, path, params=None):
+        with _quiet():
+            response = self.client.get(path, query_string=dict({u'dataset_id': _DATASET_ID}, **(params or {})))
+        try:
+            return response.status_code, json.loads(response.data) if response.status_code == 200 else response.data
+        finally:
+            response.close()
+
+    def post(self, path, body):
+        with _quiet():
+            response = self.client.post(path, data=json.dumps(body))
+        try:
+            return response.status_code, json.loads(response.data)
+        finally:
+            response.close()
+
+    def assertSameResults(self, first, second, context=u''):
+        """ Equal JSON values, with floats equal up to rounding and NaN equal to NaN """
+        if isinstance(first, float) or isinstance(second, float):
+            if (_is_nan(first) and _is_nan(second)) or first == second:
+                return
+            self.assertTrue(isinstance(first, (int, long, float)) and isinstance(second, (int, long, float)) and
+                            abs(first - second) <= 1e-9 * max(abs(first), abs(second), 1e-300),
+                            u'%s: %r != %r' % (context, first, second))
+        elif isinstance(first, dict) and isinstance(second, dict):
+            self.assertEqual(sorted(first), sorted(second), context)
+            for key in first:
+                self.assertSameResults(first[key], second[key], u'%s.%s' % (context, key))
+        elif isinstance(first, list) and isinstance(second, list):
+            self.assertEqual(len(first), len(second), u'%s: %d != %d results' % (context, len(first), len(second)))
+            for i, (a, b) in enumerate(zip(first, second)):
+                self.assertSameResults(a, b, u'%s[%d]' % (context, i))
+        else:
+            self.assertEqual(first, second, context)
+
+
+class FeatureParityTest(_ApiTestCase):
+    """ The optional backends return the same responses as the SQL queries """
+
+    def _requests(self):
+        requests = [
+            (u'/api/omop/findConceptIDs', {u'q': u'renal'}),
+            (u'/api/omop/findConceptIDs', {u'q': u'chronic cardiac', u'domain': u'Drug'}),
+            (u'/api/omop/findConceptIDs', {u'q': u'failure', u'min_count': u'100'}),
+            (u'/api/omop/findConceptIDs', {u'q': u'source', u'min_count': u'0'}),
+            (u'/api/omop/concepts', {u'q': u'100,105,%d,900' % _UNKNOWN}),
+            (u'/api/omop/mapToStandardConceptID', {u'concept_code': u'101.1', u'vocabulary_id': u'ICD9CM'}),
+            (u'/api/omop/mapFromStandardConceptID', {u'concept_id': u'102'}),
+            (u'/api/omop/vocabularies', {}),
+            (u'/api/metadata/datasets', {}),
+            (u'/api/metadata/domainCounts', {}),
+            (u'/api/metadata/domainPairCounts', {}),
+            (u'/api/metadata/patientCount', {}),
+            (u'/api/frequencies/singleConceptFreq', {u'q': u'100,101,%d,%d' % (_UNPAIRED, _UNKNOWN)}),
+            (u'/api/frequencies/pairedConceptFreq', {u'q': u'101,102'}),
+            (u'/api/frequencies/pairedConceptFreq', {u'q': u'102,101'}),
+            (u'/api/frequencies/associatedConceptFreq', {u'q': u'%d' % _UNPAIRED}),
+            (u'/api/frequencies/pairwiseConceptFreq', {u'q': u'100,101,102,103,104'}),
+            (u'/api/frequencies/pairwiseConceptFreq', {u'q': u'100,101,102', u'statistics': u'chi_square,ln_ratio'}),
+            (u'/api/frequencies/pairwiseConceptFreq', {u'q': u'100,101,102', u'format': u'matrix'}),
+            (u'/api/frequencies/mostFrequentConcepts', {u'q': u'10'}),
+            (u'/api/frequencies/mostFrequentConcepts', {u'q': u'5', u'domain': u'Procedure'}),
+        ]
+        for method in (u'chiSquare', u'obsExpRatio', u'relativeFrequency'):
+            requests += [
+                (u'/api/association/' + method, {u'concept_id_1': u'101', u'concept_id_2': u'102'}),
+                (u'/api/association/' + method, {u'concept_id_1': u'102', u'concept_id_2': u'101'}),
+                (u'/api/association/' + method, {u'concept_id_1': u'%d' % _UNPAIRED}),
+            ]
+        for path, params, _, _ in _RANKED:
+            requests += [
+                (path, params),
+                (path, dict(params, limit=u'5')),
+                (path, dict(params, min_count=u'2')),
+            ]
+        return requests
+
+    def _responses(self):
+        # Without limit or cursor, the order of tied results is unspecified
+        ranks = {path: (value_key, id_key) for path, _, value_key, id_key in _RANKED}
+        responses = []
+        for path, params in self._requests():
+            status, response = self.get(path, params)
+            if status == 200 and path in ranks and u'limit' not in params:
+                response[u'results'].sort(key=_rank_key(*ranks[path]))
+            responses.append((status, response))
+        responses.append(self.post(u'/api/batch', [
+            {u'service': u'frequencies', u'meta': u'singleConceptFreq', u'args': {u'dataset_id': 1, u'q': u'101'}},
+            {u'service': u'frequencies', u'meta': u'pairedConceptFreq', u'args': {u'dataset_id': 1, u'q': u'101,102'}},
+            {u'service': u'frequencies', u'meta': u'pairedConceptFreq', u'args': {u'dataset_id': 1, u'q': u'103,102'}},
+        ]))
+        return responses
+
+    def test_features(self):
+        _configure(self.path)
+        expected = self._responses()
+        self.assertTrue(all(status == 200 for status, _ in expected))
+        for features in _FEATURES:
+            _configure(self.path, features)
+            for request, response, expected_response in zip(self._requests(), self._responses(), expected):
+                self.assertSameResults(response, expected_response, u'%s %r' % (features.keys(), request))
+
+    def test_snapshot(self):
+        snapshot_dir = os.path.join(self.directory, u'snapshots')
+        conn = SQLiteBackend(self.path).connect()
+        try:
+            with _quiet():
+                export_snapshot.export(conn, snapshot_dir, [_DATASET_ID])
+        finally:
+            conn.close()
+
+        _configure(self.path)
+        expected = self._responses()
+        _configure(self.path, {u'COOCCURRENCE_ENGINE': True, u'COOCCURRENCE_SNAPSHOT_DIR': snapshot_dir})
+        for request, response, expected_response in zip(self._requests(), self._responses(), expected):
+            self.assertSameResults(response, expected_response, u'snapshot %r' % (request,))
+
+
+class PaginationTest(_ApiTestCase):
+    """ Pages read with limit and cursor return all results once, in a deterministic order """
+
+    def _check_pages(self, features):
+        _configure(self.path, features)
+        for path, params, value_key, id_key in _RANKED:
+            status, full = self.get(path, params)
+            self.assertEqual(status, 200)
+            ranked = sorted(full[u'results'], key=_rank_key(value_key, id_key))
+            self.assertGreater(len(ranked), 3, path)
+            for limit in (1, 3, 7, len(ranked), len(ranked) + 1):
+                pages = []
+                cursor = None
+                while True:
+                    page_params = dict(params, limit=u'%d' % limit)
+                    if cursor is not None:
+                        page_params[u'cursor'] = cursor
+                    status, page = self.get(path, page_params)
+                    self.assertEqual(status, 200)
+                    self.assertLessEqual(len(page[u'results']), limit)
+                    self.assertEqual(page[u'total_count'], len(ranked))
+                    pages += page[u'results']
+                    cursor = page[u'next_cursor']
+                    if cursor is None:
+                        break
+                    self.assertLess(len(pages), len(ranked), u'%s: more pages than results' % path)
+                self.assertSameResults(pages, ranked, u'%s %r limit %d' % (path, features.keys(), limit))
+
+    def test_sql(self):
+        self._check_pages({})
+
+    def test_cooccurrence_engine(self):
+        self._check_pages({u'COOCCURRENCE_ENGINE': True})
+
+    def test_infinite_statistics(self):
+        _configure(self.path)
+        status, full = self.get(u'/api/association/chiSquare', {u'concept_id_1': u'%d' % _EVERY_PATIENT})
+        self.assertEqual(status, 200)
+        self.assertTrue(full[u'results'])
+        self.assertTrue(all(math.isinf(r[u'chi_square']) for r in full[u'results']))
+
+    def test_filters(self):
+        for features in ({}, {u'COOCCURRENCE_ENGINE': True}):
+            _configure(self.path, features)
+            status, page = self.get(u'/api/association/obsExpRatio',
+                                    {u'concept_id_1': u'101', u'min_count': u'2', u'min_statistic': u'1'})
+            self.assertEqual(status, 200)
+            self.assertTrue(all(r[u'observed_count'] >= 2 and r[u'ln_ratio'] >= 1 for r in page[u'results']))
+
+    def test_invalid(self):
+        _configure(self.path)
+        for params in ({u'limit': u'0'}, {u'limit': u'-1'}, {u'limit': u'x'}, {u'cursor': u'x'},
+                       {u'min_count': u'x'}, {u'min_statistic': u'x'}):
+            status, _ = self.get(u'/api/association/chiSquare', dict(params, concept_id_1=u'101'))
+            self.assertEqual(status, 400, params)
+
+
+class ConceptSearchTest(_ApiTestCase):
+    def test_fuzzy(self):
+        _configure(self.path, {u'CONCEPT_SEARCH_INDEX': True})
+        status, exact = self.get(u'/api/omop/findConceptIDs', {u'q': u'cardiac'})
+        self.assertEqual(status, 200)
+        status, fuzzy = self.get(u'/api/omop/findConceptIDs', {u'q': u'cardaic', u'fuzzy': u'true'})
+        self.assertEqual(status, 200)
+        self.assertTrue(set(r[u'concept_id'] for r in exact[u'results']) <=
+                        set(r[u'concept_id'] for r in fuzzy[u'results']))
+        status, _ = self.get(u'/api/omop/findConceptIDs', {u'q': u'cardaic', u'fuzzy': u'true', u'min_count': u'0'})
+        self.assertEqual(status, 400)
+
+    def test_fuzzy_requires_index(self):
+        _configure(self.path)
+        status, _ = self.get(u'/api/omop/findConceptIDs', {u'q': u'cardaic', u'fuzzy': u'true'})
+        self.assertEqual(status, 400)
+
+
+class LoadDatasetTest(_ApiTestCase):
+    def _tables(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            return sorted(row[0] for row in conn.execute(u"SELECT name FROM sqlite_master WHERE type = 'table';"))
+        finally:
+            conn.close()
+
+    def _invalid_dataset(self, name, rows):
+        data_dir = os.path.join(self.directory, u'invalid')
+        if os.path.isdir(data_dir):
+            shutil.rmtree(data_dir)
+        os.mkdir(data_dir)
+        _write_dataset(data_dir, seed=1, patient_count=2000)
+        with open(os.path.join(data_dir, name), u'ab') as f:
+            for row in rows:
+                f.write(u'\t'.join(row).encode(u'utf-8') + b'\n')
+        return data_dir
+
+    def test_rollback(self):
+        _configure(self.path)
+        expected = [self.get(u'/api/metadata/patientCount'), self.get(u'/api/association/chiSquare',
+                                                                      {u'concept_id_1': u'101'})]
+        tables = self._tables()
+        for name, rows in ((u'concept_pair_counts.txt', [[u'101', u'x', u'1', u'0.001']]),
+                           (u'concept_pair_counts.txt', [[u'101', u'101', u'1', u'0.001']]),
+                           (u'concept_counts.txt', [[u'101', u'1']]),
+                           (u'concept_counts.txt', [[u'101', u'5', u'0.0025']])):
+            data_dir = self._invalid_dataset(name, rows)
+            with _quiet():
+                self.assertRaises(load_dataset.LoadError, load_dataset.load, load_dataset._SQLiteTarget(self.path),
+                                  data_dir, _DATASET_ID)
+            # The staging tables are dropped, and the previous data is still served
+            self.assertEqual(self._tables(), tables, name)
+            _configure(self.path)
+            actual = [self.get(u'/api/metadata/patientCount'), self.get(u'/api/association/chiSquare',
+                                                                        {u'concept_id_1': u'101'})]
+            self.assertSameResults(actual, expected, name)
+
+    def test_reload_and_other_datasets(self):
+        data_dir = os.path.join(self.directory, u'dataset_2')
+        os.mkdir(data_dir)
+        _write_dataset(data_dir, seed=2, patient_count=3000)
+        _load(self.path, data_dir, dataset_id=2)
+        _configure(self.path, {u'METADATA_CACHE': True, u'COOCCURRENCE_ENGINE': True})
+        status, datasets = self.get(u'/api/metadata/datasets')
+        self.assertEqual([d[u'dataset_id'] for d in datasets[u'results']], [1, 2])
+        status, count = self.get(u'/api/metadata/patientCount')
+        self.assertEqual(count[u'results'][0][u'count'], _PATIENT_COUNT)
+
+        # Reloading dataset 2 while it is served: the metadata cache is refreshed by invalidateDataset
+        _write_dataset(data_dir, seed=3, patient_count=4000)
+        _load(self.path, data_dir, dataset_id=2)
+        with _quiet():
+            response = self.client.post(u'/api/admin/invalidateDataset', query_string={u'dataset_id': 2})
+        self.assertEqual(response.status_code, 200)
+        response.close()
+        requests = [(u'/api/metadata/patientCount', {u'dataset_id': u'2'}),
+                    (u'/api/association/chiSquare', {u'dataset_id': u'2', u'concept_id_1': u'101', u'limit': u'100'})]
+        actual = [self.get(path, params) for path, params in requests]
+        self.assertEqual(actual[0][1][u'results'][0][u'count'], 4000)
+        _configure(self.path)
+        self.assertSameResults(actual, [self.get(path, params) for path, params in requests])
+
+
+if __name__ == u'__main__':
+    unittest.main()
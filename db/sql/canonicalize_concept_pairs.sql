@@ -0,0 +1,41 @@
+-- Canonical pair ordering for concept_pair_counts, and a per-concept adjacency table
+--
+-- Each pair is stored once in concept_pair_counts. Storing it with concept_id_1 < concept_id_2 turns the lookup of a
+-- pair into one primary key lookup on (dataset_id, LEAST(a, b), GREATEST(a, b)) instead of an
+-- (a, b) OR (b, a) predicate. concept_pair_adjacency stores every pair in both directions so that all partners of a
+-- concept are read with one range scan of (dataset_id, concept_id) instead of a UNION of scans on concept_id_1 and
+-- concept_id_2. Partners are read in order of their pair count from concept_count_idx.
+--
+-- This file only documents the schema of both tables. Migrate the data with cohd/build_canonical_pairs.py, which
+-- stops without changing the tables if a pair is stored in both orientations with different counts (see the query
+-- below), loads the tables for selected datasets, and swaps them in atomically. Enable the canonical queries with
+-- CANONICAL_PAIRS = True in cohd_flask.conf after migrating.
+
+
+-- Pairs in canonical order
+CREATE TABLE IF NOT EXISTS cohd.concept_pair_counts (
+  dataset_id TINYINT NOT NULL,
+  concept_id_1 INT(11) NOT NULL,
+  concept_id_2 INT(11) NOT NULL,
+  concept_count INT UNSIGNED NOT NULL,
+  concept_frequency DOUBLE NOT NULL,
+  PRIMARY KEY (dataset_id, concept_id_1, concept_id_2),
+  INDEX concept_id_2_idx (dataset_id, concept_id_2 ASC));
+
+
+-- Both directions of each pair
+CREATE TABLE IF NOT EXISTS cohd.concept_pair_adjacency (
+  dataset_id TINYINT NOT NULL,
+  concept_id INT(11) NOT NULL,
+  associated_concept_id INT(11) NOT NULL,
+  concept_count INT UNSIGNED NOT NULL,
+  PRIMARY KEY (dataset_id, concept_id, associated_concept_id),
+  INDEX concept_count_idx (dataset_id, concept_id, concept_count DESC));
+
+
+-- Pairs stored in both orientations with different counts, which block the migration
+-- SELECT a.dataset_id, a.concept_id_1, a.concept_id_2, a.concept_count, b.concept_count
+-- FROM cohd.concept_pair_counts a
+-- JOIN cohd.concept_pair_counts b ON b.dataset_id = a.dataset_id AND b.concept_id_1 = a.concept_id_2
+--     AND b.concept_id_2 = a.concept_id_1
+-- WHERE a.concept_id_1 < a.concept_id_2 AND a.concept_count <> b.concept_count;
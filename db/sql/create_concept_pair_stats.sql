@@ -0,0 +1,28 @@
+-- Precomputed association statistics between pairs of concepts
+--
+-- Each pair in concept_pair_counts is stored in both orientations so that all associations of a concept can be read
+-- in ranked order from one of the (dataset_id, concept_id_1, <statistic>) indexes. The table is populated by
+-- cohd/build_association_stats.py, which builds a copy of this table, adds the secondary indexes after loading, and
+-- then swaps the copy in. Counts are NULL for concepts missing from concept_counts, as are the statistics that depend
+-- on them.
+
+CREATE TABLE IF NOT EXISTS cohd.concept_pair_stats (
+  dataset_id TINYINT NOT NULL,
+  concept_id_1 INT(11) NOT NULL,
+  concept_id_2 INT(11) NOT NULL,
+  concept_pair_count INT UNSIGNED NOT NULL,
+  concept_count_1 INT UNSIGNED NULL,
+  concept_count_2 INT UNSIGNED NULL,
+  chi_square DOUBLE NULL,
+  p_value DOUBLE NULL,
+  expected_count DOUBLE NULL,
+  ln_ratio DOUBLE NULL,
+  relative_frequency DOUBLE NULL,
+  PRIMARY KEY (dataset_id, concept_id_1, concept_id_2));
+
+
+-- Add indices ordered by each statistic
+ALTER TABLE cohd.concept_pair_stats
+ADD INDEX chi_square_idx (dataset_id, concept_id_1, chi_square DESC),
+ADD INDEX ln_ratio_idx (dataset_id, concept_id_1, ln_ratio DESC),
+ADD INDEX relative_frequency_idx (dataset_id, concept_id_1, relative_frequency DESC);
@@ -1,3 +1,6 @@
+-- Superseded by cohd/load_dataset.py, which loads a dataset with its dataset_id into the tables that the API queries.
+-- Kept for reference.
+
 -- Create schema
 CREATE SCHEMA cohd;
 